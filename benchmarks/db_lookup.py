@@ -0,0 +1,121 @@
+"""Time upload lookups on a large uploads table before and after migrations."""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))  # noqa:E501
+
+from database import DB  # noqa:E402
+
+# schema as it was before versioned migrations, without any indexes
+LEGACY_SCHEMA = '''
+CREATE TABLE albums(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    gid VARCHAR NOT NULL UNIQUE,
+    name VARCHAR
+);
+CREATE TABLE uploads(
+    album_id INTEGER NOT NULL,
+    local_dir VARCHAR NOT NULL,
+    filename VARCHAR NOT NULL,
+    media_id VARCHAR DEFAULT NULL,
+    event_time DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (album_id) REFERENCES albums(id)
+);
+'''
+
+
+def main():
+    """Entrypoint."""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--rows',
+        type=int,
+        default=5000000,
+        help='number of rows in uploads table'
+    )
+    parser.add_argument(
+        '--files-per-dir',
+        type=int,
+        default=500,
+        help='rows sharing each local_dir'
+    )
+    parser.add_argument(
+        '--lookups',
+        type=int,
+        default=100,
+        help='number of select_uploads calls to time'
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, 'bench.db')
+        populate(filename, args.rows, args.files_per_dir)
+        num_dirs = args.rows // args.files_per_dir
+
+        connection = sqlite3.connect(filename)
+        query = open(os.path.join(
+            os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+            'database',
+            'queries',
+            'select_uploads_by_pair.sql'
+        )).read()
+        before = timed_lookups(
+            lambda x: connection.execute(query, x).fetchall(),
+            num_dirs,
+            args.lookups
+        )
+        connection.close()
+
+        start = time.perf_counter()
+        db = DB(filename)
+        migrate_time = time.perf_counter() - start
+        after = timed_lookups(
+            lambda x: db.select_uploads(x['local_dir'], x['album_id']),
+            num_dirs,
+            args.lookups
+        )
+
+    print(f'rows: {args.rows}')
+    print(f'before migrations: {before * 1000:.3f} ms/lookup')
+    print(f'migrations: {migrate_time:.1f} s')
+    print(f'after migrations: {after * 1000:.3f} ms/lookup')
+
+
+def populate(filename, rows, files_per_dir):
+    """Fill legacy schema with synthetic uploads."""
+    connection = sqlite3.connect(filename)
+    connection.executescript(LEGACY_SCHEMA)
+    connection.execute(
+        "INSERT INTO albums (gid, name) VALUES ('gid', 'bench')"
+    )
+    connection.executemany(
+        'INSERT INTO uploads (album_id, local_dir, filename, media_id) '
+        'VALUES (1, ?, ?, ?)',
+        (
+            (f'/photos/{x // files_per_dir}', f'IMG_{x}.JPG', f'media-{x}')
+            for x in range(rows)
+        )
+    )
+    connection.commit()
+    connection.close()
+
+
+def timed_lookups(select, num_dirs, lookups):
+    """Average seconds per lookup of one dir/album pair."""
+    start = time.perf_counter()
+    for x in range(lookups):
+        select({
+            'local_dir': f'/photos/{(x * 7919) % num_dirs}',
+            'album_id': 1
+        })
+    return (time.perf_counter() - start) / lookups
+
+
+if __name__ == '__main__':
+    main()
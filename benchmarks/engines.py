@@ -0,0 +1,191 @@
+"""Compare serial, threaded and asyncio upload engines against fake API."""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# smallest header with a start of scan, and end of image marker
+JPEG_HEAD = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00\xff\xda\x00\x08\x01\x01\x00\x00\x3f\x00'  # noqa:E501
+JPEG_TAIL = b'\xff\xd9'
+
+# file type and empty movie boxes, media data box follows to end of file
+MP4_HEAD = b'\x00\x00\x00\x10ftypisom\x00\x00\x02\x00\x00\x00\x00\x08moov'  # noqa:E501
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+
+def main():
+    """Entrypoint."""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--files',
+        type=int,
+        default=500,
+        help='number of synthetic files to upload per engine'
+    )
+    parser.add_argument(
+        '--file-size',
+        type=int,
+        default=256 * 1024,
+        help='bytes per synthetic file'
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.05,
+        help='seconds fake API adds to every call'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=32,
+        help='uploads in flight for threaded and async engines'
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            FakeAPI(args.latency) as url_base:
+
+        # point clients at fake API before they are imported
+        os.environ['GPHOTOS_API_URL'] = url_base
+        from gphoto import Client
+        from gphoto.aio import AsyncClient
+
+        token_filename = write_token_file(tmp_dir, url_base)
+        filenames = write_files(tmp_dir, args.files, args.file_size)
+        total_bytes = args.files * args.file_size
+
+        def run_sync(workers):
+            client = Client(token_filename, workers=workers)
+            album_id = client.create_album('bench').json()['id']
+            for _ in client.post_batch_media(filenames, album_id):
+                pass
+
+        async def run_async():
+            async with AsyncClient(token_filename, workers=args.workers) as client:  # noqa:E501
+                album_id = (await client.create_album('bench')).json()['id']
+                async for _ in client.post_batch_media(filenames, album_id):
+                    pass
+
+        results = [
+            ('serial', timed(lambda: run_sync(1))),
+            ('threads', timed(lambda: run_sync(args.workers))),
+            ('async', timed(lambda: asyncio.run(run_async())))
+        ]
+
+    print(f'{args.files} files x {args.file_size} bytes, {args.latency}s latency')  # noqa:E501
+    for engine, seconds in results:
+        print(
+            f'{engine:>8}: {seconds:7.2f} s '
+            f'{args.files / seconds:8.1f} files/s '
+            f'{total_bytes / seconds / 1024 / 1024:8.1f} MB/s'
+        )
+
+
+class FakeAPI(object):
+    """Run fake API server in subprocess, so it does not share the GIL."""
+
+    def __init__(self, latency=0, extra_args=[]):
+        """Pick free port for server.
+
+        Args:
+            latency (float): seconds fake API adds to every call
+            extra_args (list[str]): more fake_api.py cli arguments
+        """
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.args = [
+            sys.executable,
+            os.path.join(BENCH_DIR, 'fake_api.py'),
+            '--port', str(self.port),
+            '--latency', str(latency)
+        ] + extra_args
+        self.process = None
+
+    def __enter__(self):
+        """Start server and wait until it accepts connections."""
+        self.process = subprocess.Popen(self.args, stdout=subprocess.DEVNULL)
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        return f'http://127.0.0.1:{self.port}/'
+
+    def __exit__(self, *args):
+        """Stop server."""
+        self.process.terminate()
+        self.process.wait()
+
+
+def write_token_file(tmp_dir, url_base):
+    """User token the fake API accepts, refreshed against its token url."""
+    filename = os.path.join(tmp_dir, 'auth_token.json')
+    with open(filename, 'w') as f:
+        f.write(json.dumps({
+            'token': 'fake',
+            'refresh_token': 'fake',
+            'token_uri': url_base + 'token',
+            'client_id': 'fake',
+            'client_secret': 'fake',
+            'scopes': ['https://www.googleapis.com/auth/photoslibrary'],
+            'expiry': '2999-01-01T00:00:00Z'
+        }))
+    return filename
+
+
+def write_files(tmp_dir, count, size, ext='jpg', sub_dir='media', sparse=False):  # noqa:E501
+    """Synthetic media files of random bytes.
+
+    Sparse files start with random bytes, so content hashes still differ,
+    then are extended with holes to size without using disk space. JPEG
+    files are framed with markers and MP4 files laid out as boxes, so they
+    pass pre-flight checks.
+    """
+    media_dir = os.path.join(tmp_dir, sub_dir)
+    os.makedirs(media_dir, exist_ok=True)
+    head, tail = b'', b''
+    if ext == 'jpg':
+        head, tail = JPEG_HEAD, JPEG_TAIL
+    elif ext == 'mp4':
+        # 64 bit media data size, huge files may be over 4 GB
+        mdat_size = max(16, size - len(MP4_HEAD))
+        mdat_head = b'\x00\x00\x00\x01mdat' + mdat_size.to_bytes(8, 'big')
+        head = MP4_HEAD + mdat_head
+        size = max(size, len(head))
+    filenames = []
+    for x in range(count):
+        filename = os.path.join(media_dir, f'{x:06d}.{ext}')
+        body_size = max(0, size - len(head) - len(tail))
+        with open(filename, 'wb') as f:
+            f.write(head)
+            if sparse:
+                f.write(os.urandom(min(body_size, 64 * 1024)))
+                f.truncate(size - len(tail))
+                f.seek(size - len(tail))
+            else:
+                f.write(os.urandom(body_size))
+            f.write(tail)
+        filenames.append(filename)
+    return filenames
+
+
+def timed(func):
+    """Seconds to run func."""
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""Local stand-in for the Google Photos API, for benchmarks only."""
+
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    """Serve upload, batchCreate, batchAddMediaItems, album and token endpoints."""  # noqa:E501
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        """Keep benchmark output quiet."""
+
+    def do_GET(self):
+        """List albums a page at a time, or get one."""
+        path, _, query = self.path.partition('?')
+        if path == '/v1/albums' or path.startswith('/v1/albums/'):
+            self._delay()
+            if self._inject_failure():
+                return
+            with self.server.lock:
+                albums = list(self.server.albums)
+            if path.startswith('/v1/albums/'):
+                for album in albums:
+                    if album['id'] == path.split('/')[-1]:
+                        return self._send(200, album)
+                return self._send(404, {})
+            params = urllib.parse.parse_qs(query)
+            page_size = int(params.get('pageSize', ['50'])[0])
+            start = int(params.get('pageToken', ['0'])[0])
+            page = {'albums': albums[start:start + page_size]}
+            if start + page_size < len(albums):
+                page['nextPageToken'] = str(start + page_size)
+            return self._send(200, page)
+        self._send(404, {})
+
+    def do_POST(self):
+        """Route upload, batchCreate, album and token requests."""
+        path = self.path.split('?')[0]
+        if path == '/token':
+            self._read_body()
+            return self._send(200, {
+                'access_token': uuid.uuid4().hex,
+                'expires_in': 3600
+            })
+        self._delay()
+        if self._inject_failure():
+            return
+        if path == '/v1/uploads':
+            if self.headers.get('X-Goog-Upload-Protocol') == 'resumable':
+                return self._start_session()
+            self._discard_body()
+            return self._send(200, self._new_upload_token())
+        if path.startswith('/upload-sessions/'):
+            return self._continue_session(path.split('/')[-1])
+        if path == '/v1/mediaItems:batchCreate':
+            return self._batch_create(json.loads(self._read_body()))
+        if path.startswith('/v1/albums/') and path.endswith(':batchAddMediaItems'):  # noqa:E501
+            return self._batch_add(json.loads(self._read_body()))
+        if path == '/v1/albums':
+            data = json.loads(self._read_body())
+            album = {
+                'id': uuid.uuid4().hex,
+                'title': data['album']['title']
+            }
+            with self.server.lock:
+                self.server.albums.append(album)
+            return self._send(200, album)
+        self._send(404, {})
+
+    def _start_session(self):
+        self._discard_body()
+        session_id = uuid.uuid4().hex
+        with self.server.lock:
+            self.server.sessions[session_id] = 0
+        host = self.headers.get('Host')
+        self._send(200, '', {
+            'X-Goog-Upload-URL': f'http://{host}/upload-sessions/{session_id}',  # noqa:E501
+            'X-Goog-Upload-Chunk-Granularity': '262144'
+        })
+
+    def _continue_session(self, session_id):
+        command = self.headers.get('X-Goog-Upload-Command', '')
+        with self.server.lock:
+            received = self.server.sessions.get(session_id)
+        if received is None:
+            return self._send(404, {})
+        if command == 'query':
+            return self._send(200, '', {
+                'X-Goog-Upload-Status': 'active',
+                'X-Goog-Upload-Size-Received': str(received)
+            })
+        if int(self.headers.get('X-Goog-Upload-Offset', -1)) != received:
+            self._discard_body()
+            return self._send(400, {})
+        received += self._discard_body()
+        with self.server.lock:
+            self.server.sessions[session_id] = received
+        if 'finalize' in command:
+            return self._send(200, self._new_upload_token())
+        self._send(200, '', {
+            'X-Goog-Upload-Status': 'active'
+        })
+
+    def _batch_create(self, data):
+        results = []
+        with self.server.lock:
+            for item in data['newMediaItems']:
+                upload_token = item['simpleMediaItem']['uploadToken']
+                if upload_token in self.server.upload_tokens:
+                    self.server.upload_tokens.remove(upload_token)
+                    media_id = uuid.uuid4().hex
+                    self.server.media_items.add(media_id)
+                    results.append({
+                        'uploadToken': upload_token,
+                        'status': {'message': 'Success'},
+                        'mediaItem': {'id': media_id}
+                    })
+                else:
+                    results.append({
+                        'uploadToken': upload_token,
+                        'status': {'message': 'Invalid upload token'}
+                    })
+        self._send(200, {'newMediaItemResults': results})
+
+    def _batch_add(self, data):
+
+        # all or nothing, like the real API
+        media_ids = data.get('mediaItemIds', [])
+        with self.server.lock:
+            known = all(x in self.server.media_items for x in media_ids)
+        if not media_ids or len(media_ids) > 50 or not known:
+            return self._send(400, {})
+        self._send(200, {})
+
+    def _new_upload_token(self):
+        upload_token = uuid.uuid4().hex
+        with self.server.lock:
+            self.server.upload_tokens.add(upload_token)
+        return upload_token
+
+    def _delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def _inject_failure(self):
+        """Answer with throttling or server error instead, at configured rates."""  # noqa:E501
+        roll = random.random()
+        if roll < self.server.throttle_rate:
+            self._discard_body()
+            self._send(429, {}, {
+                'Retry-After': str(self.server.retry_after)
+            })
+            return True
+        if roll < self.server.throttle_rate + self.server.error_rate:
+            self._discard_body()
+            self._send(503, {})
+            return True
+        return False
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _discard_body(self):
+        """Read body in chunks, so huge uploads are not held in memory."""
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            chunk = self.rfile.read(min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            self.server.throttle_bandwidth(len(chunk))
+        return int(self.headers.get('Content-Length', 0)) - remaining
+
+    def _send(self, status, body, headers={}):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        body = body.encode()
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeAPIServer(ThreadingHTTPServer):
+    """Threaded server with room for many concurrent connections."""
+
+    daemon_threads = True
+    request_queue_size = 1024
+    bandwidth = None
+    bandwidth_free_at = 0.0
+
+    def throttle_bandwidth(self, size):
+        """Hold reader until size bytes fit under cap shared by all uploads."""
+        if not self.bandwidth:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.bandwidth_free_at = max(now, self.bandwidth_free_at) + size / self.bandwidth  # noqa:E501
+            wait = self.bandwidth_free_at - now
+        time.sleep(wait)
+
+
+def create_server(port=0, latency=0, bandwidth=None, error_rate=0, throttle_rate=0, retry_after=1):  # noqa:E501
+    """Build fake API server, call serve_forever to start it.
+
+    Args:
+        port (int): local port to listen on, 0 picks a free one
+        latency (float): seconds added to every API call
+        bandwidth (int): upload bytes per second accepted across all connections
+        error_rate (float): fraction of API calls answered with 503
+        throttle_rate (float): fraction of API calls answered with 429
+        retry_after (float): seconds sent in Retry-After of 429s
+
+    Returns:
+        FakeAPIServer: server with fake API state attached
+    """  # noqa:E501
+    server = FakeAPIServer(('127.0.0.1', port), FakeAPIHandler)
+    server.lock = threading.Lock()
+    server.latency = latency
+    server.bandwidth = bandwidth
+    server.error_rate = error_rate
+    server.throttle_rate = throttle_rate
+    server.retry_after = retry_after
+    server.albums = []
+    server.sessions = {}
+    server.upload_tokens = set()
+    server.media_items = set()
+    return server
+
+
+def main():
+    """Entrypoint."""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8765,
+        help='local port to listen on'
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0,
+        help='seconds added to every API call'
+    )
+    parser.add_argument(
+        '--bandwidth',
+        type=int,
+        default=None,
+        help='upload bytes per second accepted across all connections'
+    )
+    parser.add_argument(
+        '--error-rate',
+        type=float,
+        default=0,
+        help='fraction of API calls answered with 503'
+    )
+    parser.add_argument(
+        '--throttle-rate',
+        type=float,
+        default=0,
+        help='fraction of API calls answered with 429'
+    )
+    parser.add_argument(
+        '--retry-after',
+        type=float,
+        default=1,
+        help='seconds sent in Retry-After of 429s'
+    )
+    args = parser.parse_args()
+
+    server = create_server(
+        args.port,
+        args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after
+    )
+    print(f'Serving fake API at http://127.0.0.1:{server.server_port}/')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Wall time of short cli commands, each in a fresh interpreter."""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+CLI = os.path.join(os.path.dirname(BENCH_DIR), 'cli.py')
+
+
+def main():
+    """Entrypoint."""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--runs',
+        type=int,
+        default=20,
+        help='times to run each command'
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app_data = os.path.join(tmp_dir, 'app_data')
+        cases = [
+            ('python', [sys.executable, '-c', 'pass']),
+            ('--help', [sys.executable, CLI, '--help']),
+            ('list-albums', [sys.executable, CLI, '--app-data', app_data, 'list-albums'])  # noqa:E501
+        ]
+
+        # first run creates the schema, which later runs should skip
+        subprocess.run(cases[-1][1], stdout=subprocess.DEVNULL)
+
+        print(f"{'command':>12} {'median ms':>10} {'min ms':>8}")
+        for name, command in cases:
+            seconds = [run(command) for _ in range(args.runs)]
+            print(
+                f'{name:>12} '
+                f'{statistics.median(seconds) * 1000:10.1f} '
+                f'{min(seconds) * 1000:8.1f}'
+            )
+
+
+def run(command):
+    """Seconds for command to exit."""
+    start = time.perf_counter()
+    subprocess.run(command, stdout=subprocess.DEVNULL, check=False)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    main()
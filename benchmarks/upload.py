@@ -0,0 +1,322 @@
+"""Throughput, memory and db time of upload path over synthetic datasets."""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from database import DB  # noqa:E402
+
+from gphoto.schedule import BATCH_BYTES  # noqa:E402
+from gphoto.schedule import ORDERS  # noqa:E402
+
+from engines import FakeAPI  # noqa:E402
+from engines import timed  # noqa:E402
+from engines import write_files  # noqa:E402
+from engines import write_token_file  # noqa:E402
+
+TARGETS = ['client', 'cli']
+DATASETS = ['small', 'huge', 'mixed']
+
+
+def main():
+    """Entrypoint."""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--targets',
+        nargs='+',
+        choices=TARGETS,
+        default=TARGETS,
+        help='drive gphoto.Client directly, or cli upload-album end to end'
+    )
+    parser.add_argument(
+        '--datasets',
+        nargs='+',
+        choices=DATASETS,
+        default=DATASETS,
+        help='many small jpgs, a few huge mp4s, or half the small plus one huge'  # noqa:E501
+    )
+    parser.add_argument(
+        '--small-files',
+        type=int,
+        default=500,
+        help='number of jpgs in small dataset'
+    )
+    parser.add_argument(
+        '--small-size',
+        type=int,
+        default=512 * 1024,
+        help='bytes per jpg'
+    )
+    parser.add_argument(
+        '--huge-files',
+        type=int,
+        default=2,
+        help='number of mp4s in huge dataset'
+    )
+    parser.add_argument(
+        '--huge-size',
+        type=int,
+        default=2 * 1024 * 1024 * 1024,
+        help='bytes per mp4, written sparse so disk space is not used'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=16,
+        help='number of files to upload concurrently'
+    )
+    parser.add_argument(
+        '--hash-workers',
+        type=int,
+        default=None,
+        help='number of processes hashing files in cli target'
+    )
+    parser.add_argument(
+        '--engine',
+        choices=['threads', 'async'],
+        default='threads',
+        help='upload engine of cli target'
+    )
+    parser.add_argument(
+        '--order',
+        choices=ORDERS,
+        default='scan',
+        help='order files are batched in'
+    )
+    parser.add_argument(
+        '--requests-per-minute',
+        type=int,
+        default=1000000,
+        help='client side API pacing, set to 6000 to include it'
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.05,
+        help='seconds fake API adds to every call'
+    )
+    parser.add_argument(
+        '--bandwidth',
+        type=int,
+        default=None,
+        help='upload bytes per second fake API accepts'
+    )
+    parser.add_argument(
+        '--error-rate',
+        type=float,
+        default=0,
+        help='fraction of API calls fake API answers with 503'
+    )
+    parser.add_argument(
+        '--throttle-rate',
+        type=float,
+        default=0,
+        help='fraction of API calls fake API answers with 429'
+    )
+    parser.add_argument(
+        '--case',
+        nargs=4,
+        help=argparse.SUPPRESS
+    )
+    args = parser.parse_args()
+
+    # measure one target and dataset, called in its own process by main
+    if args.case:
+        print(json.dumps(run_case(*args.case, args)))
+        return
+
+    fake_api_args = [
+        '--error-rate', str(args.error_rate),
+        '--throttle-rate', str(args.throttle_rate)
+    ]
+    if args.bandwidth:
+        fake_api_args += ['--bandwidth', str(args.bandwidth)]
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            FakeAPI(args.latency, fake_api_args) as url_base:
+        token_filename = write_token_file(tmp_dir, url_base)
+        datasets = write_datasets(tmp_dir, args)
+        for dataset in args.datasets:
+            for target in args.targets:
+
+                # fresh process per case, so peak RSS is not carried over
+                process = subprocess.run(
+                    [
+                        sys.executable,
+                        os.path.realpath(__file__),
+                        '--case',
+                        target,
+                        datasets[dataset],
+                        token_filename,
+                        os.path.join(tmp_dir, f'{target}-{dataset}.sqlite')
+                    ] + sys.argv[1:],
+                    env={**os.environ, 'GPHOTOS_API_URL': url_base},
+                    stdout=subprocess.PIPE,
+                    check=True
+                )
+                results.append((
+                    target,
+                    dataset,
+                    json.loads(process.stdout.decode().splitlines()[-1])
+                ))
+
+    print(
+        f'{args.latency}s latency, {args.workers} workers, '
+        f'{args.error_rate} error rate, {args.throttle_rate} throttle rate'
+    )
+    print(f"{'target':>8} {'dataset':>8} {'files':>6} {'seconds':>8} {'first s':>8} {'files/s':>8} {'MB/s':>8} {'RSS MB':>8} {'DB s':>7}")  # noqa:E501
+    for target, dataset, x in results:
+        print(
+            f'{target:>8} {dataset:>8} {x["files"]:>6} '
+            f'{x["seconds"]:8.2f} '
+            f'{x["first_commit_seconds"]:8.2f} '
+            f'{x["files"] / x["seconds"]:8.1f} '
+            f'{x["bytes"] / x["seconds"] / 1024 / 1024:8.1f} '
+            f'{x["peak_rss_mb"]:8.1f} '
+            f'{x["db_seconds"]:7.2f}'
+        )
+
+
+class TimedDB(DB):
+    """App database adding up time spent in queries, lock waits included."""
+
+    seconds = 0.0
+    first_commit = None
+
+    def insert_uploads(self, *args, **kwargs):
+        """Note when first batch of results is saved."""
+        if self.first_commit is None:
+            self.first_commit = time.perf_counter()
+        return super().insert_uploads(*args, **kwargs)
+
+    def _select(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super()._select(*args, **kwargs)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def _modify(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super()._modify(*args, **kwargs)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+def write_datasets(tmp_dir, args):
+    """Synthetic media dirs, by dataset name."""
+    write_files(tmp_dir, args.small_files, args.small_size, 'jpg', 'small')
+    write_files(tmp_dir, args.huge_files, args.huge_size, 'mp4', 'huge', sparse=True)  # noqa:E501
+    write_files(tmp_dir, args.small_files // 2, args.small_size, 'jpg', 'mixed')  # noqa:E501
+    write_files(tmp_dir, 1, args.huge_size, 'mp4', 'mixed', sparse=True)
+    return {
+        x: os.path.join(tmp_dir, x)
+        for x in DATASETS
+    }
+
+
+def run_case(target, media_dir, token_filename, db_filename, args):
+    """Upload dataset once, with the fake API url already in environment.
+
+    Args:
+        target (str): client or cli
+        media_dir (str): full path of dataset directory
+        token_filename (str): user token fake API accepts
+        db_filename (str): new sqlite database for this case
+        args (argparse.Namespace): benchmark settings
+
+    Returns:
+        dict: files, bytes, seconds, first_commit_seconds, peak_rss_mb and db_seconds
+    """  # noqa:E501
+    import cli
+    from gphoto import Client
+    from gphoto.throttle import RateLimiter
+
+    filenames = sorted(
+        os.path.join(media_dir, x)
+        for x in os.listdir(media_dir)
+    )
+    db = TimedDB(db_filename)
+    committed = []
+
+    def run_client():
+        client = Client(
+            token_filename,
+            workers=args.workers,
+            upload_store=db,
+            rate_limiter=RateLimiter(requests_per_minute=args.requests_per_minute)  # noqa:E501
+        )
+        album_gid = client.create_album('bench').json()['id']
+        for results in client.post_batch_media(filenames, album_gid, order=args.order):  # noqa:E501
+            if db.first_commit is None:
+                db.first_commit = time.perf_counter()
+            committed.extend(
+                x['filename']
+                for x in results.values()
+                if x.get('media_id')
+            )
+
+    def run_cli():
+        album_gid = Client(token_filename).create_album('bench').json()['id']
+        album_id = db.insert_album(album_gid, 'bench')
+
+        # real parser defaults, so options added later need no change here
+        upload_args = cli.build_parser().parse_args([
+            'upload-album',
+            media_dir,
+            str(album_id),
+            '--token-file', token_filename,
+            '--workers', str(args.workers),
+            '--engine', args.engine,
+            '--batch-bytes', str(BATCH_BYTES),
+            '--order', args.order,
+            '--requests-per-minute', str(args.requests_per_minute),
+            '--daily-batch-create', '1000000'
+        ] + (
+            ['--hash-workers', str(args.hash_workers)]
+            if args.hash_workers else []
+        ))
+        # exits early when every file is skipped, counted below as failure
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull), \
+                contextlib.suppress(SystemExit):
+            cli.upload_album(upload_args, db)
+        committed.extend(
+            os.path.join(media_dir, x['filename'])
+            for x in db.select_uploads(media_dir, album_id)
+            if x['uploaded']
+        )
+
+    db.seconds = 0.0
+    start = time.perf_counter()
+    seconds = timed(run_client if target == 'client' else run_cli)
+
+    # files skipped by checks or failed would inflate throughput
+    if len(set(committed)) != len(filenames):
+        raise RuntimeError(
+            f'{target} committed {len(set(committed))} of {len(filenames)} files in {media_dir}'  # noqa:E501
+        )
+    return {
+        'files': len(committed),
+        'bytes': sum(os.path.getsize(x) for x in committed),
+        'seconds': seconds,
+        'first_commit_seconds': db.first_commit - start,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # noqa:E501
+        'db_seconds': db.seconds
+    }
+
+
+if __name__ == '__main__':
+    main()
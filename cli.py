@@ -1,25 +1,87 @@
 """CLI to upload to google-photos."""
 
 import argparse
+import itertools
+import json
 import os
+import shutil
+import signal
+import time
 
 from database import DB
+from database import JOURNAL_MODES
 
 from gphoto import Client
-from gphoto import valid_photo_ext
-from gphoto import valid_video_ext
+from gphoto.schedule import BATCH_BYTES
+from gphoto.schedule import ORDERS
+from gphoto.throttle import DAILY_BATCH_CREATE
+from gphoto.throttle import HTTPError
+from gphoto.throttle import QuotaExceeded
+from gphoto.throttle import REQUESTS_PER_MINUTE
+from gphoto.throttle import BandwidthLimiter
+from gphoto.throttle import RateLimiter
+from gphoto.throttle import parse_rate
+from gphoto.throttle import parse_rate_window
 
-from tabulate import tabulate
+from media import DirScanner
+from media import hash_files
+from media import media_dirs
+from media.exiftool import EXIFTOOL
+from media.exiftool import Tagger
+from media.exiftool import validate_tags
+from media.preflight import Preflight
+from media.shard import LEASE_SECONDS
+from media.shard import ShardLeases
+from media.transform import TRANSFORM_CACHE_MAX_BYTES
+from media.transform import TransformCache
+from media.transform import prune_cache
+
+from metrics import Metrics
 
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# remote albums rarely change other than through create-album, which caches
+ALBUM_CATALOGUE_MAX_AGE_MINUTES = 60
+
 
 def main():
     """Entrypoint."""
+    parser = build_parser()
+
+    # parse and save args
+    args = parser.parse_args()
+
+    # call func related to command
+    if 'func' not in args:
+        parser.print_help()
+        exit(1)
+
+    metrics = Metrics()
+    db = DB(args.app_data, metrics=metrics, journal_mode=args.journal_mode)
+
+    # export at exit, including early exits on errors or nothing to do
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        if profiler:
+            profiler.enable()
+        args.func(args, db)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        _write_metrics(args, metrics)
+
+
+def build_parser():
+    """Command line parser of every command, e.g. for benchmarks to call them."""  # noqa:E501
     default_app_data_filename = os.path.join(SCRIPT_DIR, 'database/.app_data')
     default_token_filename = os.path.join(SCRIPT_DIR, 'auth_token.json')
     default_credentials_filename = os.path.join(SCRIPT_DIR, 'credentials.json')
+    default_transform_cache_dir = os.path.join(SCRIPT_DIR, 'database/.transform_cache')  # noqa:E501
 
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -28,6 +90,27 @@ def main():
         default=default_app_data_filename,
         help='filename to store app data in sqlite'
     )
+    parser.add_argument(
+        '--journal-mode',
+        choices=list(JOURNAL_MODES),
+        default='wal',
+        help='sqlite journal, delete if app data is on a network mount shared by hosts'  # noqa:E501
+    )
+    parser.add_argument(
+        '--metrics-json',
+        default=None,
+        help='filename to write json summary of timings and counters to at exit'  # noqa:E501
+    )
+    parser.add_argument(
+        '--metrics-prom',
+        default=None,
+        help='filename to write timings and counters to at exit, in prometheus text format for node_exporter'  # noqa:E501
+    )
+    parser.add_argument(
+        '--profile',
+        default=None,
+        help='filename to write cProfile stats of main thread to at exit'
+    )
 
     subparser = parser.add_subparsers(dest='command')
 
@@ -63,6 +146,17 @@ def main():
         default=default_token_filename,
         help='filename for oauth user token, only relevent if -a is set'
     )
+    list_albums_subparser.add_argument(
+        '--max-age',
+        type=int,
+        default=ALBUM_CATALOGUE_MAX_AGE_MINUTES,
+        help='minutes remote albums are cached for, only relevent if -a is set'  # noqa:E501
+    )
+    list_albums_subparser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='list remote albums again even if cached recently'
+    )
     list_albums_subparser.set_defaults(func=list_albums)
 
     create_album_subparser = subparser.add_parser(
@@ -100,6 +194,125 @@ def main():
         default=default_token_filename,
         help='filename for oauth user token'
     )
+    upload_album_subparser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of files to upload concurrently'
+    )
+    upload_album_subparser.add_argument(
+        '--engine',
+        choices=['threads', 'async'],
+        default='threads',
+        help='upload with a thread per worker, or asyncio tasks'
+    )
+    upload_album_subparser.add_argument(
+        '--requests-per-minute',
+        type=int,
+        default=REQUESTS_PER_MINUTE,
+        help='API calls allowed per minute, shared by all workers'
+    )
+    upload_album_subparser.add_argument(
+        '--daily-batch-create',
+        type=int,
+        default=DAILY_BATCH_CREATE,
+        help='batchCreate calls allowed per day by all runs before stopping'
+    )
+    upload_album_subparser.add_argument(
+        '--max-rate',
+        default=None,
+        help='upload bytes per second shared by all workers, e.g. 20MB/s'
+    )
+    upload_album_subparser.add_argument(
+        '--rate-window',
+        action='append',
+        default=[],
+        help='upload bytes per second during local time of day, e.g. 09:00-18:00=2MB/s, may be repeated'  # noqa:E501
+    )
+    upload_album_subparser.add_argument(
+        '--batch-bytes',
+        type=int,
+        default=BATCH_BYTES,
+        help='max bytes registered in album at once, larger files are sent alone'  # noqa:E501
+    )
+    upload_album_subparser.add_argument(
+        '--order',
+        choices=ORDERS,
+        default='scan',
+        help='upload files as found, smallest first, or oldest modified first'  # noqa:E501
+    )
+    upload_album_subparser.add_argument(
+        '--hash-workers',
+        type=int,
+        default=None,
+        help='number of processes hashing files, defaults to cpu count'
+    )
+    upload_album_subparser.add_argument(
+        '--max-pixels',
+        type=int,
+        default=None,
+        help='downscale jpg, png, tiff and heic images with more pixels before upload, e.g. 16000000'  # noqa:E501
+    )
+    upload_album_subparser.add_argument(
+        '--jpeg-quality',
+        type=int,
+        default=None,
+        help='recompress jpg images at quality 1 to 95 before upload'
+    )
+    upload_album_subparser.add_argument(
+        '--transform-workers',
+        type=int,
+        default=None,
+        help='number of processes downscaling images, defaults to cpu count'
+    )
+    upload_album_subparser.add_argument(
+        '--transform-cache',
+        default=default_transform_cache_dir,
+        help='dir to keep downscaled and tagged copies in, reused by later runs'  # noqa:E501
+    )
+    upload_album_subparser.add_argument(
+        '--transform-cache-max-bytes',
+        type=int,
+        default=TRANSFORM_CACHE_MAX_BYTES,
+        help='least recently used copies in --transform-cache are deleted after upload once it grows past this'  # noqa:E501
+    )
+    upload_album_subparser.add_argument(
+        '--tags',
+        default=None,
+        help='json file of date, offset, latitude and longitude to set on copies of files before upload, by path relative to from_dir'  # noqa:E501
+    )
+    upload_album_subparser.add_argument(
+        '--exiftool',
+        default=EXIFTOOL,
+        help='exiftool command used to set --tags'
+    )
+    upload_album_subparser.add_argument(
+        '--tag-workers',
+        type=int,
+        default=1,
+        help='number of exiftool processes setting --tags'
+    )
+    upload_album_subparser.add_argument(
+        '--shard-worker',
+        action='store_true',
+        help='share files with other --shard-worker runs on the same dir and app data, each uploading files it leased'  # noqa:E501
+    )
+    upload_album_subparser.add_argument(
+        '--lease-seconds',
+        type=int,
+        default=LEASE_SECONDS,
+        help='leases of stopped --shard-worker runs are claimed by others after this long'  # noqa:E501
+    )
+    upload_album_subparser.add_argument(
+        '-r',
+        action='store_true',
+        help='include files in sub directories'
+    )
+    upload_album_subparser.add_argument(
+        '--retry-failed',
+        action='store_true',
+        help='only upload files that failed before and are due for retry'
+    )
     upload_album_subparser.add_argument(
         '-e',
         action='store_true',
@@ -112,17 +325,143 @@ def main():
     )
     upload_album_subparser.set_defaults(func=upload_album)
 
-    # parse and save args
-    args = parser.parse_args()
-
-    # call func related to command
-    if 'func' not in args:
-        parser.print_help()
-        exit(1)
-
-    db = DB(args.app_data)
+    upload_tree_subparser = subparser.add_parser(
+        'upload-tree',
+        help='upload each leaf dir of local tree to a cloud album of its own, created if missing',  # noqa:E501
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    upload_tree_subparser.add_argument(
+        'from_dir',
+        help='local folder whose leaf dirs are uploaded, albums named by path from it'  # noqa:E501
+    )
+    upload_tree_subparser.add_argument(
+        '--token-file',
+        default=default_token_filename,
+        help='filename for oauth user token'
+    )
+    upload_tree_subparser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='number of files to upload concurrently, shared by all albums'
+    )
+    upload_tree_subparser.add_argument(
+        '--albums',
+        type=int,
+        default=4,
+        help='number of albums to upload concurrently'
+    )
+    upload_tree_subparser.add_argument(
+        '--requests-per-minute',
+        type=int,
+        default=REQUESTS_PER_MINUTE,
+        help='API calls allowed per minute, shared by all workers'
+    )
+    upload_tree_subparser.add_argument(
+        '--daily-batch-create',
+        type=int,
+        default=DAILY_BATCH_CREATE,
+        help='batchCreate calls allowed per day by all runs before stopping'
+    )
+    upload_tree_subparser.add_argument(
+        '--max-rate',
+        default=None,
+        help='upload bytes per second shared by all workers, e.g. 20MB/s'
+    )
+    upload_tree_subparser.add_argument(
+        '--rate-window',
+        action='append',
+        default=[],
+        help='upload bytes per second during local time of day, e.g. 09:00-18:00=2MB/s, may be repeated'  # noqa:E501
+    )
+    upload_tree_subparser.add_argument(
+        '--batch-bytes',
+        type=int,
+        default=BATCH_BYTES,
+        help='max bytes registered in album at once, larger files are sent alone'  # noqa:E501
+    )
+    upload_tree_subparser.add_argument(
+        '--order',
+        choices=ORDERS,
+        default='scan',
+        help='upload files as found, smallest first, or oldest modified first'
+    )
+    upload_tree_subparser.add_argument(
+        '--hash-workers',
+        type=int,
+        default=1,
+        help='number of processes hashing files per album, 1 hashes in album threads instead'  # noqa:E501
+    )
+    upload_tree_subparser.set_defaults(func=upload_tree)
 
-    args.func(args, db)
+    sync_subparser = subparser.add_parser(
+        'sync',
+        help='keep uploading new content from many local dirs to cloud albums',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    sync_subparser.add_argument(
+        'config',
+        help='json file listing dirs and album ids to upload into'
+    )
+    sync_subparser.add_argument(
+        '--token-file',
+        default=default_token_filename,
+        help='filename for oauth user token'
+    )
+    sync_subparser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of files to upload concurrently'
+    )
+    sync_subparser.add_argument(
+        '--requests-per-minute',
+        type=int,
+        default=REQUESTS_PER_MINUTE,
+        help='API calls allowed per minute, shared by all workers'
+    )
+    sync_subparser.add_argument(
+        '--daily-batch-create',
+        type=int,
+        default=DAILY_BATCH_CREATE,
+        help='batchCreate calls allowed per day by all runs before stopping'
+    )
+    sync_subparser.add_argument(
+        '--max-rate',
+        default=None,
+        help='upload bytes per second shared by all workers, e.g. 20MB/s'
+    )
+    sync_subparser.add_argument(
+        '--rate-window',
+        action='append',
+        default=[],
+        help='upload bytes per second during local time of day, e.g. 09:00-18:00=2MB/s, may be repeated'  # noqa:E501
+    )
+    sync_subparser.add_argument(
+        '--hash-workers',
+        type=int,
+        default=None,
+        help='number of processes hashing files, defaults to cpu count'
+    )
+    sync_subparser.add_argument(
+        '--interval',
+        type=float,
+        default=60,
+        help='seconds between full rescans, which also retry failed uploads'
+    )
+    sync_subparser.add_argument(
+        '--settle',
+        type=float,
+        default=2,
+        help='seconds dir must be quiet before uploading new files'
+    )
+    sync_subparser.add_argument(
+        '--poll',
+        action='store_true',
+        help='rescan on interval only, without inotify, e.g. for network mounts'  # noqa:E501
+    )
+    sync_subparser.set_defaults(func=sync)
+    return parser
 
 
 def create_auth(args, db):
@@ -138,41 +477,24 @@ def list_albums(args, db):
     include_remote = args.a
     token_filename = args.token_file
 
-    # query db for local albums
-    local_albums = db.select_albums()
-
     if include_remote:
+        _refresh_album_catalogue(
+            db,
+            token_filename,
+            args.max_age,
+            args.refresh
+        )
 
-        # query for remote albums
-        client = Client(token_filename)
-        remote_albums = {
-            x['id']: x
-            for x in client.list_albums(exclude_non_app=False)
-        }
-        if remote_albums and not local_albums:
+        # locally registered albums enriched with remote data, then the rest
+        rows = db.select_album_catalogue()
+        if not rows:
             print('No albums found locally or remote!')
             exit(0)
-
-        # format data for display
         headers = ['id', 'gid', 'local name', 'remote name']
-        rows = []
-
-        # locally registered albums, enriched with remote data
-        for local in local_albums:
-            remote_name = remote_albums.get(local['gid'], {}).get('title', None)  # noqa:E501
-            rows.append(list(local) + [remote_name])
-            if local['gid'] in remote_albums:
-                del remote_albums[local['gid']]
-
-        # albums not registered locally
-        for _, remote in remote_albums.items():
-            rows.append([
-                None,
-                remote['id'],
-                None,
-                remote['title']
-            ])
     else:
+
+        # query db for local albums
+        local_albums = db.select_albums()
         if not local_albums:
             print('No albums registered locally')
             exit(0)
@@ -181,6 +503,8 @@ def list_albums(args, db):
         headers = local_albums[0].keys()
         rows = local_albums
 
+    from tabulate import tabulate
+
     print(tabulate(
         rows,
         headers=headers,
@@ -193,14 +517,40 @@ def create_album(args, db):
     album_name = args.name
     token_filename = args.token_file
 
-    client = Client(token_filename)
+    client = Client(token_filename, metrics=db.metrics)
     response = client.create_album(album_name).json()
     print(f'Created album "{album_name}" in cloud')
 
     db.insert_album(response['id'], response['title'])
+    db.save_remote_albums([response])
     print('Added album in db!')
 
 
+def _refresh_album_catalogue(db, token_filename, max_age_minutes, force=False):  # noqa:E501
+    """Bring cached remote albums up to date, listing them only when stale.
+
+    Args:
+        db (database.DB): app database
+        token_filename (str): file to read user token
+        max_age_minutes (int): list all albums again if cached longer
+        force (bool): list all albums again regardless of age
+    """
+    client = None
+    if force or not db.remote_albums_fresh(max_age_minutes):
+        client = Client(token_filename, metrics=db.metrics)
+        db.replace_remote_albums(client.list_albums(exclude_non_app=False))
+        return
+
+    # albums registered since last listing, looked up one by one
+    for album in db.select_albums_not_catalogued():
+        client = client or Client(token_filename, metrics=db.metrics)
+        try:
+            db.save_remote_albums([client.get_album(album['gid'])])
+        except HTTPError as e:
+            if e.status_code != 404:
+                raise
+
+
 def upload_album(args, db):
     """Upload all files in a directory into a remote album."""
     album_id = args.to_album
@@ -208,6 +558,48 @@ def upload_album(args, db):
     token_filename = args.token_file
     exit_on_error = args.e
     exit_on_invalid_file = args.s
+    workers = args.workers
+    hash_workers = args.hash_workers
+    recursive = args.r
+    engine = args.engine
+    retry_failed = args.retry_failed
+    batch_bytes = args.batch_bytes
+    order = args.order
+    transform_workers = args.transform_workers
+    shard_worker = args.shard_worker
+    lease_seconds = args.lease_seconds
+    metrics = db.metrics
+    rate_limiter = RateLimiter(
+        requests_per_minute=args.requests_per_minute,
+        daily_batch_create=args.daily_batch_create,
+        quota_store=db
+    )
+    bandwidth_limiter = _bandwidth_limiter(args)
+    if args.transform_cache_max_bytes < 0:
+        print('Invalid transform_cache_max_bytes')
+        exit(1)
+    transform_cache = None
+    if args.max_pixels or args.jpeg_quality:
+        try:
+            transform_cache = TransformCache(
+                args.transform_cache,
+                max_pixels=args.max_pixels,
+                jpeg_quality=args.jpeg_quality
+            )
+        except ValueError as e:
+            print(e)
+            exit(1)
+    tagger = None
+    if args.tags:
+        if not shutil.which(args.exiftool):
+            print(f'exiftool not found at "{args.exiftool}"')
+            exit(1)
+        tagger = Tagger(
+            args.transform_cache,
+            _load_tags(args.tags, local_dir),
+            executable=args.exiftool,
+            workers=args.tag_workers
+        )
 
     # validate input album and get gid
     album = db.select_album(album_id)
@@ -216,74 +608,869 @@ def upload_album(args, db):
         exit(1)
     album_gid = album['gid']
 
-    # validate directory exists
-    try:
-        filenames = os.listdir(local_dir)
-    except FileNotFoundError:
+    # find new or changed files, skipping directories unchanged since upload
+    if not os.path.isdir(local_dir):
         print(f'Local dir not found at "{local_dir}"')
         exit(1)
+    if retry_failed:
+        filenames = metrics.iterate(
+            'scan',
+            _failed_files(db, album_id, local_dir, recursive)
+        )
+    else:
+        scanner = DirScanner(db, album_id, recursive=recursive)
+        filenames = metrics.iterate('scan', scanner.scan(local_dir))
+        if exit_on_invalid_file:
+            filenames = list(filenames)
+            if scanner.invalid:
+                print('Invalid files found in upload dir')
+                exit(1)
 
-    # list files and filter based on extension
-    num_total_files = len(filenames)
-    filenames = [
-        x
-        for x in filenames
-        if valid_photo_ext(x) or valid_video_ext(x)
-    ]
-    if exit_on_invalid_file and num_total_files != len(filenames):
-        print('Invalid files found in upload dir')
+    # claim files through leases shared with other workers, released at exit
+    leases = None
+    if shard_worker:
+        try:
+            leases = ShardLeases(db, album_id, lease_seconds=lease_seconds)
+        except ValueError as e:
+            print(e)
+            exit(1)
+        leases.start()
+        filenames = metrics.iterate('claim', leases.claim(filenames))
+    # one session for adding media to album and uploading, made once needed
+    client = None
+
+    def connect():
+        nonlocal client
+        if client is None:
+            client = Client(
+                token_filename,
+                workers=workers,
+                upload_store=db,
+                rate_limiter=rate_limiter,
+                bandwidth_limiter=bandwidth_limiter,
+                metrics=metrics
+            )
+        return client
+
+    try:
+        uploaded_any = False
+        attached = []
+        rejects = []
+        while True:
+            # stream files through dedupe stages, uploads start before scan
+            # ends, and once more for files reclaimed from other workers
+            content_hashes = {}
+            filenames = _pending_files(
+                db,
+                album_id,
+                filenames,
+                content_hashes,
+                hash_workers,
+                rejects
+            )
+
+            # content uploaded into other albums is added without its bytes
+            filenames = metrics.iterate('attach', _attached_files(
+                db,
+                album_id,
+                album_gid,
+                filenames,
+                content_hashes,
+                connect,
+                attached,
+                leases
+            ))
+
+            # shrink images first if asked, uploading cached copies instead
+            sources = {}
+            if transform_cache:
+                filenames = _transformed_files(
+                    db,
+                    filenames,
+                    content_hashes,
+                    sources,
+                    transform_cache,
+                    transform_workers
+                )
+            if tagger:
+                filenames = _tagged_files(
+                    db,
+                    filenames,
+                    content_hashes,
+                    sources,
+                    tagger
+                )
+            first_filename = next(filenames, None)
+            if first_filename is not None:
+                uploaded_any = True
+
+                # upload files to album, saving results one batch at a time
+                filenames = itertools.chain([first_filename], filenames)
+                if engine == 'async':
+                    import asyncio
+
+                    with metrics.phase('upload'):
+                        asyncio.run(_upload_async(
+                            db,
+                            album_id,
+                            album_gid,
+                            filenames,
+                            content_hashes,
+                            token_filename,
+                            workers,
+                            rate_limiter,
+                            bandwidth_limiter,
+                            exit_on_error,
+                            batch_bytes,
+                            order,
+                            sources,
+                            leases
+                        ))
+                else:
+                    uploads = connect().post_batch_media(
+                        filenames,
+                        album_gid,
+                        batch_bytes=batch_bytes,
+                        order=order,
+                        sources=sources
+                    )
+                    for upload_results in metrics.iterate('upload', uploads):
+                        with metrics.phase('record'):
+                            _record_batch(
+                                db,
+                                album_id,
+                                upload_results,
+                                content_hashes,
+                                exit_on_error,
+                                sources,
+                                leases
+                            )
+
+            # files leased to others are done by them, or claimed once expired
+            if not leases or not leases.waiting:
+                break
+            filenames = metrics.iterate('claim', leases.reclaim())
+        db.complete_scan_dirs(album_id)
+        _print_rejects(local_dir, rejects)
+
+        # copies for other albums and runs kept within cap, newest first
+        if transform_cache or tagger:
+            deleted_files, deleted_bytes = prune_cache(
+                args.transform_cache,
+                args.transform_cache_max_bytes
+            )
+            if deleted_files:
+                print(f'Pruned {deleted_files} cached copies ({deleted_bytes / 1024 ** 2:.1f} MiB)')  # noqa:E501
+        if not uploaded_any and not attached:
+            print('No pending files found to upload!')
+            exit(0)
+    except QuotaExceeded as e:
+        print(e)
         exit(1)
-    if not filenames:
-        print('No valid files found to upload!')
+    finally:
+        if leases:
+            leases.stop()
+            if leases.skipped:
+                print(f'Skipped {leases.skipped} files uploaded by other workers')  # noqa:E501
+
+    # report api pacing, if it slowed the run
+    counters = rate_limiter.counters
+    if counters['retries'] or counters['throttle_waits']:
+        print(
+            f"Retries: {counters['retries']}, "
+            f"throttle waits: {counters['throttle_waits']} "
+            f"({counters['throttle_wait_seconds']:.1f}s)"
+        )
+    counters = bandwidth_limiter.counters
+    if counters['waits']:
+        print(
+            f"Bandwidth waits: {counters['waits']} "
+            f"({counters['wait_seconds']:.1f}s)"
+        )
+
+
+def upload_tree(args, db):
+    """Upload each leaf directory of a tree into an album named by its path."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    root = os.path.abspath(args.from_dir)
+    if not os.path.isdir(root):
+        print(f'Local dir not found at "{root}"')
+        exit(1)
+    if args.albums < 1:
+        print('Invalid albums')
+        exit(1)
+    rate_limiter = RateLimiter(
+        requests_per_minute=args.requests_per_minute,
+        daily_batch_create=args.daily_batch_create,
+        quota_store=db
+    )
+    bandwidth_limiter = _bandwidth_limiter(args)
+
+    # dirs with both media and sub dirs have no album of their own
+    leaf_dirs = []
+    for local_dir, is_leaf in media_dirs(root):
+        if is_leaf:
+            leaf_dirs.append(local_dir)
+        else:
+            print(f'Skipped "{local_dir}", only leaf dirs are uploaded')
+    if not leaf_dirs:
+        print('No media dirs found to upload!')
         exit(0)
 
-    # get files in dir already uploaded
-    uploaded = db.select_uploads(
-        local_dir,
-        album_id
+    # albums matched by name, oldest first if registered twice
+    albums = {}
+    for album in db.select_albums():
+        albums.setdefault(album['name'], album)
+
+    # one session and upload budget shared by every album, its pool sized
+    # for the worker threads of every album, so no connection is dropped
+    client = Client(
+        args.token_file,
+        workers=args.workers,
+        upload_store=db,
+        rate_limiter=rate_limiter,
+        bandwidth_limiter=bandwidth_limiter,
+        metrics=db.metrics,
+        pool_size=args.albums * args.workers
+    )
+
+    def upload_leaf(local_dir):
+        title = _tree_album_title(root, local_dir)
+        album = albums.get(title)
+        if album is None:
+            try:
+                response = client.create_album(title).json()
+            except Exception as e:
+                print(f'Album "{title}" not created: {e}')
+                return
+            album = {
+                'id': db.insert_album(response['id'], response['title']),
+                'gid': response['id']
+            }
+            db.save_remote_albums([response])
+            print(f'Created album "{title}" in cloud')
+        _upload_mapping(
+            db,
+            client,
+            {
+                'local_dir': local_dir,
+                'album_id': album['id'],
+                'album_gid': album['gid'],
+                'recursive': False
+            },
+            args.hash_workers,
+            batch_bytes=args.batch_bytes,
+            order=args.order
+        )
+
+    # albums run side by side, files of all of them queue for the workers,
+    # on Ctrl+C albums not started are dropped and running ones finish
+    executor = ThreadPoolExecutor(max_workers=args.albums)
+    try:
+        for _ in executor.map(upload_leaf, leaf_dirs):
+            pass
+    except KeyboardInterrupt:
+        print('Stopped upload, finishing albums in progress')
+        executor.shutdown(wait=True, cancel_futures=True)
+        exit(1)
+    except QuotaExceeded as e:
+        executor.shutdown(wait=True, cancel_futures=True)
+        print(e)
+        exit(1)
+    executor.shutdown(wait=True)
+
+    # report api pacing, if it slowed the run
+    counters = rate_limiter.counters
+    if counters['retries'] or counters['throttle_waits']:
+        print(
+            f"Retries: {counters['retries']}, "
+            f"throttle waits: {counters['throttle_waits']} "
+            f"({counters['throttle_wait_seconds']:.1f}s)"
+        )
+
+
+def _tree_album_title(root, local_dir):
+    """Album name of dir in tree, its path from root or name of root itself."""  # noqa:E501
+    if local_dir == root:
+        return os.path.basename(root)
+    return os.path.relpath(local_dir, root).replace(os.sep, '/')
+
+
+def sync(args, db):
+    """Upload new files from many directories as they appear, until stopped."""
+    from media.watch import PollingWatcher
+    from media.watch import create_watcher
+
+    token_filename = args.token_file
+    hash_workers = args.hash_workers
+    interval = args.interval
+    rate_limiter = RateLimiter(
+        requests_per_minute=args.requests_per_minute,
+        daily_batch_create=args.daily_batch_create,
+        quota_store=db
+    )
+    bandwidth_limiter = _bandwidth_limiter(args)
+    mappings = _load_sync_config(args.config, db)
+
+    # watch dirs for changes, polling if inotify is missing or out of watches
+    watcher = create_watcher(settle=args.settle, polling=args.poll)
+    try:
+        for mapping in mappings:
+            watcher.add(mapping['local_dir'], mapping['recursive'])
+    except OSError as e:
+        print(f'Unable to watch dirs ({e}), polling instead')
+        watcher.close()
+        watcher = PollingWatcher()
+        for mapping in mappings:
+            watcher.add(mapping['local_dir'], mapping['recursive'])
+
+    # one session and rate limit shared by every dir
+    client = Client(
+        token_filename,
+        workers=args.workers,
+        upload_store=db,
+        rate_limiter=rate_limiter,
+        bandwidth_limiter=bandwidth_limiter,
+        metrics=db.metrics
+    )
+
+    # stop cleanly on service manager shutdown too
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    # catch up on startup, then only dirs reported changed or due rescan
+    changed = set(x['local_dir'] for x in mappings)
+    next_rescan = time.monotonic() + interval
+    try:
+        while True:
+            for mapping in mappings:
+                if mapping['local_dir'] in changed:
+                    _upload_mapping(db, client, mapping, hash_workers)
+            if changed:
+                _write_metrics(args, db.metrics)
+            changed = watcher.changes(max(0, next_rescan - time.monotonic()))
+            if time.monotonic() >= next_rescan:
+                changed = set(x['local_dir'] for x in mappings)
+                next_rescan = time.monotonic() + interval
+    except KeyboardInterrupt:
+        print('Stopped sync')
+    except QuotaExceeded as e:
+        print(e)
+        exit(1)
+    finally:
+        watcher.close()
+
+
+def _bandwidth_limiter(args):
+    """Upload byte rate caps from command line, exiting if invalid."""
+    try:
+        return BandwidthLimiter(
+            max_rate=parse_rate(args.max_rate) if args.max_rate else None,
+            windows=[parse_rate_window(x) for x in args.rate_window]
+        )
+    except ValueError as e:
+        print(e)
+        exit(1)
+
+
+def _write_metrics(args, metrics):
+    """Export timings and counters to files requested on command line."""
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
+
+
+def _load_sync_config(filename, db):
+    """Read and validate dir to album mappings.
+
+    Args:
+        filename (str): json file of list of objects
+            - dir (str): local folder to upload
+            - album (int): id of album in db to upload into
+            - recursive (bool): include files in sub directories
+        db (database.DB): app database
+
+    Returns:
+        list[dict]: mappings with full path dirs and album gids
+    """
+    with open(filename, 'r') as f:
+        config = json.load(f)
+    mappings = []
+    for x in config:
+        album = db.select_album(x['album'])
+        if not album:
+            print(f'Album not found for id "{x["album"]}"')
+            exit(1)
+        local_dir = os.path.abspath(x['dir'])
+        if not os.path.isdir(local_dir):
+            print(f'Local dir not found at "{local_dir}"')
+            exit(1)
+        mappings.append({
+            'local_dir': local_dir,
+            'album_id': album['id'],
+            'album_gid': album['gid'],
+            'recursive': bool(x.get('recursive', False))
+        })
+    return mappings
+
+
+def _load_tags(filename, local_dir):
+    """Read and validate tags to set on files before upload.
+
+    Args:
+        filename (str): json file of object of tags, see media.exiftool.tag_args, by path relative to local_dir
+        local_dir (str): full path of directory uploaded from
+
+    Returns:
+        dict: tags by full path filename
+    """  # noqa:E501
+    with open(filename, 'r') as f:
+        config = json.load(f)
+    tags = {}
+    for path, values in config.items():
+        try:
+            validate_tags(values)
+        except ValueError as e:
+            print(f'{e} for "{path}"')
+            exit(1)
+        tags[os.path.join(local_dir, path)] = values
+    return tags
+
+
+def _upload_mapping(db, client, mapping, hash_workers, batch_bytes=BATCH_BYTES, order='scan'):  # noqa:E501
+    """Upload new files in one mapped dir, reporting rather than exiting on errors.
+
+    Raises:
+        QuotaExceeded: daily budget used up, no other dir can upload either
+    """  # noqa:E501
+    album_id = mapping['album_id']
+    scanner = DirScanner(db, album_id, recursive=mapping['recursive'])
+    content_hashes = {}
+    rejects = []
+    metrics = db.metrics
+    filenames = _pending_files(
+        db,
+        album_id,
+        metrics.iterate('scan', scanner.scan(mapping['local_dir'])),
+        content_hashes,
+        hash_workers,
+        rejects
     )
-    uploaded_files = [
-        x['filename']
-        for x in uploaded
+    try:
+        filenames = metrics.iterate('attach', _attached_files(
+            db,
+            album_id,
+            mapping['album_gid'],
+            filenames,
+            content_hashes,
+            lambda: client,
+            []
+        ))
+        uploads = client.post_batch_media(
+            filenames,
+            mapping['album_gid'],
+            batch_bytes=batch_bytes,
+            order=order
+        )
+        for upload_results in metrics.iterate('upload', uploads):
+            with metrics.phase('record'):
+                _record_batch(db, album_id, upload_results, content_hashes, False)  # noqa:E501
+    except QuotaExceeded:
+        raise
+    except Exception as e:
+        print(f'Upload of "{mapping["local_dir"]}" failed: {e}')
+    db.complete_scan_dirs(album_id)
+    _print_rejects(mapping['local_dir'], rejects)
+
+
+async def _upload_async(db, album_id, album_gid, filenames, content_hashes, token_filename, workers, rate_limiter, bandwidth_limiter, exit_on_error, batch_bytes, order, sources, leases):  # noqa:E501
+    """Run uploads on asyncio engine, saving results one batch at a time."""
+    from gphoto.aio import AsyncClient
+
+    async with AsyncClient(
+        token_filename,
+        workers=workers,
+        upload_store=db,
+        rate_limiter=rate_limiter,
+        bandwidth_limiter=bandwidth_limiter,
+        metrics=db.metrics
+    ) as client:
+        async for upload_results in client.post_batch_media(filenames, album_gid, batch_bytes=batch_bytes, order=order, sources=sources):  # noqa:E501
+            with db.metrics.phase('record'):
+                _record_batch(
+                    db,
+                    album_id,
+                    upload_results,
+                    content_hashes,
+                    exit_on_error,
+                    sources,
+                    leases
+                )
+
+
+def _record_batch(db, album_id, upload_results, content_hashes, exit_on_error, sources=None, leases=None):  # noqa:E501
+    """Save and report results of one batch from API.
+
+    Args:
+        db (database.DB): app database
+        album_id (int): db id of album uploading into
+        upload_results (dict): results yielded from post_batch_media
+        content_hashes (dict): hashes of files pending upload, by filename
+        exit_on_error (bool): exit non-zero if any uploads failed
+        sources (dict): transformed copies of files pending upload, by filename
+        leases (media.shard.ShardLeases): leases to release once recorded
+    """
+    if sources:
+        for _, x in upload_results.items():
+            sources.pop(x['filename'], None)
+    batch = [
+        {
+            'album_id': album_id,
+            'local_dir': os.path.dirname(x['filename']),
+            'filename': os.path.basename(x['filename']),
+            'media_id': x.get('media_id'),
+            'content_hash': content_hashes.pop(x['filename'])
+        }
+        for _, x in upload_results.items()
     ]
-    filenames = [
-        x
-        for x in filenames
-        if x not in uploaded_files
+    db.insert_uploads(batch)
+    uploaded = [
+        os.path.join(x['local_dir'], x['filename'])
+        for x in batch
+        if x['media_id'] is not None
     ]
-    if not filenames:
-        print('No pending files found to upload!')
-        exit(0)
-
-    # upload files to album, saving results one batch at a time
-    client = Client(token_filename)
-    for upload_results in client.post_batch_media(
+    db.update_scan_status(album_id, uploaded, 'uploaded')
+    db.metrics.inc('files', len(uploaded), result='uploaded')
+    db.metrics.inc('files', len(batch) - len(uploaded), result='failed')
+    db.update_scan_status(
+        album_id,
         [
-            os.path.join(local_dir, x)
-            for x in filenames
+            os.path.join(x['local_dir'], x['filename'])
+            for x in batch
+            if x['media_id'] is None
         ],
-        album_gid
-    ):
+        'failed'
+    )
+    if leases:
+        leases.release([
+            os.path.join(x['local_dir'], x['filename'])
+            for x in batch
+        ])
 
-        # process batch results from API
-        batch = [
-            {
-                'album_id': album_id,
-                'local_dir': local_dir,
-                'filename': os.path.split(x['filename'])[-1],
-                'media_id': x.get('media_id')
+    # progress report
+    for x in batch:
+        print(f"{x['filename']} => {x['media_id']}")
+
+    # stop if upload errors occured
+    if exit_on_error and any([y['media_id'] is None for y in batch]):
+        db.complete_scan_dirs(album_id)
+        exit(1)
+
+
+def _pending_files(db, album_id, filenames, content_hashes, hash_workers=None, rejects=None):  # noqa:E501
+    """Drop files uploaded by name or content or failing checks, hashing the rest.
+
+    Args:
+        db (database.DB): app database
+        album_id (int): db id of album uploading into
+        filenames (iterable[str]): full path filenames, grouped by dir
+        content_hashes (dict): filled with hashes of files yielded, by filename
+        hash_workers (int): processes to hash with, defaults to cpu count
+        rejects (list): filled with filenames failing checks and why
+
+    Yields:
+        str: full path filenames to upload
+    """  # noqa:E501
+    metrics = db.metrics
+    filenames = metrics.iterate('dedupe', _skip_uploaded(db, album_id, filenames))  # noqa:E501
+    filenames = metrics.iterate('preflight', _preflight_files(
+        db,
+        album_id,
+        filenames,
+        [] if rejects is None else rejects
+    ))
+    yield from metrics.iterate('dedupe', _skip_duplicates(
+        db,
+        album_id,
+        metrics.iterate('hash', hash_files(filenames, workers=hash_workers)),
+        content_hashes
+    ))
+
+
+def _attached_files(db, album_id, album_gid, filenames, content_hashes, connect, attached, leases=None, chunk_size=50):  # noqa:E501
+    """Add content uploaded into other albums to this one, sending no bytes.
+
+    Media items are added in chunks, and chunks the API rejects are halved
+    to find items it no longer accepts, e.g. deleted from library, which
+    are uploaded again instead.
+
+    Args:
+        db (database.DB): app database
+        album_id (int): db id of album uploading into
+        album_gid (str): Google Photos album id
+        filenames (iterable[str]): full path filenames with hashes in content_hashes
+        content_hashes (dict): hashes of files pending upload, by filename
+        connect (callable): returns gphoto.Client, called once media is found
+        attached (list): filled with full path filenames added to album
+        leases (media.shard.ShardLeases): leases to release once recorded
+        chunk_size (int): media items to add at once, up to 50
+
+    Yields:
+        str: full path filenames to upload
+    """  # noqa:E501
+    metrics = db.metrics
+
+    def attach(chunk):
+        try:
+            connect().add_album_media(
+                album_gid,
+                [x['media_id'] for x in chunk]
+            )
+        except HTTPError as e:
+            if e.status_code != 400 or len(chunk) == 1:
+                return chunk
+            return attach(chunk[:len(chunk) // 2]) + attach(chunk[len(chunk) // 2:])  # noqa:E501
+
+        # recorded like uploads, so later runs and duplicates skip them
+        db.insert_uploads(chunk)
+        paths = [os.path.join(x['local_dir'], x['filename']) for x in chunk]
+        db.update_scan_status(album_id, paths, 'uploaded')
+        if leases:
+            leases.release(paths)
+        for x, path in zip(chunk, paths):
+            content_hashes.pop(path, None)
+            print(f"{x['filename']} => {x['media_id']} (added from other album)")  # noqa:E501
+        metrics.inc('files', len(chunk), result='attached')
+        attached.extend(paths)
+        return []
+
+    pending = []
+    for filename in filenames:
+        existing = db.select_upload_by_hash_other_album(
+            album_id,
+            content_hashes[filename]
+        )
+        if not existing:
+            yield filename
+            continue
+        pending.append({
+            'album_id': album_id,
+            'local_dir': os.path.dirname(filename),
+            'filename': os.path.basename(filename),
+            'media_id': existing['media_id'],
+            'content_hash': content_hashes[filename]
+        })
+        if len(pending) >= chunk_size:
+            for x in attach(pending):
+                yield os.path.join(x['local_dir'], x['filename'])
+            pending = []
+    for x in attach(pending) if pending else []:
+        yield os.path.join(x['local_dir'], x['filename'])
+
+
+def _transformed_files(db, filenames, content_hashes, sources, transform_cache, workers=None):  # noqa:E501
+    """Shrink images in parallel processes, noting copies to upload instead.
+
+    Files whose copy fails to write are reported and left pending for the
+    next run.
+
+    Args:
+        db (database.DB): app database
+        filenames (iterable[str]): full path filenames with hashes in content_hashes
+        content_hashes (dict): hashes of files pending upload, by filename
+        sources (dict): filled with transformed copies of files yielded, by filename
+        transform_cache (media.transform.TransformCache): settings and copies from earlier runs
+        workers (int): processes to transform with, defaults to cpu count
+
+    Yields:
+        str: full path filenames to upload
+    """  # noqa:E501
+    metrics = db.metrics
+    transformed_filenames = transform_cache.transform(
+        filenames,
+        content_hashes,
+        workers=workers
+    )
+    for filename, transformed, error in metrics.iterate('transform', transformed_filenames):  # noqa:E501
+        if error:
+            print(f'{os.path.basename(filename)} => not transformed, {error}')
+            metrics.inc('transforms', result='failed')
+            content_hashes.pop(filename, None)
+            continue
+        if transformed:
+            sources[filename] = transformed
+            metrics.inc(
+                'transform_saved_bytes',
+                os.path.getsize(filename) - os.path.getsize(transformed)
+            )
+        metrics.inc('transforms', result='transformed' if transformed else 'original')  # noqa:E501
+        yield filename
+
+
+def _tagged_files(db, filenames, content_hashes, sources, tagger):
+    """Tag copies of files with exiftool, noting copies to upload instead.
+
+    Files failing to tag are reported and left pending for the next run.
+
+    Args:
+        db (database.DB): app database
+        filenames (iterable[str]): full path filenames with hashes in content_hashes
+        content_hashes (dict): hashes of files pending upload, by filename
+        sources (dict): copies of files to tag instead, filled with tagged copies, by filename
+        tagger (media.exiftool.Tagger): tags to set and exiftool processes
+
+    Yields:
+        str: full path filenames to upload
+    """  # noqa:E501
+    metrics = db.metrics
+    tagged_filenames = tagger.tag(filenames, content_hashes, sources)
+    for filename, tagged, error in metrics.iterate('tag', tagged_filenames):
+        if error:
+            print(f'{os.path.basename(filename)} => not tagged, {error}')
+            metrics.inc('tags', result='failed')
+            content_hashes.pop(filename, None)
+            sources.pop(filename, None)
+            continue
+        if filename in tagger.tags:
+            sources[filename] = tagged
+            metrics.inc('tags', result='tagged')
+        yield filename
+
+
+def _failed_files(db, album_id, local_dir, recursive):
+    """List failed uploads due for retry, without scanning dirs.
+
+    Args:
+        db (database.DB): app database
+        album_id (int): db id of album uploading into
+        local_dir (str): full path of directory uploaded from
+        recursive (bool): include failures in sub directories
+
+    Yields:
+        str: full path filenames still on disk
+    """
+    for x in db.select_failed_uploads(album_id):
+        if x['local_dir'] != local_dir and not (
+            recursive and x['local_dir'].startswith(local_dir + os.sep)
+        ):
+            continue
+        filename = os.path.join(x['local_dir'], x['filename'])
+        if os.path.isfile(filename):
+            yield filename
+
+
+def _skip_uploaded(db, album_id, filenames):
+    """Drop files already uploaded under the same name, or waiting to retry.
+
+    Files waiting to retry stay failed, so their dir is scanned again.
+
+    Args:
+        db (database.DB): app database
+        album_id (int): db id of album uploading into
+        filenames (iterable[str]): full path filenames, grouped by dir
+
+    Yields:
+        str: full path filenames not uploaded yet
+    """
+    upload_dir = None
+    uploaded_files = {}
+    for filename in filenames:
+
+        # only the current dir's uploads are held in memory
+        if os.path.dirname(filename) != upload_dir:
+            upload_dir = os.path.dirname(filename)
+            uploaded_files = {
+                x['filename']: x['uploaded']
+                for x in db.select_uploads(upload_dir, album_id)
             }
-            for _, x in upload_results.items()
-        ]
-        db.insert_uploads(batch)
+        uploaded = uploaded_files.get(os.path.basename(filename))
+        if uploaded:
+            db.update_scan_status(album_id, [filename], 'uploaded')
+            db.metrics.inc('files', result='skipped')
+            continue
+        if uploaded is not None:
+            db.update_scan_status(album_id, [filename], 'failed')
+            continue
+        yield filename
 
-        # progress report
-        for x in batch:
-            print(f"{x['filename']} => {x['media_id']}")
 
-        # stop if upload errors occured
-        if exit_on_error and any([y['media_id'] is None for y in batch]):
-            exit(1)
+def _preflight_files(db, album_id, filenames, rejects):
+    """Drop files the API would refuse, before reading or sending them whole.
+
+    Args:
+        db (database.DB): app database
+        album_id (int): db id of album uploading into
+        filenames (iterable[str]): full path filenames, grouped by dir
+        rejects (list): filled with filenames failing checks and why
+
+    Yields:
+        str: full path filenames passing checks
+    """
+    for filename, error in Preflight(db).check(filenames):
+        if error is None:
+            yield filename
+            continue
+        db.update_scan_status(album_id, [filename], 'rejected')
+        db.metrics.inc('files', result='rejected')
+        rejects.append((filename, error))
+
+
+def _print_rejects(local_dir, rejects):
+    """Summarize files left out of upload by checks, once uploads end."""
+    if not rejects:
+        return
+    print(f'Rejected {len(rejects)} files before upload:')
+    for filename, error in rejects:
+        print(f'  {os.path.relpath(filename, local_dir)}: {error}')
+
+
+def _skip_duplicates(db, album_id, hashed_filenames, content_hashes, flush_size=50):  # noqa:E501
+    """Drop files with content already in album, e.g. renamed or moved.
+
+    Args:
+        db (database.DB): app database
+        album_id (int): db id of album uploading into
+        hashed_filenames (iterable[tuple(str, str)]): full path filenames and content hashes
+        content_hashes (dict): filled with hashes of files yielded, by filename
+        flush_size (int): duplicates to record in db at once
+
+    Yields:
+        str: full path filenames with new content
+    """  # noqa:E501
+    duplicates = []
+
+    def flush():
+        db.insert_uploads(duplicates)
+        db.update_scan_status(
+            album_id,
+            [
+                os.path.join(x['local_dir'], x['filename'])
+                for x in duplicates
+            ],
+            'uploaded'
+        )
+        for x in duplicates:
+            print(f"{x['filename']} => {x['media_id']} (already in album)")
+        db.metrics.inc('files', len(duplicates), result='duplicate')
+        duplicates.clear()
+
+    for filename, content_hash in hashed_filenames:
+        existing = db.select_upload_by_hash(album_id, content_hash)
+        if not existing:
+            content_hashes[filename] = content_hash
+            yield filename
+            continue
+        duplicates.append({
+            'album_id': album_id,
+            'local_dir': os.path.dirname(filename),
+            'filename': os.path.basename(filename),
+            'media_id': existing['media_id'],
+            'content_hash': content_hash
+        })
+        if len(duplicates) >= flush_size:
+            flush()
+    flush()
 
 
 if __name__ == '__main__':
@@ -2,38 +2,68 @@
 
 import os
 import sqlite3
+import threading
+import uuid
+
+from metrics import Metrics
+
+# failed uploads wait before retrying, doubling each attempt up to a day
+RETRY_MINUTES = 15
+MAX_RETRY_MINUTES = 24 * 60
+
+# rollback journal for files shared by hosts over network mounts, where wal
+# is unsupported, synchronous writes keep it safe on power loss
+JOURNAL_MODES = {
+    'wal': 'NORMAL',
+    'delete': 'FULL'
+}
+
+# other processes may hold the write lock, e.g. shard workers
+BUSY_TIMEOUT_SECONDS = 60
+
+SQL_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'queries')
 
 
 class DB(object):
     """Instance of DB interface."""
 
     connection = None
+    lock = None
     queries = {}
+    metrics = None
 
-    def __init__(self, filename):
+    def __init__(self, filename, metrics=None, journal_mode='wal'):
         """Initialize db interface.
 
         Args:
             filename (str): sqlite database file
+            metrics (metrics.Metrics): run metrics to time queries into
+            journal_mode (str): wal, or delete for file on network mount
 
         """
-        self.connection = sqlite3.connect(filename)
-        self.connection.row_factory = sqlite3.Row
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError('Invalid journal_mode')
+        self.metrics = metrics or Metrics()
 
-        # load query templates in dir, map filename to contents
-        sql_dir = os.path.join(
-            os.path.dirname(os.path.realpath(__file__)),
-            'queries'
+        # shared with upload worker threads, access serialized by lock
+        self.connection = sqlite3.connect(
+            filename,
+            timeout=BUSY_TIMEOUT_SECONDS,
+            check_same_thread=False
         )
-        self.queries = {
-            x.replace('.sql', ''): open(os.path.join(sql_dir, x), 'r').read()
-            for x in os.listdir(sql_dir)
-            if x.endswith('.sql')
-        }
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+
+        # query templates are read from disk on first use
+        self.queries = {}
 
-        # run setup script
-        self._script(self.queries['setup'])
-        del self.queries['setup']
+        # per connection settings, then bring schema up to date
+        self._script(
+            f'PRAGMA journal_mode = {journal_mode};\n'
+            f'PRAGMA synchronous = {JOURNAL_MODES[journal_mode]};\n'
+            + self._query('connect')
+        )
+        self._migrate(os.path.join(SQL_DIR, 'migrations'))
 
     def insert_album(self, gid, name):
         """Record album in db.
@@ -80,6 +110,84 @@ class DB(object):
             single=True
         )
 
+    def select_album_catalogue(self):
+        """Join local albums with cached remote ones, unregistered included.
+
+        Returns:
+            list[sqlite3.Row]: id, gid, local_name and remote_name of albums
+        """
+        return self._select(
+            'select_album_catalogue'
+        )
+
+    def select_albums_not_catalogued(self):
+        """Find local albums missing from cached remote albums.
+
+        Returns:
+            list[sqlite3.Row]: rows from albums table
+        """
+        return self._select(
+            'select_albums_not_catalogued'
+        )
+
+    def save_remote_albums(self, albums):
+        """Add or update albums in cached remote catalogue.
+
+        Args:
+            albums (list[Album]): https://developers.google.com/photos/library/reference/rest/v1/albums#Album
+        """  # noqa:E501
+        if albums:
+            self._modify(
+                'upsert_bulk_remote_albums',
+                [
+                    {
+                        'gid': x['id'],
+                        'title': x.get('title'),
+                        'media_items_count': int(x.get('mediaItemsCount', 0)),
+                        'is_writeable': int(x.get('isWriteable', False))
+                    }
+                    for x in albums
+                ]
+            )
+
+    def replace_remote_albums(self, albums):
+        """Refresh cached remote catalogue from full listing of albums.
+
+        Args:
+            albums (list[Album]): every album user has access to
+        """
+        self._modify(
+            'upsert_catalogue_refresh',
+            {
+                'name': 'albums'
+            }
+        )
+        self.save_remote_albums(albums)
+        self._modify(
+            'delete_stale_remote_albums',
+            {
+                'name': 'albums'
+            }
+        )
+
+    def remote_albums_fresh(self, max_age_minutes):
+        """If cached remote catalogue was fully refreshed recently.
+
+        Args:
+            max_age_minutes (int): refreshes older than this are stale
+
+        Returns:
+            bool: catalogue can be used without listing albums again
+        """
+        return self._select(
+            'select_catalogue_refresh',
+            {
+                'name': 'albums',
+                'max_age': f'-{max_age_minutes} minutes'
+            },
+            single=True
+        ) is not None
+
     def insert_uploads(self, uploads):
         """Record uploads sent to API.
 
@@ -89,6 +197,7 @@ class DB(object):
                 - local_dir (str): directory file is in
                 - filename (str): filename minus directory
                 - media_id (str): remote id of item
+                - content_hash (str): hex sha256 of file contents
         """
         self._modify(
             'insert_bulk_uploads',
@@ -97,22 +206,25 @@ class DB(object):
                     'album_id': x['album_id'],
                     'local_dir': x['local_dir'],
                     'filename': x['filename'],
-                    'media_id': x['media_id']
+                    'media_id': x['media_id'],
+                    'content_hash': x.get('content_hash'),
+                    'retry_minutes': RETRY_MINUTES,
+                    'max_retry_minutes': MAX_RETRY_MINUTES
                 }
                 for x in uploads
             ]
         )
 
     def select_uploads(self, local_dir, album_id):
-        """Get uploads already sent.
+        """Get uploads already sent, or failed and not yet due for retry.
 
         Args:
             local_dir (str): folder on disk sent from
             aldum_id (int): db id of album sent into
 
         Returns:
-            list[sqlite3.Row]: rows from uploads table
-        """
+            list[sqlite3.Row]: rows from uploads table, with uploaded false while waiting to retry
+        """  # noqa:E501
         return self._select(
             'select_uploads_by_pair',
             {
@@ -121,32 +233,562 @@ class DB(object):
             }
         )
 
-    def _script(self, queries):
-        cursor = self.connection.cursor()
-        cursor.executescript(queries)
+    def select_failed_uploads(self, album_id):
+        """Get failed uploads due for another attempt.
 
-    def _select(self, query, placeholders={}, single=False):
-        cursor = self.connection.cursor()
-        cursor.execute(
-            self.queries[query],
-            placeholders
+        Args:
+            album_id (int): db id of album sent into
+
+        Returns:
+            list[sqlite3.Row]: rows from uploads table
+        """
+        return self._select(
+            'select_failed_uploads',
+            {
+                'album_id': album_id
+            }
         )
-        if single:
-            return cursor.fetchone()
-        else:
-            return cursor.fetchall()
 
-    def _modify(self, query, placeholders):
-        cursor = self.connection.cursor()
-        if type(placeholders) == list:
-            cursor.executemany(
-                self.queries[query],
-                placeholders
+    def select_upload_by_hash(self, album_id, content_hash):
+        """Find successful upload of identical content into album.
+
+        Args:
+            album_id (int): db id of album sent into
+            content_hash (str): hex sha256 of file contents
+
+        Returns:
+            sqlite3.Row: matching upload, None if not found
+        """
+        return self._select(
+            'select_upload_by_hash',
+            {
+                'album_id': album_id,
+                'content_hash': content_hash
+            },
+            single=True
+        )
+
+    def select_upload_by_hash_other_album(self, album_id, content_hash):
+        """Find successful upload of identical content into any other album.
+
+        Args:
+            album_id (int): db id of album to exclude
+            content_hash (str): hex sha256 of file contents
+
+        Returns:
+            sqlite3.Row: latest matching upload, None if not found
+        """
+        return self._select(
+            'select_upload_by_hash_other_album',
+            {
+                'album_id': album_id,
+                'content_hash': content_hash
+            },
+            single=True
+        )
+
+    def select_upload_session(self, filename):
+        """Find in progress resumable upload for file.
+
+        Args:
+            filename (str): full path filename locally on disk
+
+        Returns:
+            sqlite3.Row: matching session, None if not found
+        """
+        return self._select(
+            'select_upload_session',
+            {
+                'filename': filename
+            },
+            single=True
+        )
+
+    def save_upload_session(self, filename, size, session_url, confirmed_offset):  # noqa:E501
+        """Record progress of resumable upload.
+
+        Args:
+            filename (str): full path filename locally on disk
+            size (int): total bytes in file when session started
+            session_url (str): url to send remaining bytes to
+            confirmed_offset (int): bytes acknowledged by API so far
+        """
+        self._modify(
+            'upsert_upload_session',
+            {
+                'filename': filename,
+                'size': size,
+                'session_url': session_url,
+                'confirmed_offset': confirmed_offset
+            }
+        )
+
+    def delete_upload_session(self, filename):
+        """Forget resumable upload once finalized.
+
+        Args:
+            filename (str): full path filename locally on disk
+        """
+        self._modify(
+            'delete_upload_session',
+            {
+                'filename': filename
+            }
+        )
+
+    def insert_upload_token(self, upload_token, filename, album_gid, size, mtime_ns):  # noqa:E501
+        """Journal upload token as soon as bytes are sent.
+
+        Args:
+            upload_token (str): token returned by API for uploaded bytes
+            filename (str): full path filename locally on disk
+            album_gid (str): Google Photos album id token is meant for
+            size (int): bytes on disk of file sent, before upload
+            mtime_ns (int): modification time in nanoseconds of file sent, before upload
+        """  # noqa:E501
+        self._modify(
+            'insert_upload_token',
+            {
+                'upload_token': upload_token,
+                'filename': filename,
+                'album_gid': album_gid,
+                'size': size,
+                'mtime_ns': mtime_ns
+            }
+        )
+
+    def select_upload_token(self, filename, album_gid, max_age_hours):
+        """Find unexpired upload token not yet registered in album.
+
+        Args:
+            filename (str): full path filename locally on disk
+            album_gid (str): Google Photos album id token is meant for
+            max_age_hours (int): ignore tokens older than this
+
+        Returns:
+            sqlite3.Row: latest matching token with size and mtime_ns of file sent, None if not found
+        """  # noqa:E501
+        return self._select(
+            'select_upload_token',
+            {
+                'filename': filename,
+                'album_gid': album_gid,
+                'max_age': f'-{max_age_hours} hours'
+            },
+            single=True
+        )
+
+    def delete_upload_tokens(self, upload_tokens):
+        """Forget upload tokens once registered, or rejected.
+
+        Args:
+            upload_tokens (list[str]): tokens returned by API
+        """
+        if upload_tokens:
+            self._modify(
+                'delete_bulk_upload_tokens',
+                [
+                    {
+                        'upload_token': x
+                    }
+                    for x in upload_tokens
+                ]
             )
-        else:
+
+    def delete_expired_upload_tokens(self, max_age_hours):
+        """Drop journaled tokens the API will no longer accept.
+
+        Args:
+            max_age_hours (int): tokens older than this are removed
+        """
+        self._modify(
+            'delete_expired_upload_tokens',
+            {
+                'max_age': f'-{max_age_hours} hours'
+            }
+        )
+
+    def select_scan_entry(self, album_id, path):
+        """Find cached scan state of a file or directory.
+
+        Args:
+            album_id (int): db id of album scanned for
+            path (str): full path locally on disk
+
+        Returns:
+            sqlite3.Row: matching entry, None if not found
+        """
+        return self._select(
+            'select_scan_entry',
+            {
+                'album_id': album_id,
+                'path': path
+            },
+            single=True
+        )
+
+    def select_scan_children(self, album_id, parent, dirs_only=False):
+        """Get cached scan state of entries in a directory.
+
+        Args:
+            album_id (int): db id of album scanned for
+            parent (str): full path of directory locally on disk
+            dirs_only (bool): skip file entries
+
+        Returns:
+            list[sqlite3.Row]: rows from scan_state table
+        """
+        return self._select(
+            'select_scan_child_dirs' if dirs_only else 'select_scan_children',
+            {
+                'album_id': album_id,
+                'parent': parent
+            }
+        )
+
+    def count_scan_invalid(self, album_id, parent):
+        """Count files in directory without a valid media extension.
+
+        Args:
+            album_id (int): db id of album scanned for
+            parent (str): full path of directory locally on disk
+
+        Returns:
+            int: number of invalid files
+        """
+        return self._select(
+            'count_scan_invalid',
+            {
+                'album_id': album_id,
+                'parent': parent
+            },
+            single=True
+        )['total']
+
+    def save_scan_entries(self, entries):
+        """Record scan state of files and directories.
+
+        Args:
+            entries (list[dict]):
+                - album_id (int): db id of album scanned for
+                - path (str): full path locally on disk
+                - parent (str): full path of containing directory
+                - is_dir (bool): if entry is a directory
+                - size (int): bytes on disk
+                - mtime_ns (int): modification time in nanoseconds
+                - inode (int): inode number on disk
+                - status (str): pending, uploaded, failed, invalid, rejected or done
+        """  # noqa:E501
+        if entries:
+            self._modify('upsert_bulk_scan_entries', entries)
+
+    def delete_scan_entries(self, album_id, paths):
+        """Forget scan state of entries removed from disk.
+
+        Args:
+            album_id (int): db id of album scanned for
+            paths (list[str]): full paths locally on disk
+        """
+        if paths:
+            self._modify(
+                'delete_bulk_scan_entries',
+                [
+                    {
+                        'album_id': album_id,
+                        'path': x
+                    }
+                    for x in paths
+                ]
+            )
+
+    def update_scan_status(self, album_id, paths, status):
+        """Set scan status of files after upload attempt.
+
+        Args:
+            album_id (int): db id of album scanned for
+            paths (list[str]): full paths locally on disk
+            status (str): new status for all paths
+        """
+        if paths:
+            self._modify(
+                'update_bulk_scan_status',
+                [
+                    {
+                        'album_id': album_id,
+                        'path': x,
+                        'status': status
+                    }
+                    for x in paths
+                ]
+            )
+
+    def complete_scan_dirs(self, album_id):
+        """Mark directories with no files left to upload as done.
+
+        Args:
+            album_id (int): db id of album scanned for
+        """
+        self._modify(
+            'update_scan_dirs_done',
+            {
+                'album_id': album_id
+            }
+        )
+
+    def select_preflight_results(self, local_dir):
+        """Get cached checks of files in directory.
+
+        Args:
+            local_dir (str): full path of directory locally on disk
+
+        Returns:
+            list[sqlite3.Row]: rows from preflight_results table
+        """
+        return self._select(
+            'select_preflight_results_by_dir',
+            {
+                'local_dir': local_dir
+            }
+        )
+
+    def save_preflight_results(self, results):
+        """Cache checks of files until they change.
+
+        Args:
+            results (list[dict]):
+                - local_dir (str): directory file is in
+                - filename (str): filename minus directory
+                - size (int): bytes on disk when checked
+                - mtime_ns (int): modification time in nanoseconds when checked
+                - version (int): version of checks, older results are checked again
+                - error (str): reason file was rejected, None if it passed
+        """  # noqa:E501
+        if results:
+            self._modify('upsert_bulk_preflight_results', results)
+
+    def reserve_quota(self, name, day, limit):
+        """Count one call against daily quota shared by all processes.
+
+        Args:
+            name (str): quota counted, e.g. batchCreate
+            day (str): date quota resets on, as YYYY-MM-DD
+            limit (int): calls allowed per day
+
+        Returns:
+            bool: True if counted, False if quota used up
+        """
+        query = 'upsert_api_quota'
+        with self.metrics.span('db_query_seconds', query=query), self.lock:
+            cursor = self.connection.cursor()
             cursor.execute(
-                self.queries[query],
+                self._query(query),
+                {
+                    'name': name,
+                    'day': day,
+                    'limit': limit
+                }
+            )
+            with self.metrics.span('db_commit_seconds'):
+                self.connection.commit()
+            return cursor.rowcount > 0
+
+    def claim_upload_leases(self, album_id, paths, worker, lease_seconds):
+        """Lease files to one worker, unless leased to another and unexpired.
+
+        All files are claimed in one transaction, so workers claiming at
+        once never split a file.
+
+        Args:
+            album_id (int): db id of album uploading into
+            paths (list[str]): full paths locally on disk
+            worker (str): unique name of worker claiming
+            lease_seconds (int): lease expires unless renewed in time
+
+        Returns:
+            set[str]: paths leased to worker
+        """
+        if not paths:
+            return set()
+        claim = uuid.uuid4().hex
+        self._modify(
+            'upsert_bulk_upload_leases',
+            [
+                {
+                    'album_id': album_id,
+                    'path': x,
+                    'worker': worker,
+                    'claim': claim,
+                    'lease': f'+{lease_seconds} seconds'
+                }
+                for x in paths
+            ]
+        )
+        return set(
+            x['path']
+            for x in self._select(
+                'select_upload_leases_by_claim',
+                {
+                    'claim': claim
+                }
+            )
+        )
+
+    def renew_upload_leases(self, worker, lease_seconds):
+        """Push back expiry of every lease held by worker.
+
+        Args:
+            worker (str): unique name of worker
+            lease_seconds (int): lease expires unless renewed again in time
+        """
+        self._modify(
+            'update_upload_leases_expiry',
+            {
+                'worker': worker,
+                'lease': f'+{lease_seconds} seconds'
+            }
+        )
+
+    def delete_upload_leases(self, album_id, paths, worker):
+        """Release leases on files once recorded.
+
+        Args:
+            album_id (int): db id of album uploading into
+            paths (list[str]): full paths locally on disk
+            worker (str): unique name of worker holding leases
+        """
+        if paths:
+            self._modify(
+                'delete_bulk_upload_leases',
+                [
+                    {
+                        'album_id': album_id,
+                        'path': x,
+                        'worker': worker
+                    }
+                    for x in paths
+                ]
+            )
+
+    def delete_worker_upload_leases(self, worker):
+        """Release every lease held by worker, e.g. when it stops.
+
+        Args:
+            worker (str): unique name of worker
+        """
+        self._modify(
+            'delete_worker_upload_leases',
+            {
+                'worker': worker
+            }
+        )
+
+    def delete_expired_upload_leases(self):
+        """Drop leases of workers that stopped without releasing them."""
+        self._modify(
+            'delete_expired_upload_leases',
+            {}
+        )
+
+    def _migrate(self, migrations_dir):
+        version = self._select_pragma('user_version')
+        migrations = sorted(
+            (int(x.split('_')[0]), x)
+            for x in os.listdir(migrations_dir)
+            if x.endswith('.sql')
+        )
+        for number, name in migrations:
+            if number <= version:
+                continue
+            with open(os.path.join(migrations_dir, name), 'r') as f:
+                statements = _split_statements(f.read())
+
+            # other processes may open a new db at once, so the version is
+            # read again once this one holds the write lock
+            with self.lock:
+                cursor = self.connection.cursor()
+                cursor.execute('BEGIN IMMEDIATE')
+                try:
+                    version = cursor.execute('PRAGMA user_version').fetchone()[0]  # noqa:E501
+                    if number > version:
+
+                        # databases created before versioning lack columns
+                        # added since
+                        if version == 0:
+                            self._ensure_column(cursor, 'uploads', 'content_hash', 'VARCHAR DEFAULT NULL')  # noqa:E501
+                        for statement in statements:
+                            cursor.execute(statement)
+                        cursor.execute(f'PRAGMA user_version = {number}')
+                        version = number
+                    self.connection.commit()
+                except BaseException:
+                    self.connection.rollback()
+                    raise
+
+    def _select_pragma(self, name):
+        with self.lock:
+            cursor = self.connection.cursor()
+            return cursor.execute(f'PRAGMA {name}').fetchone()[0]
+
+    def _ensure_column(self, cursor, table, column, definition):
+        columns = [
+            x['name']
+            for x in cursor.execute(f'PRAGMA table_info({table})')
+        ]
+        if columns and column not in columns:
+            cursor.execute(
+                f'ALTER TABLE {table} ADD COLUMN {column} {definition}'
+            )
+
+    def _query(self, name):
+        if name not in self.queries:
+            with open(os.path.join(SQL_DIR, f'{name}.sql'), 'r') as f:
+                self.queries[name] = f.read()
+        return self.queries[name]
+
+    def _script(self, queries):
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.executescript(queries)
+
+    def _select(self, query, placeholders={}, single=False):
+        with self.metrics.span('db_query_seconds', query=query), self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute(
+                self._query(query),
                 placeholders
             )
-        self.connection.commit()
-        return cursor.lastrowid
+            if single:
+                return cursor.fetchone()
+            else:
+                return cursor.fetchall()
+
+    def _modify(self, query, placeholders):
+        with self.metrics.span('db_query_seconds', query=query), self.lock:
+            cursor = self.connection.cursor()
+            if type(placeholders) == list:
+                cursor.executemany(
+                    self._query(query),
+                    placeholders
+                )
+            else:
+                cursor.execute(
+                    self._query(query),
+                    placeholders
+                )
+            with self.metrics.span('db_commit_seconds'):
+                self.connection.commit()
+            return cursor.lastrowid
+
+
+def _split_statements(script):
+    """Split sql script into statements, to run in one transaction."""
+    statements = []
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ''
+    if statement.strip():
+        statements.append(statement.strip())
+    return statements
@@ -0,0 +1,6 @@
+SELECT COUNT(*) AS total
+FROM scan_state
+WHERE album_id = :album_id
+AND parent = :parent
+AND is_dir = 0
+AND status = 'invalid';
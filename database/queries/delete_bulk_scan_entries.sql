@@ -0,0 +1,3 @@
+DELETE FROM scan_state
+WHERE album_id = :album_id
+AND (path = :path OR parent = :path);
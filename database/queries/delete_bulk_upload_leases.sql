@@ -0,0 +1,4 @@
+DELETE FROM upload_leases
+WHERE album_id = :album_id
+AND path = :path
+AND worker = :worker;
@@ -0,0 +1,2 @@
+DELETE FROM upload_tokens
+WHERE upload_token = :upload_token;
@@ -0,0 +1,2 @@
+DELETE FROM upload_tokens
+WHERE event_time <= datetime('now', :max_age);
@@ -0,0 +1,6 @@
+DELETE FROM remote_albums
+WHERE event_time < (
+    SELECT refresh_time
+    FROM catalogue_refreshes
+    WHERE name = :name
+);
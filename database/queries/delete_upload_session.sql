@@ -0,0 +1,2 @@
+DELETE FROM upload_sessions
+WHERE filename = :filename;
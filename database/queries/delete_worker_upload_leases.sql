@@ -0,0 +1,2 @@
+DELETE FROM upload_leases
+WHERE worker = :worker;
@@ -1,4 +1,26 @@
 INSERT INTO uploads
-(album_id, local_dir, filename, media_id)
+(album_id, local_dir, filename, media_id, content_hash, attempts, next_attempt_time)
 VALUES
-(:album_id, :local_dir, :filename, :media_id);
+(
+    :album_id, :local_dir, :filename, :media_id, :content_hash,
+    CASE WHEN :media_id IS NULL THEN 1 ELSE 0 END,
+    CASE WHEN :media_id IS NULL
+        THEN datetime('now', '+' || :retry_minutes || ' minutes')
+    END
+)
+ON CONFLICT(album_id, local_dir, filename) DO UPDATE SET
+media_id = COALESCE(excluded.media_id, uploads.media_id),
+content_hash = COALESCE(excluded.content_hash, uploads.content_hash),
+attempts = CASE
+    WHEN uploads.media_id IS NOT NULL THEN uploads.attempts
+    WHEN excluded.media_id IS NULL THEN uploads.attempts + 1
+    ELSE uploads.attempts
+END,
+next_attempt_time = CASE
+    WHEN COALESCE(excluded.media_id, uploads.media_id) IS NOT NULL THEN NULL
+    ELSE datetime(
+        'now',
+        '+' || MIN(:max_retry_minutes, :retry_minutes << uploads.attempts) || ' minutes'
+    )
+END,
+event_time = CURRENT_TIMESTAMP;
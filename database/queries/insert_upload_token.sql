@@ -0,0 +1,4 @@
+INSERT INTO upload_tokens
+(upload_token, filename, album_gid, size, mtime_ns)
+VALUES
+(:upload_token, :filename, :album_gid, :size, :mtime_ns);
@@ -0,0 +1,42 @@
+CREATE TABLE IF NOT EXISTS albums(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    gid VARCHAR NOT NULL UNIQUE,
+    name VARCHAR
+);
+
+CREATE TABLE IF NOT EXISTS uploads(
+    album_id INTEGER NOT NULL,
+    local_dir VARCHAR NOT NULL,
+    filename VARCHAR NOT NULL,
+    media_id VARCHAR DEFAULT NULL,
+    content_hash VARCHAR DEFAULT NULL,
+    event_time DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (album_id) REFERENCES albums(id)
+);
+
+CREATE TABLE IF NOT EXISTS upload_sessions(
+    filename VARCHAR PRIMARY KEY,
+    size INTEGER NOT NULL,
+    session_url VARCHAR NOT NULL,
+    confirmed_offset INTEGER NOT NULL DEFAULT 0,
+    event_time DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS scan_state(
+    album_id INTEGER NOT NULL,
+    path VARCHAR NOT NULL,
+    parent VARCHAR NOT NULL,
+    is_dir INTEGER NOT NULL DEFAULT 0,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    status VARCHAR NOT NULL,
+    PRIMARY KEY (album_id, path),
+    FOREIGN KEY (album_id) REFERENCES albums(id)
+);
+
+CREATE INDEX IF NOT EXISTS uploads_album_hash
+ON uploads(album_id, content_hash);
+
+CREATE INDEX IF NOT EXISTS scan_state_parent
+ON scan_state(album_id, parent, is_dir);
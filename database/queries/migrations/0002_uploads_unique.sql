@@ -0,0 +1,25 @@
+-- temporary index so finding duplicate rows is not quadratic
+CREATE INDEX IF NOT EXISTS uploads_dedupe
+ON uploads(album_id, local_dir, filename);
+
+-- keep one row per file, preferring a successful upload then the latest
+DELETE FROM uploads
+WHERE EXISTS (
+    SELECT 1
+    FROM uploads AS other
+    WHERE other.album_id = uploads.album_id
+    AND other.local_dir = uploads.local_dir
+    AND other.filename = uploads.filename
+    AND (
+        (other.media_id IS NOT NULL AND uploads.media_id IS NULL)
+        OR (
+            (other.media_id IS NULL) = (uploads.media_id IS NULL)
+            AND other.rowid > uploads.rowid
+        )
+    )
+);
+
+DROP INDEX uploads_dedupe;
+
+CREATE UNIQUE INDEX IF NOT EXISTS uploads_album_dir_filename
+ON uploads(album_id, local_dir, filename);
@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS upload_tokens(
+    upload_token VARCHAR PRIMARY KEY,
+    filename VARCHAR NOT NULL,
+    album_gid VARCHAR NOT NULL,
+    event_time DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS upload_tokens_file
+ON upload_tokens(album_gid, filename, event_time);
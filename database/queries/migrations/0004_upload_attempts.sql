@@ -0,0 +1,12 @@
+ALTER TABLE uploads ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0;
+
+ALTER TABLE uploads ADD COLUMN next_attempt_time DEFAULT NULL;
+
+UPDATE uploads
+SET attempts = 1,
+next_attempt_time = CURRENT_TIMESTAMP
+WHERE media_id IS NULL;
+
+CREATE INDEX IF NOT EXISTS uploads_failed
+ON uploads(album_id, next_attempt_time)
+WHERE media_id IS NULL;
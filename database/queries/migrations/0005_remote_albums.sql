@@ -0,0 +1,12 @@
+CREATE TABLE IF NOT EXISTS remote_albums(
+    gid VARCHAR PRIMARY KEY,
+    title VARCHAR,
+    media_items_count INTEGER,
+    is_writeable INTEGER,
+    event_time DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS catalogue_refreshes(
+    name VARCHAR PRIMARY KEY,
+    refresh_time DEFAULT CURRENT_TIMESTAMP
+);
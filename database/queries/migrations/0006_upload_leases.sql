@@ -0,0 +1,15 @@
+CREATE TABLE IF NOT EXISTS upload_leases(
+    album_id INTEGER NOT NULL,
+    path VARCHAR NOT NULL,
+    worker VARCHAR NOT NULL,
+    claim VARCHAR NOT NULL,
+    expire_time NOT NULL,
+    PRIMARY KEY (album_id, path),
+    FOREIGN KEY (album_id) REFERENCES albums(id)
+);
+
+CREATE INDEX IF NOT EXISTS upload_leases_worker
+ON upload_leases(worker);
+
+CREATE INDEX IF NOT EXISTS upload_leases_claim
+ON upload_leases(claim);
@@ -0,0 +1,4 @@
+-- finds media uploaded into any album by content, e.g. to add to another
+CREATE INDEX IF NOT EXISTS uploads_content_hash
+ON uploads(content_hash)
+WHERE media_id IS NOT NULL;
@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS preflight_results(
+    local_dir VARCHAR NOT NULL,
+    filename VARCHAR NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    error VARCHAR DEFAULT NULL,
+    event_time DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (local_dir, filename)
+);
@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS api_quota(
+    name VARCHAR NOT NULL,
+    day VARCHAR NOT NULL,
+    calls INTEGER NOT NULL,
+    PRIMARY KEY (name, day)
+);
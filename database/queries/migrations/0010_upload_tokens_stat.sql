@@ -0,0 +1,2 @@
+ALTER TABLE upload_tokens ADD COLUMN size INTEGER DEFAULT NULL;
+ALTER TABLE upload_tokens ADD COLUMN mtime_ns INTEGER DEFAULT NULL;
@@ -0,0 +1,23 @@
+SELECT *
+FROM (
+    SELECT
+        albums.id AS id,
+        albums.gid AS gid,
+        albums.name AS local_name,
+        remote_albums.title AS remote_name
+    FROM albums
+    LEFT JOIN remote_albums ON remote_albums.gid = albums.gid
+    UNION ALL
+    SELECT
+        NULL AS id,
+        remote_albums.gid AS gid,
+        NULL AS local_name,
+        remote_albums.title AS remote_name
+    FROM remote_albums
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM albums
+        WHERE albums.gid = remote_albums.gid
+    )
+)
+ORDER BY id IS NULL, id ASC, remote_name ASC;
@@ -0,0 +1,5 @@
+SELECT albums.*
+FROM albums
+LEFT JOIN remote_albums ON remote_albums.gid = albums.gid
+WHERE remote_albums.gid IS NULL
+ORDER BY albums.id ASC;
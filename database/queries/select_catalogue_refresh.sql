@@ -0,0 +1,4 @@
+SELECT *
+FROM catalogue_refreshes
+WHERE name = :name
+AND refresh_time > datetime('now', :max_age);
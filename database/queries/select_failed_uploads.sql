@@ -0,0 +1,6 @@
+SELECT *
+FROM uploads
+WHERE album_id = :album_id
+AND media_id IS NULL
+AND next_attempt_time <= CURRENT_TIMESTAMP
+ORDER BY local_dir, filename;
@@ -0,0 +1,3 @@
+SELECT *
+FROM preflight_results
+WHERE local_dir = :local_dir;
@@ -0,0 +1,5 @@
+SELECT *
+FROM scan_state
+WHERE album_id = :album_id
+AND parent = :parent
+AND is_dir = 1;
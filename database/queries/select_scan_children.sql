@@ -0,0 +1,4 @@
+SELECT *
+FROM scan_state
+WHERE album_id = :album_id
+AND parent = :parent;
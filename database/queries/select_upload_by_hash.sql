@@ -0,0 +1,6 @@
+SELECT *
+FROM uploads
+WHERE album_id = :album_id
+AND content_hash = :content_hash
+AND media_id IS NOT NULL
+LIMIT 1;
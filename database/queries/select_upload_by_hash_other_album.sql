@@ -0,0 +1,7 @@
+SELECT *
+FROM uploads
+WHERE content_hash = :content_hash
+AND media_id IS NOT NULL
+AND album_id != :album_id
+ORDER BY event_time DESC
+LIMIT 1;
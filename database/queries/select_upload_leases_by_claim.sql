@@ -0,0 +1,3 @@
+SELECT path
+FROM upload_leases
+WHERE claim = :claim;
@@ -0,0 +1,3 @@
+SELECT *
+FROM upload_sessions
+WHERE filename = :filename;
@@ -0,0 +1,7 @@
+SELECT *
+FROM upload_tokens
+WHERE album_gid = :album_gid
+AND filename = :filename
+AND event_time > datetime('now', :max_age)
+ORDER BY event_time DESC
+LIMIT 1;
@@ -1,4 +1,5 @@
-SELECT *
+SELECT *, media_id IS NOT NULL AS uploaded
 FROM uploads
 WHERE local_dir = :local_dir
-AND album_id = :album_id;
+AND album_id = :album_id
+AND (media_id IS NOT NULL OR next_attempt_time > CURRENT_TIMESTAMP);
@@ -0,0 +1,4 @@
+UPDATE scan_state
+SET status = :status
+WHERE album_id = :album_id
+AND path = :path;
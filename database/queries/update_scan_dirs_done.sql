@@ -0,0 +1,13 @@
+UPDATE scan_state
+SET status = 'done'
+WHERE album_id = :album_id
+AND is_dir = 1
+AND status = 'pending'
+AND NOT EXISTS (
+    SELECT 1
+    FROM scan_state AS files
+    WHERE files.album_id = scan_state.album_id
+    AND files.parent = scan_state.path
+    AND files.is_dir = 0
+    AND files.status IN ('pending', 'failed', 'rejected')
+);
@@ -0,0 +1,3 @@
+UPDATE upload_leases
+SET expire_time = datetime('now', :lease)
+WHERE worker = :worker;
@@ -0,0 +1,7 @@
+INSERT INTO api_quota
+(name, day, calls)
+SELECT :name, :day, 1
+WHERE :limit > 0
+ON CONFLICT(name, day) DO UPDATE SET
+calls = calls + 1
+WHERE api_quota.calls < :limit;
@@ -0,0 +1,10 @@
+INSERT INTO preflight_results
+(local_dir, filename, size, mtime_ns, version, error)
+VALUES
+(:local_dir, :filename, :size, :mtime_ns, :version, :error)
+ON CONFLICT(local_dir, filename) DO UPDATE SET
+size = excluded.size,
+mtime_ns = excluded.mtime_ns,
+version = excluded.version,
+error = excluded.error,
+event_time = CURRENT_TIMESTAMP;
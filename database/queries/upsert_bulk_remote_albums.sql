@@ -0,0 +1,9 @@
+INSERT INTO remote_albums
+(gid, title, media_items_count, is_writeable)
+VALUES
+(:gid, :title, :media_items_count, :is_writeable)
+ON CONFLICT(gid) DO UPDATE SET
+title = excluded.title,
+media_items_count = excluded.media_items_count,
+is_writeable = excluded.is_writeable,
+event_time = CURRENT_TIMESTAMP;
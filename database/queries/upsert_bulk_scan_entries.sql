@@ -0,0 +1,11 @@
+INSERT INTO scan_state
+(album_id, path, parent, is_dir, size, mtime_ns, inode, status)
+VALUES
+(:album_id, :path, :parent, :is_dir, :size, :mtime_ns, :inode, :status)
+ON CONFLICT(album_id, path) DO UPDATE SET
+parent = excluded.parent,
+is_dir = excluded.is_dir,
+size = excluded.size,
+mtime_ns = excluded.mtime_ns,
+inode = excluded.inode,
+status = excluded.status;
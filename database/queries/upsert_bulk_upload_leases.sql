@@ -0,0 +1,10 @@
+INSERT INTO upload_leases
+(album_id, path, worker, claim, expire_time)
+VALUES
+(:album_id, :path, :worker, :claim, datetime('now', :lease))
+ON CONFLICT(album_id, path) DO UPDATE SET
+worker = excluded.worker,
+claim = excluded.claim,
+expire_time = excluded.expire_time
+WHERE upload_leases.worker = excluded.worker
+OR upload_leases.expire_time <= datetime('now');
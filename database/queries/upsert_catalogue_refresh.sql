@@ -0,0 +1,6 @@
+INSERT INTO catalogue_refreshes
+(name)
+VALUES
+(:name)
+ON CONFLICT(name) DO UPDATE SET
+refresh_time = CURRENT_TIMESTAMP;
@@ -0,0 +1,9 @@
+INSERT INTO upload_sessions
+(filename, size, session_url, confirmed_offset)
+VALUES
+(:filename, :size, :session_url, :confirmed_offset)
+ON CONFLICT(filename) DO UPDATE SET
+size = excluded.size,
+session_url = excluded.session_url,
+confirmed_offset = excluded.confirmed_offset,
+event_time = CURRENT_TIMESTAMP;
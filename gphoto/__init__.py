@@ -1,15 +1,37 @@
 """API interface for google photos."""
 
 import json
+import mimetypes
 import os
+import threading
+import time
 
-from google.auth.transport.requests import AuthorizedSession
-from google.oauth2.credentials import Credentials
+from gphoto.auth import APP_SCOPES
+from gphoto.auth import CredentialManager
+from gphoto.auth import save_credentials
+from gphoto.schedule import BATCH_BYTES
+from gphoto.schedule import schedule_batches
+from gphoto.throttle import BANDWIDTH_CHUNK_SIZE
+from gphoto.throttle import BandwidthLimiter
+from gphoto.throttle import HTTPError
+from gphoto.throttle import RateLimiter
+from gphoto.throttle import parse_retry_after
 
-from google_auth_oauthlib.flow import InstalledAppFlow
+from metrics import Metrics
 
-URL_BASE = 'https://photoslibrary.googleapis.com/'
-APP_SCOPES = ['https://www.googleapis.com/auth/photoslibrary']
+URL_BASE = os.environ.get('GPHOTOS_API_URL', 'https://photoslibrary.googleapis.com/')  # noqa:E501
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# https://developers.google.com/photos/library/guides/resumable-uploads
+RESUMABLE_THRESHOLD = 64 * 1024 * 1024
+RESUMABLE_CHUNK_SIZE = 16 * 1024 * 1024
+
+# upload tokens are valid for a day, journaled ones are reused until then
+UPLOAD_TOKEN_MAX_AGE_HOURS = 23
+
+# google.rpc.Code values of batchCreate items worth registering again
+BATCH_CREATE_RETRIES = 2
+BATCH_CREATE_RETRY_CODES = (4, 8, 10, 13, 14)
 
 # https://developers.google.com/photos/library/guides/upload-media#file-types-sizes
 PHOTO_TYPES = [
@@ -31,81 +53,450 @@ def valid_video_ext(filename):
     return filename.split('.')[-1].upper() in VIDEO_TYPES
 
 
+def api_endpoint(url):
+    """Label for url called, grouping upload sessions and albums together."""
+    if '://' in url:
+        return 'v1/uploads:session'
+    if url.startswith('v1/albums/'):
+        _, _, action = url.partition(':')
+        return 'v1/albums/{id}' + (f':{action}' if action else '')
+    return url
+
+
+def batch_create_body(upload_tokens, to_album_id):
+    """Build mediaItems:batchCreate request registering uploads in album."""
+    return json.dumps({
+        'albumId': to_album_id,
+        'newMediaItems': [
+            {
+                'simpleMediaItem': {
+                    'uploadToken': upload_token,
+                    'fileName': os.path.split(details['filename'])[-1]
+                }
+            }
+            for upload_token, details in upload_tokens.items()
+        ]
+    })
+
+
+def record_batch_results(upload_tokens, data):
+    """Add media ids of successful items from batchCreate response."""
+    for result in data['newMediaItemResults']:
+        if result['status']['message'] in ('Success', 'OK'):
+            upload_tokens[result['uploadToken']]['media_id'] = result['mediaItem']['id']  # noqa:E501
+        else:
+            upload_tokens[result['uploadToken']]['status_code'] = result['status'].get('code')  # noqa:E501
+
+
+def retryable_batch_items(upload_tokens):
+    """Items of batch that failed for transient reasons."""
+    return {
+        upload_token: details
+        for upload_token, details in upload_tokens.items()
+        if 'media_id' not in details
+        and details.get('status_code') in BATCH_CREATE_RETRY_CODES
+    }
+
+
+def resumable_start_headers(filename):
+    """Headers to open a resumable upload session for file."""
+    content_type, _ = mimetypes.guess_type(filename)
+    return {
+        'Content-Length': '0',
+        'X-Goog-Upload-Command': 'start',
+        'X-Goog-Upload-Content-Type': content_type or 'application/octet-stream',  # noqa:E501
+        'X-Goog-Upload-Protocol': 'resumable',
+        'X-Goog-Upload-Raw-Size': str(os.path.getsize(filename))
+    }
+
+
+def journaled_matches(journaled, stat):
+    """If journaled upload token was sent from file as it is on disk now."""
+    return journaled['size'] == stat.st_size \
+        and journaled['mtime_ns'] == stat.st_mtime_ns
+
+
+def resumable_chunk_size(headers):
+    """Largest chunk size within limit that is a multiple of granularity."""
+    granularity = int(headers.get('X-Goog-Upload-Chunk-Granularity', 1))
+    return max(
+        granularity,
+        RESUMABLE_CHUNK_SIZE - RESUMABLE_CHUNK_SIZE % granularity
+    )
+
+
+class FileBody(object):
+    """Request body streamed from disk in fixed size chunks."""
+
+    def __init__(self, filename, chunk_size=UPLOAD_CHUNK_SIZE, offset=0, length=None, pace=None):  # noqa:E501
+        """Wrap file to be read lazily while sending.
+
+        Args:
+            filename (str): full path filename locally on disk
+            chunk_size (int): max bytes held in memory at once
+            offset (int): byte position in file to start from
+            length (int): bytes to send, defaults to rest of file
+            pace (callable): called with size of each chunk before it is sent, e.g. to limit bandwidth
+        """  # noqa:E501
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.pace = pace
+        self.offset = offset
+        if length is None:
+            length = os.path.getsize(filename) - offset
+        self.size = length
+
+    def __len__(self):
+        """Size known up front, so body is sent with Content-Length."""
+        return self.size
+
+    def __iter__(self):
+        """Read file one chunk at a time."""
+        remaining = self.size
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            while remaining > 0:
+                chunk = f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                if self.pace:
+                    self.pace(len(chunk))
+                yield chunk
+
+
 class Client(object):
     """Session scoped client object."""
 
     session = None
+    credentials = None
+    workers = 1
+    upload_store = None
+    resumable_threshold = RESUMABLE_THRESHOLD
+    rate_limiter = None
+    bandwidth_limiter = None
+    metrics = None
 
-    def __init__(self, user_token_filename, app_creds_filename=None):  # noqa:E501
+    def __init__(self, user_token_filename, app_creds_filename=None, workers=1, upload_store=None, resumable_threshold=RESUMABLE_THRESHOLD, rate_limiter=None, bandwidth_limiter=None, metrics=None, pool_size=None):  # noqa:E501
         """Create new authorized client.
 
         Args:
             user_token_filename (str): file to read/write user token
             app_creds_filename (str): file to read app config when registering user token
+            workers (int): number of media uploads to run concurrently, across all post_batch_media calls
+            upload_store (database.DB): store to persist resumable upload progress and upload tokens in
+            resumable_threshold (int): file size in bytes to switch to resumable uploads
+            rate_limiter (gphoto.throttle.RateLimiter): pacing and retries shared by all workers
+            bandwidth_limiter (gphoto.throttle.BandwidthLimiter): upload bytes per second shared by all workers
+            metrics (metrics.Metrics): run metrics to time calls and count bytes into
+            pool_size (int): connections kept open for reuse, defaults to workers
         """  # noqa:E501
+        if workers < 1:
+            raise ValueError('Invalid workers')
+        if pool_size is not None and pool_size < 1:
+            raise ValueError('Invalid pool_size')
+        self.workers = workers
+        self.upload_store = upload_store
+        self.resumable_threshold = resumable_threshold
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.bandwidth_limiter = bandwidth_limiter or BandwidthLimiter()
+        self.metrics = metrics or Metrics()
+
+        # uploads in flight over every batch stream, e.g. albums sent at once
+        self.upload_slots = threading.BoundedSemaphore(workers)
+
+        # imported here so commands without api calls start quickly
+        import requests
+        from requests.adapters import HTTPAdapter
+
         try:
-            token = self._get_creds_from_file(user_token_filename)
+            self.credentials = CredentialManager(user_token_filename, metrics=self.metrics)  # noqa:E501
         except (FileNotFoundError, json.decoder.JSONDecodeError, ValueError) as e:  # noqa:E501
             if not app_creds_filename:
                 raise e
             raw_token = self._generate_auth_token(app_creds_filename)
-            self._save_auth_token(raw_token, user_token_filename)
-            token = self._get_creds_from_file(user_token_filename)
-        self.session = AuthorizedSession(token)
+            save_credentials(raw_token, user_token_filename)
+            self.credentials = CredentialManager(user_token_filename, metrics=self.metrics)  # noqa:E501
+
+        # one token for all workers, refreshed before it expires
+        self.credentials.start()
+        self.session = requests.Session()
 
-    def post_batch_media(self, filenames, to_album_id, batch_size=50):
+        # keep one pooled connection per upload worker, or per thread calling
+        # at once when several batch streams share the client
+        self.session.mount(
+            URL_BASE,
+            HTTPAdapter(pool_connections=1, pool_maxsize=pool_size or workers)
+        )
+
+    def post_batch_media(self, filenames, to_album_id, batch_size=50, batch_bytes=BATCH_BYTES, order='scan', sources=None):  # noqa:E501
         """Upload and register batch of media items.
 
+        Batches are registered as soon as all their files are uploaded, so
+        not necessarily in the order files were given.
+
         Args:
-            list[str]: full path filenames locally on disk
+            filenames (iterable[str]): full path filenames locally on disk, consumed lazily
             to_album_id (str): Google Photos album id
-            batch_size (int): chunk size to send files in
+            batch_size (int): max files to send in one batch
+            batch_bytes (int): max bytes to send in one batch, unless one file is larger
+            order (str): scan, smallest or oldest, see gphoto.schedule
+            sources (dict): files to send in place of others, e.g. downscaled copies, by filename
 
         Yields:
             dict: uploads results
                 key (str): Google Photos upload token
                     - filename (str): full path filename uploaded
                     - media_id (str): remote id created or missing on failure
-        """
+                    - status_code (int): google.rpc.Code of failure
+        """  # noqa:E501
         if batch_size > 50 or batch_size < 1:
             raise ValueError('Invalid batch_size')
-        batches = [
-            filenames[x:x + batch_size]
-            for x in range(0, len(filenames), batch_size)
-        ]
-        for batch in batches:
-
-            # upload bytes, record upload token by filename
-            upload_tokens = {}
-            for filename in batch:
-                with open(filename, 'rb') as f:
-                    response = self._call('POST', 'v1/uploads', data=f.read())
-                    upload_tokens[response.content.decode()] = {
-                        'filename': filename
-                    }
+        if sources is None:
+            sources = {}
+        batches = schedule_batches(filenames, batch_size, batch_bytes, order, sources=sources)  # noqa:E501
+        if self.upload_store:
+            self.upload_store.delete_expired_upload_tokens(UPLOAD_TOKEN_MAX_AGE_HOURS)  # noqa:E501
+
+        from concurrent.futures import FIRST_COMPLETED
+        from concurrent.futures import ThreadPoolExecutor
+        from concurrent.futures import wait
+
+        # upload bytes in worker threads, queueing batches until every
+        # worker has a file waiting, e.g. while others send large files
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        pending = []
+
+        def queue_batches():
+            while len(pending) < 2 or unfinished_count() < self.workers * 2:  # noqa:E501
+                batch = next(batches, None)
+                if batch is None:
+                    return
+                pending.append([
+                    (filename, executor.submit(self._upload_media, filename, to_album_id, sources.get(filename, filename)))  # noqa:E501
+                    for filename in batch
+                ])
+
+        def unfinished_count():
+            return sum(
+                not future.done()
+                for uploads in pending
+                for _, future in uploads
+            )
+
+        try:
+            queue_batches()
+            while pending:
+                uploads = next(
+                    (x for x in pending if all(y.done() for _, y in x)),
+                    None
+                )
+                if uploads is None:
+                    wait(
+                        [y for x in pending for _, y in x if not y.done()],
+                        return_when=FIRST_COMPLETED
+                    )
+                    queue_batches()
+                    continue
+                pending.remove(uploads)
+                queue_batches()
+                yield self._create_batch_media(uploads, to_album_id)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _upload_media(self, filename, to_album_id, source):
+
+        # bytes read from source, which differs when transformed first
+        stat = os.stat(source)
+
+        # bytes sent by an earlier run that never reached batchCreate,
+        # unless the file sent has changed since
+        if self.upload_store:
+            journaled = self.upload_store.select_upload_token(
+                filename,
+                to_album_id,
+                UPLOAD_TOKEN_MAX_AGE_HOURS
+            )
+            if journaled:
+                if journaled_matches(journaled, stat):
+                    return journaled['upload_token']
+                self.upload_store.delete_upload_tokens([journaled['upload_token']])  # noqa:E501
+
+        with self.upload_slots:
+            if stat.st_size > self.resumable_threshold:
+                upload_token = self._upload_media_resumable(source)
+            else:
+                upload_token = self._upload_media_simple(source)
+        if self.upload_store:
+            self.upload_store.insert_upload_token(
+                upload_token,
+                filename,
+                to_album_id,
+                stat.st_size,
+                stat.st_mtime_ns
+            )
+        return upload_token
 
-            # register uploads into album
-            data = json.dumps({
-                'albumId': to_album_id,
-                'newMediaItems': [
-                    {
-                        'simpleMediaItem': {
-                            'uploadToken': upload_token,
-                            'fileName': os.path.split(details['filename'])[-1]
-                        }
+    def _upload_media_simple(self, filename):
+        body = self._file_body(filename)
+        response = self._call(
+            'POST',
+            'v1/uploads',
+            data=body,
+            headers={
+                'Content-Length': str(len(body))
+            }
+        )
+        return response.content.decode()
+
+    def _upload_media_resumable(self, filename):
+        import requests
+
+        size = os.path.getsize(filename)
+        session_url = None
+        offset = 0
+
+        # pick up from last acknowledged byte of previous session
+        saved = None
+        if self.upload_store:
+            saved = self.upload_store.select_upload_session(filename)
+        if saved and saved['size'] == size:
+            try:
+                response = self._call(
+                    'POST',
+                    saved['session_url'],
+                    headers={
+                        'X-Goog-Upload-Command': 'query'
                     }
-                    for upload_token, details in upload_tokens.items()
-                ]
-            })
-            response = self._call('POST', 'v1/mediaItems:batchCreate', data=data)  # noqa:E501
+                )
+                if response.headers.get('X-Goog-Upload-Status') == 'active':
+                    session_url = saved['session_url']
+                    offset = int(response.headers['X-Goog-Upload-Size-Received'])  # noqa:E501
+            except Exception:
+                pass
+
+        # start new session
+        if not session_url:
+            response = self._call(
+                'POST',
+                'v1/uploads',
+                headers=resumable_start_headers(filename)
+            )
+            session_url = response.headers['X-Goog-Upload-URL']
+            offset = 0
+            self._save_upload_session(filename, size, session_url, offset)
+
+        # chunks must be a multiple of granularity, except for the last one
+        chunk_size = resumable_chunk_size(response.headers)
+
+        # send chunks, recording offset as each is acknowledged, a failed
+        # chunk may have partly arrived, so server is asked where to resume
+        attempt = 0
+        while True:
+            body = self._file_body(
+                filename,
+                offset=offset,
+                length=min(chunk_size, size - offset)
+            )
+            finalize = offset + len(body) >= size
+            try:
+                response = self._call(
+                    'POST',
+                    session_url,
+                    data=body,
+                    headers={
+                        'Content-Length': str(len(body)),
+                        'X-Goog-Upload-Command': 'upload, finalize' if finalize else 'upload',  # noqa:E501
+                        'X-Goog-Upload-Offset': str(offset)
+                    },
+                    retry=False
+                )
+            except (HTTPError, requests.ConnectionError, requests.Timeout) as e:  # noqa:E501
+                delay = self.rate_limiter.retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                self.metrics.inc('api_retries', endpoint=api_endpoint(session_url))  # noqa:E501
+                time.sleep(delay)
+                attempt += 1
+                offset = self._upload_offset(session_url, e)
+                self._save_upload_session(filename, size, session_url, offset)
+                continue
+            if finalize:
+                break
+            offset += len(body)
+            self._save_upload_session(filename, size, session_url, offset)
+
+        if self.upload_store:
+            self.upload_store.delete_upload_session(filename)
+        return response.content.decode()
+
+    def _upload_offset(self, session_url, error):
+        response = self._call(
+            'POST',
+            session_url,
+            headers={
+                'X-Goog-Upload-Command': 'query'
+            }
+        )
+        if response.headers.get('X-Goog-Upload-Status') != 'active':
+            raise error
+        return int(response.headers['X-Goog-Upload-Size-Received'])
+
+    def _file_body(self, filename, offset=0, length=None):
+
+        # sent in small pieces when capped, so workers share bytes evenly
+        if not self.bandwidth_limiter.active:
+            return FileBody(filename, offset=offset, length=length)
+        return FileBody(
+            filename,
+            chunk_size=BANDWIDTH_CHUNK_SIZE,
+            offset=offset,
+            length=length,
+            pace=self._pace
+        )
+
+    def _pace(self, size):
+        wait = self.bandwidth_limiter.reserve(size)
+        if wait:
+            self.metrics.inc('bandwidth_wait_seconds', wait)
+            time.sleep(wait)
+
+    def _save_upload_session(self, filename, size, session_url, offset):
+        if self.upload_store:
+            self.upload_store.save_upload_session(
+                filename,
+                size,
+                session_url,
+                offset
+            )
+
+    def _create_batch_media(self, uploads, to_album_id):
+
+        # wait for bytes to upload, record upload token by filename
+        upload_tokens = {}
+        for filename, future in uploads:
+            upload_tokens[future.result()] = {
+                'filename': filename
+            }
 
-            # record success
-            for result in response.json()['newMediaItemResults']:
-                if result['status']['message'] in ('Success', 'OK'):
-                    upload_tokens[result['uploadToken']]['media_id'] = result['mediaItem']['id']  # noqa:E501
+        # register uploads into album, again for only items failing transiently
+        pending_tokens = upload_tokens
+        for attempt in range(BATCH_CREATE_RETRIES + 1):
+            if attempt:
+                time.sleep(self.rate_limiter.retry_policy.delay(attempt - 1, None))  # noqa:E501
+            response = self._call(
+                'POST',
+                'v1/mediaItems:batchCreate',
+                data=batch_create_body(pending_tokens, to_album_id)
+            )
+            record_batch_results(upload_tokens, response.json())
+            pending_tokens = retryable_batch_items(pending_tokens)
+            if not pending_tokens:
+                break
 
-            # yield batch to be processed
-            yield upload_tokens
+        if self.upload_store:
+            self.upload_store.delete_upload_tokens(list(upload_tokens.keys()))
+        return upload_tokens
 
     def list_albums(self, exclude_non_app=True, page_size=50):
         """View all albums user has access to.
@@ -134,6 +525,17 @@ class Client(object):
             params['pageToken'] = data['nextPageToken']
         return results
 
+    def get_album(self, album_id):
+        """View one album.
+
+        Args:
+            album_id (str): Google Photos album id
+
+        Returns:
+            Album: https://developers.google.com/photos/library/reference/rest/v1/albums#Album
+        """  # noqa:E501
+        return self._call('GET', f'v1/albums/{album_id}').json()
+
     def create_album(self, title):
         """Make new album.
 
@@ -150,41 +552,88 @@ class Client(object):
         })
         return self._call('POST', 'v1/albums', data=data)
 
-    def _call(self, verb, url, **kwargs):
-        response = self.session.request(
-            verb,
-            URL_BASE + url,
-            **kwargs
+    def add_album_media(self, album_id, media_ids):
+        """Add media items created by this app to album, without sending bytes.
+
+        All items are added or none, the API rejects the call if any one
+        can not be added, e.g. deleted from library.
+
+        Args:
+            album_id (str): Google Photos album id
+            media_ids (list[str]): up to 50 Google Photos media item ids
+
+        Raises:
+            gphoto.throttle.HTTPError: items not added
+        """
+        if len(media_ids) > 50 or not media_ids:
+            raise ValueError('Invalid media_ids')
+        data = json.dumps({
+            'mediaItemIds': media_ids
+        })
+        self._call(
+            'POST',
+            f'v1/albums/{album_id}:batchAddMediaItems',
+            data=data
         )
-        status_code = response.status_code
-        if status_code < 200 or status_code > 300:
-            raise Exception(f'Unexpected HTTP code "{status_code}" @ "{verb} {url}"')  # noqa:E501
-        return response
-
-    def _save_auth_token(self, token, filename):
-        data = {
-            prop: getattr(token, prop)
-            for prop in [
-                'token',
-                'refresh_token',
-                'scopes',
-                'token_uri',
-                'client_id',
-                'client_secret'
-            ]
-        }
-        with open(filename, 'w') as f:
-            f.write(json.dumps(data))
+
+    def _call(self, verb, url, headers={}, retry=True, **kwargs):
+        import requests
+
+        endpoint = api_endpoint(url)
+        attempt = 0
+        reauthorized = False
+        while True:
+            wait = self.rate_limiter.reserve(url)
+            if wait:
+                self.metrics.inc('throttle_wait_seconds', wait, endpoint=endpoint)  # noqa:E501
+            time.sleep(wait)
+            try:
+                token = self.credentials.token()
+
+                # resumable upload sessions hand back absolute urls
+                with self.metrics.span('api_request_seconds', endpoint=endpoint):  # noqa:E501
+                    response = self.session.request(
+                        verb,
+                        url if '://' in url else URL_BASE + url,
+                        headers={
+                            **headers,
+                            'Authorization': f'Bearer {token}'
+                        },
+                        **kwargs
+                    )
+                status_code = response.status_code
+                self.metrics.inc('api_requests', endpoint=endpoint, status=status_code)  # noqa:E501
+                if isinstance(kwargs.get('data'), FileBody):
+                    self.metrics.inc('upload_bytes', len(kwargs['data']))
+
+                # token revoked or expired early, refreshed once by all workers
+                if status_code == 401 and not reauthorized:
+                    self.credentials.refresh(token)
+                    reauthorized = True
+                    continue
+                if status_code < 200 or status_code > 300:
+                    raise HTTPError(
+                        status_code,
+                        verb,
+                        url,
+                        parse_retry_after(response.headers.get('Retry-After'))
+                    )
+                return response
+            except (HTTPError, requests.ConnectionError, requests.Timeout) as e:  # noqa:E501
+                if not isinstance(e, HTTPError):
+                    self.metrics.inc('api_requests', endpoint=endpoint, status='error')  # noqa:E501
+                delay = self.rate_limiter.retry_delay(attempt, e) if retry else None  # noqa:E501
+                if delay is None:
+                    raise
+                self.metrics.inc('api_retries', endpoint=endpoint)
+                time.sleep(delay)
+                attempt += 1
 
     def _generate_auth_token(self, filename):
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         flow = InstalledAppFlow.from_client_secrets_file(
             filename,
             scopes=APP_SCOPES
         )
         return flow.run_local_server()
-
-    def _get_creds_from_file(self, filename):
-        return Credentials.from_authorized_user_file(
-                filename,
-                APP_SCOPES
-        )
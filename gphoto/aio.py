@@ -0,0 +1,511 @@
+"""Asyncio API interface for google photos."""
+
+import asyncio
+import json
+import os
+
+import aiohttp
+
+from gphoto import BATCH_CREATE_RETRIES
+from gphoto import RESUMABLE_THRESHOLD
+from gphoto import UPLOAD_CHUNK_SIZE
+from gphoto import UPLOAD_TOKEN_MAX_AGE_HOURS
+from gphoto import URL_BASE
+from gphoto import api_endpoint
+from gphoto import batch_create_body
+from gphoto import journaled_matches
+from gphoto import record_batch_results
+from gphoto import resumable_chunk_size
+from gphoto import resumable_start_headers
+from gphoto import retryable_batch_items
+from gphoto.auth import CredentialManager
+from gphoto.schedule import BATCH_BYTES
+from gphoto.schedule import schedule_batches
+from gphoto.throttle import BANDWIDTH_CHUNK_SIZE
+from gphoto.throttle import BandwidthLimiter
+from gphoto.throttle import HTTPError
+from gphoto.throttle import RateLimiter
+from gphoto.throttle import parse_retry_after
+
+from metrics import Metrics
+
+
+async def file_chunks(filename, offset=0, length=None, chunk_size=UPLOAD_CHUNK_SIZE, pace=None):  # noqa:E501
+    """Read file one chunk at a time without blocking the event loop.
+
+    Args:
+        filename (str): full path filename locally on disk
+        offset (int): byte position in file to start from
+        length (int): bytes to read, defaults to rest of file
+        chunk_size (int): max bytes held in memory at once
+        pace (callable): awaited with size of each chunk before it is sent, e.g. to limit bandwidth
+
+    Yields:
+        bytes: next chunk of file
+    """  # noqa:E501
+    if length is None:
+        length = os.path.getsize(filename) - offset
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            chunk = await asyncio.to_thread(f.read, min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            if pace:
+                await pace(len(chunk))
+            yield chunk
+
+
+class AsyncResponse(object):
+    """Fully read response, with the parts of requests.Response used."""
+
+    def __init__(self, status_code, headers, content):
+        """Hold response after connection is released.
+
+        Args:
+            status_code (int): HTTP status code
+            headers (multidict.CIMultiDictProxy): response headers
+            content (bytes): response body
+        """
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        """Parse body as json."""
+        return json.loads(self.content)
+
+
+class AsyncClient(object):
+    """Session scoped asyncio client object, use as async context manager."""
+
+    session = None
+    credentials = None
+    workers = 1
+    upload_store = None
+    resumable_threshold = RESUMABLE_THRESHOLD
+    rate_limiter = None
+    bandwidth_limiter = None
+    metrics = None
+
+    def __init__(self, user_token_filename, workers=1, upload_store=None, resumable_threshold=RESUMABLE_THRESHOLD, rate_limiter=None, bandwidth_limiter=None, metrics=None):  # noqa:E501
+        """Create new authorized client.
+
+        Args:
+            user_token_filename (str): file to read user token, see Client to create it
+            workers (int): number of media uploads in flight at once
+            upload_store (database.DB): store to persist resumable upload progress and upload tokens in
+            resumable_threshold (int): file size in bytes to switch to resumable uploads
+            rate_limiter (gphoto.throttle.RateLimiter): pacing and retries shared by all workers
+            bandwidth_limiter (gphoto.throttle.BandwidthLimiter): upload bytes per second shared by all workers
+            metrics (metrics.Metrics): run metrics to time calls and count bytes into
+        """  # noqa:E501
+        if workers < 1:
+            raise ValueError('Invalid workers')
+        self.workers = workers
+        self.upload_store = upload_store
+        self.resumable_threshold = resumable_threshold
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.bandwidth_limiter = bandwidth_limiter or BandwidthLimiter()
+        self.metrics = metrics or Metrics()
+        self.credentials = CredentialManager(user_token_filename, metrics=self.metrics)  # noqa:E501
+
+    async def __aenter__(self):
+        """Open connection pool, must be called inside running loop."""
+        self.semaphore = asyncio.Semaphore(self.workers)
+        self.credentials.start()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.workers),
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=300)
+        )
+        return self
+
+    async def __aexit__(self, *args):
+        """Close connection pool."""
+        await self.session.close()
+        self.credentials.stop()
+
+    async def post_batch_media(self, filenames, to_album_id, batch_size=50, batch_bytes=BATCH_BYTES, order='scan', sources=None):  # noqa:E501
+        """Upload and register batch of media items.
+
+        Batches are registered as soon as all their files are uploaded, so
+        not necessarily in the order files were given.
+
+        Args:
+            filenames (iterable[str]): full path filenames locally on disk, consumed lazily
+            to_album_id (str): Google Photos album id
+            batch_size (int): max files to send in one batch
+            batch_bytes (int): max bytes to send in one batch, unless one file is larger
+            order (str): scan, smallest or oldest, see gphoto.schedule
+            sources (dict): files to send in place of others, e.g. downscaled copies, by filename
+
+        Yields:
+            dict: uploads results
+                key (str): Google Photos upload token
+                    - filename (str): full path filename uploaded
+                    - media_id (str): remote id created or missing on failure
+                    - status_code (int): google.rpc.Code of failure
+        """  # noqa:E501
+        if batch_size > 50 or batch_size < 1:
+            raise ValueError('Invalid batch_size')
+        if sources is None:
+            sources = {}
+        batches = schedule_batches(filenames, batch_size, batch_bytes, order, sources=sources)  # noqa:E501
+        if self.upload_store:
+            await asyncio.to_thread(
+                self.upload_store.delete_expired_upload_tokens,
+                UPLOAD_TOKEN_MAX_AGE_HOURS
+            )
+
+        # queue batches until every worker has a file waiting, e.g. while
+        # others send large files
+        pending = []
+
+        async def queue_batches():
+            while len(pending) < 2 or unfinished_count() < self.workers * 2:  # noqa:E501
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is None:
+                    return
+                pending.append([
+                    (filename, asyncio.ensure_future(self._upload_media(filename, to_album_id, sources.get(filename, filename))))  # noqa:E501
+                    for filename in batch
+                ])
+
+        def unfinished_count():
+            return sum(
+                not task.done()
+                for uploads in pending
+                for _, task in uploads
+            )
+
+        try:
+            await queue_batches()
+            while pending:
+                uploads = next(
+                    (x for x in pending if all(y.done() for _, y in x)),
+                    None
+                )
+                if uploads is None:
+                    await asyncio.wait(
+                        [y for x in pending for _, y in x if not y.done()],
+                        return_when=asyncio.FIRST_COMPLETED
+                    )
+                    await queue_batches()
+                    continue
+                pending.remove(uploads)
+                await queue_batches()
+                yield await self._create_batch_media(uploads, to_album_id)
+        finally:
+            for uploads in pending:
+                for _, task in uploads:
+                    task.cancel()
+
+    async def list_albums(self, exclude_non_app=True, page_size=50):
+        """View all albums user has access to.
+
+        Args:
+            exclude_non_app (bool): don't show albums not created by this app
+            page_size (int): batch size to fetch
+
+        Returns:
+            list[Album]: https://developers.google.com/photos/library/reference/rest/v1/albums#Album
+        """  # noqa:E501
+        if page_size > 50 or page_size < 1:
+            raise ValueError('Invalid page_size')
+        params = {
+            'pageSize': page_size,
+            'excludeNonAppCreatedData': str(exclude_non_app).lower()
+        }
+        results = []
+        while True:
+            response = await self._call('GET', 'v1/albums', params=params)
+            data = response.json()
+            albums_batch = data.get('albums', [])
+            results += albums_batch
+            if len(albums_batch) < page_size:
+                break
+            params['pageToken'] = data['nextPageToken']
+        return results
+
+    async def create_album(self, title):
+        """Make new album.
+
+        Args:
+            title (str): human readable name of album
+
+        Returns:
+            Album: https://developers.google.com/photos/library/reference/rest/v1/albums#Album
+        """  # noqa:E501
+        return await self._call(
+            'POST',
+            'v1/albums',
+            json={
+                'album': {
+                    'title': title
+                }
+            }
+        )
+
+    async def _upload_media(self, filename, to_album_id, source):
+
+        # bytes read from source, which differs when transformed first
+        stat = os.stat(source)
+
+        # bytes sent by an earlier run that never reached batchCreate,
+        # unless the file sent has changed since
+        if self.upload_store:
+            journaled = await asyncio.to_thread(
+                self.upload_store.select_upload_token,
+                filename,
+                to_album_id,
+                UPLOAD_TOKEN_MAX_AGE_HOURS
+            )
+            if journaled:
+                if journaled_matches(journaled, stat):
+                    return journaled['upload_token']
+                await asyncio.to_thread(
+                    self.upload_store.delete_upload_tokens,
+                    [journaled['upload_token']]
+                )
+
+        async with self.semaphore:
+            size = stat.st_size
+            if size > self.resumable_threshold:
+                upload_token = await self._upload_media_resumable(source, size)  # noqa:E501
+            else:
+                upload_token = await self._upload_media_simple(source, size)
+        if self.upload_store:
+            await asyncio.to_thread(
+                self.upload_store.insert_upload_token,
+                upload_token,
+                filename,
+                to_album_id,
+                stat.st_size,
+                stat.st_mtime_ns
+            )
+        return upload_token
+
+    async def _upload_media_simple(self, filename, size):
+        response = await self._call(
+            'POST',
+            'v1/uploads',
+            data=lambda: self._file_chunks(filename),
+            headers={
+                'Content-Length': str(size)
+            }
+        )
+        return response.content.decode()
+
+    async def _upload_media_resumable(self, filename, size):
+        session_url = None
+        offset = 0
+
+        # pick up from last acknowledged byte of previous session
+        saved = None
+        if self.upload_store:
+            saved = await asyncio.to_thread(
+                self.upload_store.select_upload_session,
+                filename
+            )
+        if saved and saved['size'] == size:
+            try:
+                response = await self._call(
+                    'POST',
+                    saved['session_url'],
+                    headers={
+                        'X-Goog-Upload-Command': 'query'
+                    }
+                )
+                if response.headers.get('X-Goog-Upload-Status') == 'active':
+                    session_url = saved['session_url']
+                    offset = int(response.headers['X-Goog-Upload-Size-Received'])  # noqa:E501
+            except Exception:
+                pass
+
+        # start new session
+        if not session_url:
+            response = await self._call(
+                'POST',
+                'v1/uploads',
+                headers=resumable_start_headers(filename)
+            )
+            session_url = response.headers['X-Goog-Upload-URL']
+            offset = 0
+            await self._save_upload_session(filename, size, session_url, offset)  # noqa:E501
+
+        # chunks must be a multiple of granularity, except for the last one
+        chunk_size = resumable_chunk_size(response.headers)
+
+        # send chunks, recording offset as each is acknowledged, a failed
+        # chunk may have partly arrived, so server is asked where to resume
+        attempt = 0
+        while True:
+            length = min(chunk_size, size - offset)
+            finalize = offset + length >= size
+            try:
+                response = await self._call(
+                    'POST',
+                    session_url,
+                    data=lambda: self._file_chunks(filename, offset=offset, length=length),  # noqa:E501
+                    headers={
+                        'Content-Length': str(length),
+                        'X-Goog-Upload-Command': 'upload, finalize' if finalize else 'upload',  # noqa:E501
+                        'X-Goog-Upload-Offset': str(offset)
+                    },
+                    retry=False
+                )
+            except (HTTPError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                delay = self.rate_limiter.retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                self.metrics.inc('api_retries', endpoint=api_endpoint(session_url))  # noqa:E501
+                await asyncio.sleep(delay)
+                attempt += 1
+                offset = await self._upload_offset(session_url, e)
+                await self._save_upload_session(filename, size, session_url, offset)  # noqa:E501
+                continue
+            if finalize:
+                break
+            offset += length
+            await self._save_upload_session(filename, size, session_url, offset)  # noqa:E501
+
+        if self.upload_store:
+            await asyncio.to_thread(
+                self.upload_store.delete_upload_session,
+                filename
+            )
+        return response.content.decode()
+
+    async def _upload_offset(self, session_url, error):
+        response = await self._call(
+            'POST',
+            session_url,
+            headers={
+                'X-Goog-Upload-Command': 'query'
+            }
+        )
+        if response.headers.get('X-Goog-Upload-Status') != 'active':
+            raise error
+        return int(response.headers['X-Goog-Upload-Size-Received'])
+
+    def _file_chunks(self, filename, offset=0, length=None):
+
+        # sent in small pieces when capped, so workers share bytes evenly
+        if not self.bandwidth_limiter.active:
+            return file_chunks(filename, offset=offset, length=length)
+        return file_chunks(
+            filename,
+            offset=offset,
+            length=length,
+            chunk_size=BANDWIDTH_CHUNK_SIZE,
+            pace=self._pace
+        )
+
+    async def _pace(self, size):
+        wait = self.bandwidth_limiter.reserve(size)
+        if wait:
+            self.metrics.inc('bandwidth_wait_seconds', wait)
+            await asyncio.sleep(wait)
+
+    async def _save_upload_session(self, filename, size, session_url, offset):  # noqa:E501
+        if self.upload_store:
+            await asyncio.to_thread(
+                self.upload_store.save_upload_session,
+                filename,
+                size,
+                session_url,
+                offset
+            )
+
+    async def _create_batch_media(self, uploads, to_album_id):
+
+        # wait for bytes to upload, record upload token by filename
+        upload_tokens = {}
+        for filename, task in uploads:
+            upload_tokens[await task] = {
+                'filename': filename
+            }
+
+        # register uploads into album, again for only items failing transiently
+        pending_tokens = upload_tokens
+        for attempt in range(BATCH_CREATE_RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(self.rate_limiter.retry_policy.delay(attempt - 1, None))  # noqa:E501
+            response = await self._call(
+                'POST',
+                'v1/mediaItems:batchCreate',
+                data=batch_create_body(pending_tokens, to_album_id)
+            )
+            record_batch_results(upload_tokens, response.json())
+            pending_tokens = retryable_batch_items(pending_tokens)
+            if not pending_tokens:
+                break
+
+        if self.upload_store:
+            await asyncio.to_thread(
+                self.upload_store.delete_upload_tokens,
+                list(upload_tokens.keys())
+            )
+        return upload_tokens
+
+    async def _call(self, verb, url, headers={}, data=None, retry=True, **kwargs):  # noqa:E501
+        endpoint = api_endpoint(url)
+        attempt = 0
+        reauthorized = False
+        while True:
+            wait = self.rate_limiter.reserve(url)
+            if wait:
+                self.metrics.inc('throttle_wait_seconds', wait, endpoint=endpoint)  # noqa:E501
+            await asyncio.sleep(wait)
+            try:
+                token = await self._token()
+
+                # resumable upload sessions hand back absolute urls
+                # streamed bodies are passed as factories, fresh per attempt
+                with self.metrics.span('api_request_seconds', endpoint=endpoint):  # noqa:E501
+                    async with self.session.request(
+                        verb,
+                        url if '://' in url else URL_BASE + url,
+                        headers={
+                            **headers,
+                            'Authorization': f'Bearer {token}'
+                        },
+                        data=data() if callable(data) else data,
+                        **kwargs
+                    ) as response:
+                        content = await response.read()
+                status_code = response.status
+                self.metrics.inc('api_requests', endpoint=endpoint, status=status_code)  # noqa:E501
+                if callable(data):
+                    self.metrics.inc('upload_bytes', int(headers['Content-Length']))  # noqa:E501
+
+                # token revoked or expired early, refreshed once by all workers
+                if status_code == 401 and not reauthorized:
+                    await asyncio.to_thread(self.credentials.refresh, token)
+                    reauthorized = True
+                    continue
+                if status_code < 200 or status_code > 300:
+                    raise HTTPError(
+                        status_code,
+                        verb,
+                        url,
+                        parse_retry_after(response.headers.get('Retry-After'))
+                    )
+                return AsyncResponse(status_code, response.headers, content)
+            except (HTTPError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not isinstance(e, HTTPError):
+                    self.metrics.inc('api_requests', endpoint=endpoint, status='error')  # noqa:E501
+                delay = self.rate_limiter.retry_delay(attempt, e) if retry else None  # noqa:E501
+                if delay is None:
+                    raise
+                self.metrics.inc('api_retries', endpoint=endpoint)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _token(self):
+
+        # refreshed in background ahead of expiry, so rarely blocks
+        if self.credentials.valid:
+            return self.credentials.token()
+        return await asyncio.to_thread(self.credentials.token)
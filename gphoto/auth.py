@@ -0,0 +1,197 @@
+"""OAuth user token shared by API clients, refreshed ahead of expiry."""
+
+import copy
+import datetime
+import json
+import os
+import tempfile
+import threading
+
+from metrics import Metrics
+
+APP_SCOPES = ['https://www.googleapis.com/auth/photoslibrary']
+
+# refresh this long before expiry, so calls never wait on it
+REFRESH_MARGIN_SECONDS = 10 * 60
+REFRESH_RETRY_SECONDS = 30
+REFRESH_CHECK_SECONDS = 60 * 60
+
+
+def load_credentials(filename):
+    """Read user token from file.
+
+    Args:
+        filename (str): file written by save_credentials
+
+    Returns:
+        google.oauth2.credentials.Credentials: user token, maybe expired
+
+    Raises:
+        FileNotFoundError, json.decoder.JSONDecodeError, ValueError: no usable token in file
+    """  # noqa:E501
+    from google.oauth2.credentials import Credentials
+
+    return Credentials.from_authorized_user_file(filename, APP_SCOPES)
+
+
+def save_credentials(credentials, filename):
+    """Write user token with its expiry, replacing file atomically.
+
+    Args:
+        credentials (google.oauth2.credentials.Credentials): user token
+        filename (str): file to replace
+    """
+    data = {
+        prop: getattr(credentials, prop)
+        for prop in [
+            'token',
+            'refresh_token',
+            'scopes',
+            'token_uri',
+            'client_id',
+            'client_secret'
+        ]
+    }
+    if credentials.expiry:
+        data['expiry'] = credentials.expiry.isoformat() + 'Z'
+
+    # concurrent runs never read a partly written token, owner only access
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)),
+        prefix='.tmp-'
+    )
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(data))
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+
+
+class CredentialManager(object):
+    """One user token for every worker, refreshed in background before expiry.
+
+    Reading the token never takes the lock, so workers only wait when it has
+    actually expired. Refreshed tokens replace the old ones whole, and are
+    saved, so later runs start valid.
+    """
+
+    filename = None
+    credentials = None
+    refresh_margin = REFRESH_MARGIN_SECONDS
+    metrics = None
+
+    def __init__(self, user_token_filename, refresh_margin=REFRESH_MARGIN_SECONDS, metrics=None):  # noqa:E501
+        """Load user token.
+
+        Args:
+            user_token_filename (str): file to read user token from and save refreshed ones to
+            refresh_margin (float): seconds before expiry to refresh in background
+            metrics (metrics.Metrics): run metrics to count refreshes into
+
+        Raises:
+            FileNotFoundError, json.decoder.JSONDecodeError, ValueError: no usable token in file
+        """  # noqa:E501
+        self.filename = user_token_filename
+        self.credentials = load_credentials(user_token_filename)
+        self.refresh_margin = refresh_margin
+        self.metrics = metrics or Metrics()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def valid(self):
+        """If token can be sent without refreshing first."""
+        return self.credentials.valid
+
+    def token(self):
+        """Access token, refreshing first only if it expired.
+
+        Returns:
+            str: bearer token to authorize API call with
+        """
+        credentials = self.credentials
+        if credentials.valid:
+            return credentials.token
+        self.refresh(credentials.token)
+        return self.credentials.token
+
+    def refresh(self, stale_token):
+        """Replace token, unless another worker already did.
+
+        Args:
+            stale_token (str): token caller found expired or rejected
+        """
+        with self.lock:
+            if self.credentials.token != stale_token:
+                return
+
+            # another process may have refreshed and saved it already
+            try:
+                saved = load_credentials(self.filename)
+                if saved.token != stale_token and saved.valid:
+                    self.credentials = saved
+                    return
+            except (FileNotFoundError, json.decoder.JSONDecodeError, ValueError):  # noqa:E501
+                pass
+
+            from google.auth.transport.requests import Request
+
+            credentials = copy.copy(self.credentials)
+            with self.metrics.span('auth_refresh_seconds'):
+                credentials.refresh(Request())
+            self.credentials = credentials
+            try:
+                save_credentials(self.credentials, self.filename)
+            except OSError:
+                # read only token file, refreshed token is still used this run
+                pass
+
+    def start(self):
+        """Refresh in background thread from now on."""
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._refresh_ahead,
+                name='gphoto-auth',
+                daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        """End background refreshes."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _refresh_ahead(self):
+        delay = 0
+        while not self.stopped.wait(delay):
+            credentials = self.credentials
+            due = self._seconds_until_due(credentials)
+
+            # checked again at least hourly, e.g. tokens without expiry
+            if due is None or due > 0:
+                delay = min(REFRESH_CHECK_SECONDS, due or REFRESH_CHECK_SECONDS)  # noqa:E501
+                continue
+            try:
+                self.refresh(credentials.token)
+                delay = 0
+            except Exception:
+                # workers refresh on demand if this keeps failing
+                delay = REFRESH_RETRY_SECONDS
+
+            # tokens shorter lived than margin would refresh back to back
+            if self._seconds_until_due(self.credentials) == 0:
+                delay = REFRESH_RETRY_SECONDS
+
+    def _seconds_until_due(self, credentials):
+        if credentials.expiry is None:
+            return None
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)  # noqa:E501
+        return max(
+            0.0,
+            (credentials.expiry - now).total_seconds() - self.refresh_margin
+        )
@@ -0,0 +1,89 @@
+"""Group files into upload batches by count and bytes."""
+
+import os
+
+# bytes of media registered per batchCreate, bounding work lost to a crash
+BATCH_BYTES = 256 * 1024 * 1024
+
+# upcoming files considered at once when ordering, so input stays streamed
+ORDER_WINDOW = 200
+
+ORDERS = ['scan', 'smallest', 'oldest']
+
+
+def schedule_batches(filenames, batch_size=50, batch_bytes=BATCH_BYTES, order='scan', window=ORDER_WINDOW, sources=None):  # noqa:E501
+    """Cut files into batches, interleaving large files with small ones.
+
+    Files over a quarter of batch_bytes get a batch of their own, spread
+    evenly between batches of small files, so workers are not all tied up
+    with large files at once and small batches keep committing meanwhile.
+
+    Args:
+        filenames (iterable[str]): full path filenames locally on disk, consumed lazily
+        batch_size (int): max files per batch
+        batch_bytes (int): max bytes per batch, unless one file is larger
+        order (str): scan as found, smallest first, or oldest modified first
+        window (int): upcoming files ordered together
+        sources (dict): files sent in place of others, sized instead, by filename
+
+    Yields:
+        list[str]: full path filenames of next batch
+    """  # noqa:E501
+    if order not in ORDERS:
+        raise ValueError('Invalid order')
+    pending = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        size = stat.st_size
+        if sources and filename in sources:
+            size = os.path.getsize(sources[filename])
+        pending.append((filename, size, stat.st_mtime))
+        if len(pending) >= window:
+            yield from _window_batches(pending, batch_size, batch_bytes, order)
+            pending = []
+    yield from _window_batches(pending, batch_size, batch_bytes, order)
+
+
+def _window_batches(files, batch_size, batch_bytes, order):
+    if order == 'smallest':
+        files = sorted(files, key=lambda x: x[1])
+    elif order == 'oldest':
+        files = sorted(files, key=lambda x: x[2])
+
+    # pack small files by count and bytes, large ones alone
+    small_batches = []
+    large_batches = []
+    batch = []
+    size = 0
+    for filename, file_size, _ in files:
+        if file_size > batch_bytes // 4:
+            large_batches.append([filename])
+            continue
+        if batch and (len(batch) >= batch_size or size + file_size > batch_bytes):  # noqa:E501
+            small_batches.append(batch)
+            batch = []
+            size = 0
+        batch.append(filename)
+        size += file_size
+    if batch:
+        small_batches.append(batch)
+
+    # smallest first is asked to commit as much as possible early on
+    if order == 'smallest':
+        yield from small_batches
+        yield from large_batches
+        return
+
+    # large ones start first, then one every so many small batches
+    small_index = 0
+    large_index = 0
+    while small_index < len(small_batches) or large_index < len(large_batches):  # noqa:E501
+        if large_index < len(large_batches) and (
+            small_index == len(small_batches)
+            or large_index * len(small_batches) <= small_index * len(large_batches)  # noqa:E501
+        ):
+            yield large_batches[large_index]
+            large_index += 1
+        else:
+            yield small_batches[small_index]
+            small_index += 1
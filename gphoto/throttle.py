@@ -0,0 +1,352 @@
+"""Retry and rate limit policy shared by API clients."""
+
+import random
+import re
+import threading
+import time
+
+# https://developers.google.com/photos/library/guides/api-limits-quotas
+REQUESTS_PER_MINUTE = 6000
+DAILY_BATCH_CREATE = 10000
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+# daily quotas reset at midnight pacific time, standard time offset is used
+# so the day rolls over an hour late during daylight saving
+QUOTA_UTC_OFFSET_HOURS = -8
+
+# upload bodies are paced in small pieces, bursting at most this long
+BANDWIDTH_CHUNK_SIZE = 64 * 1024
+BANDWIDTH_BURST_SECONDS = 0.5
+
+# e.g. 20MB/s, 512KiB, 1e6
+RATE_PATTERN = re.compile(r'^(\d+(?:\.\d*)?(?:e\d+)?)\s*([kmg]i?)?b?(?:/s)?$', re.IGNORECASE)  # noqa:E501
+RATE_UNITS = {
+    '': 1,
+    'k': 1000,
+    'm': 1000 ** 2,
+    'g': 1000 ** 3,
+    'ki': 1024,
+    'mi': 1024 ** 2,
+    'gi': 1024 ** 3
+}
+
+# e.g. 09:00-18:00=2MB/s, may run past midnight
+RATE_WINDOW_PATTERN = re.compile(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)$')  # noqa:E501
+
+
+class HTTPError(Exception):
+    """Unexpected HTTP status from API."""
+
+    def __init__(self, status_code, verb, url, retry_after=None):
+        """Describe failed call.
+
+        Args:
+            status_code (int): HTTP status code
+            verb (str): HTTP method called
+            url (str): path or url called
+            retry_after (float): seconds server asked to wait, if any
+        """
+        super().__init__(f'Unexpected HTTP code "{status_code}" @ "{verb} {url}"')  # noqa:E501
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class QuotaExceeded(Exception):
+    """Local count of daily quota used up, stop before API rejects calls."""
+
+
+def quota_day(timestamp=None):
+    """Date daily quotas are counted against, as YYYY-MM-DD."""
+    if timestamp is None:
+        timestamp = time.time()
+    return time.strftime(
+        '%Y-%m-%d',
+        time.gmtime(timestamp + QUOTA_UTC_OFFSET_HOURS * 60 * 60)
+    )
+
+
+def parse_retry_after(value):
+    """Seconds to wait from Retry-After header, as delta or HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())  # noqa:E501
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_rate(value):
+    """Bytes per second from human readable rate.
+
+    Args:
+        value (str): number of bytes per second, with optional unit, e.g. 20MB/s or 512KiB/s
+
+    Returns:
+        float: bytes per second
+
+    Raises:
+        ValueError: not a rate above zero
+    """  # noqa:E501
+    match = RATE_PATTERN.match(value.strip())
+    if not match or not float(match.group(1)):
+        raise ValueError(f'Invalid rate "{value}"')
+    return float(match.group(1)) * RATE_UNITS[(match.group(2) or '').lower()]
+
+
+def parse_rate_window(value):
+    """Time of day window and its rate cap.
+
+    Args:
+        value (str): local start and end time with rate, e.g. 09:00-18:00=2MB/s
+
+    Returns:
+        tuple(int, int, float): start and end minute of day, bytes per second
+
+    Raises:
+        ValueError: not a valid window
+    """  # noqa:E501
+    match = RATE_WINDOW_PATTERN.match(value.strip())
+    if not match:
+        raise ValueError(f'Invalid rate window "{value}"')
+    start_hour, start_minute, end_hour, end_minute = (
+        int(x)
+        for x in match.groups()[:4]
+    )
+    if max(start_hour, end_hour) > 23 or max(start_minute, end_minute) > 59:
+        raise ValueError(f'Invalid rate window "{value}"')
+    start = start_hour * 60 + start_minute
+    end = end_hour * 60 + end_minute
+    if start == end:
+        raise ValueError(f'Invalid rate window "{value}"')
+    return start, end, parse_rate(match.group(5))
+
+
+class RetryPolicy(object):
+    """Exponential backoff with full jitter, honouring Retry-After."""
+
+    def __init__(self, max_retries=5, base_delay=1, max_delay=60):
+        """Configure backoff.
+
+        Args:
+            max_retries (int): attempts after the first before giving up
+            base_delay (float): seconds to wait before first retry, doubled each time
+            max_delay (float): cap on seconds between attempts
+        """  # noqa:E501
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, attempt, error):
+        """If failed attempt, starting from 0, is worth repeating."""
+        if attempt >= self.max_retries:
+            return False
+        if isinstance(error, HTTPError):
+            return error.status_code in RETRY_STATUS_CODES
+        return True
+
+    def delay(self, attempt, error):
+        """Seconds to wait before next attempt."""
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))  # noqa:E501
+
+
+class RateLimiter(object):
+    """Token bucket over all API calls, plus daily batchCreate budget.
+
+    Thread safe, calls reserve a slot and are told how long to wait for it,
+    so the same limiter can pace threads and asyncio tasks alike. The daily
+    budget is counted in the quota store when given, shared by every run
+    and process on the same day, otherwise over the last 24 hours of this
+    process.
+    """
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, daily_batch_create=DAILY_BATCH_CREATE, retry_policy=None, quota_store=None):  # noqa:E501
+        """Configure limits.
+
+        Args:
+            requests_per_minute (int): sustained API calls allowed per minute
+            daily_batch_create (int): batchCreate calls allowed per day
+            retry_policy (RetryPolicy): backoff for failed calls
+            quota_store (database.DB): store to count daily calls in
+        """
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.daily_batch_create = daily_batch_create
+        self.batch_create_calls = []
+        self.quota_store = quota_store
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.lock = threading.Lock()
+        self.counters = {
+            'requests': 0,
+            'retries': 0,
+            'throttle_waits': 0,
+            'throttle_wait_seconds': 0.0
+        }
+
+    def reserve(self, url):
+        """Take slot for next call, counting against quotas.
+
+        Args:
+            url (str): path or url about to be called
+
+        Returns:
+            float: seconds caller must wait before sending
+        """
+        with self.lock:
+            now = time.monotonic()
+            if 'mediaItems:batchCreate' in url:
+                self._reserve_daily(now)
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            self.counters['requests'] += 1
+            if self.tokens >= 0:
+                return 0.0
+            wait = -self.tokens / self.rate
+            self.counters['throttle_waits'] += 1
+            self.counters['throttle_wait_seconds'] += wait
+            return wait
+
+    def retry_delay(self, attempt, error):
+        """Seconds to wait before retrying, None if call should fail.
+
+        Args:
+            attempt (int): failed attempts so far, minus one
+            error (Exception): reason attempt failed
+
+        Returns:
+            float: seconds to back off, or None to give up
+        """
+        if not self.retry_policy.should_retry(attempt, error):
+            return None
+        delay = self.retry_policy.delay(attempt, error)
+        with self.lock:
+            self.counters['retries'] += 1
+
+            # throttled, hold back every worker rather than just this one
+            if getattr(error, 'status_code', None) == 429:
+                self.tokens = min(self.tokens, -delay * self.rate)
+                return 0.0
+        return delay
+
+    def _reserve_daily(self, now):
+        if self.quota_store:
+            if not self.quota_store.reserve_quota('batchCreate', quota_day(), self.daily_batch_create):  # noqa:E501
+                raise QuotaExceeded(
+                    f'Daily batchCreate budget of {self.daily_batch_create} used, resets at midnight Pacific time'  # noqa:E501
+                )
+            return
+        day_ago = now - 24 * 60 * 60
+        self.batch_create_calls = [
+            x
+            for x in self.batch_create_calls
+            if x > day_ago
+        ]
+        if len(self.batch_create_calls) >= self.daily_batch_create:
+            raise QuotaExceeded(
+                f'Daily batchCreate budget of {self.daily_batch_create} used'
+            )
+        self.batch_create_calls.append(now)
+
+
+class BandwidthLimiter(object):
+    """Token bucket over bytes of all upload bodies, capped by time of day.
+
+    Thread safe like RateLimiter, bodies reserve each piece they send and
+    are told how long to wait for it. Every worker draws from one bucket,
+    so workers busy elsewhere leave their share to the others, and a new
+    cap applies to the next piece sent once its window starts.
+    """
+
+    def __init__(self, max_rate=None, windows=()):
+        """Configure caps.
+
+        Args:
+            max_rate (float): bytes per second outside windows, None for no cap
+            windows (list[tuple(int, int, float)]): local start and end minute of day with bytes per second, first match applies, see parse_rate_window
+        """  # noqa:E501
+        if max_rate is not None and max_rate <= 0:
+            raise ValueError('Invalid max_rate')
+        for start, end, rate in windows:
+            if not 0 <= start < 24 * 60 or not 0 <= end < 24 * 60 or rate <= 0:  # noqa:E501
+                raise ValueError('Invalid windows')
+        self.max_rate = max_rate
+        self.windows = list(windows)
+        self.rate = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.counters = {
+            'waits': 0,
+            'wait_seconds': 0.0
+        }
+
+    @property
+    def active(self):
+        """If any cap is set, otherwise bodies need no pacing."""
+        return self.max_rate is not None or bool(self.windows)
+
+    def rate_at(self, local_time):
+        """Bytes per second allowed at time of day, None for no cap.
+
+        Args:
+            local_time (time.struct_time): local time, e.g. time.localtime()
+        """
+        minute = local_time.tm_hour * 60 + local_time.tm_min
+        for start, end, rate in self.windows:
+            if start <= minute < end or (
+                end < start and (minute >= start or minute < end)
+            ):
+                return rate
+        return self.max_rate
+
+    def reserve(self, size):
+        """Take bytes for next piece of body.
+
+        Args:
+            size (int): bytes about to be sent
+
+        Returns:
+            float: seconds caller must wait before sending
+        """
+        rate = self.rate_at(time.localtime())
+        with self.lock:
+            now = time.monotonic()
+
+            # bucket starts full whenever a cap starts or changes
+            if rate != self.rate:
+                self.rate = rate
+                self.tokens = self._capacity(rate)
+            elif rate is not None:
+                self.tokens = min(
+                    self._capacity(rate),
+                    self.tokens + (now - self.updated) * rate
+                )
+            self.updated = now
+            if rate is None:
+                return 0.0
+            self.tokens -= size
+            if self.tokens >= 0:
+                return 0.0
+            wait = -self.tokens / rate
+            self.counters['waits'] += 1
+            self.counters['wait_seconds'] += wait
+            return wait
+
+    def _capacity(self, rate):
+        if rate is None:
+            return 0.0
+        return max(BANDWIDTH_CHUNK_SIZE, rate * BANDWIDTH_BURST_SECONDS)
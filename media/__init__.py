@@ -0,0 +1,196 @@
+"""Local media file helpers."""
+
+import hashlib
+import os
+from collections import deque
+
+from gphoto import valid_photo_ext
+from gphoto import valid_video_ext
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(filename, chunk_size=HASH_CHUNK_SIZE):
+    """Digest file contents without reading it all into memory.
+
+    Args:
+        filename (str): full path filename locally on disk
+        chunk_size (int): bytes to read at once
+
+    Returns:
+        str: hex sha256 of file contents
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_files(filenames, workers=None):
+    """Digest files in parallel processes as they arrive.
+
+    Args:
+        filenames (iterable[str]): full path filenames locally on disk
+        workers (int): processes to hash with, defaults to cpu count
+
+    Yields:
+        tuple(str, str): filename and hex sha256 of contents, in input order
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for filename in filenames:
+            yield filename, hash_file(filename)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # bounded window of files in flight, so input is consumed lazily
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for filename in filenames:
+            pending.append((filename, executor.submit(hash_file, filename)))
+            if len(pending) >= workers * 4:
+                filename, future = pending.popleft()
+                yield filename, future.result()
+        while pending:
+            filename, future = pending.popleft()
+            yield filename, future.result()
+
+
+def media_dirs(root):
+    """Find directories holding media files, and which of them are leaves.
+
+    Hidden directories, e.g. thumbnail caches, are not counted as sub
+    directories nor searched.
+
+    Args:
+        root (str): full path of directory locally on disk
+
+    Yields:
+        tuple(str, bool): full path of each directory holding media files, and if it has no sub directories, sorted by path
+    """  # noqa:E501
+    sub_dirs = []
+    has_media = False
+    with os.scandir(root) as it:
+        for item in sorted(it, key=lambda x: x.name):
+            if item.is_dir(follow_symlinks=False):
+                if not item.name.startswith('.'):
+                    sub_dirs.append(item.path)
+            elif not has_media and item.is_file() \
+                    and (valid_photo_ext(item.name) or valid_video_ext(item.name)):  # noqa:E501
+                has_media = True
+    if has_media:
+        yield root, not sub_dirs
+    for sub_dir in sub_dirs:
+        yield from media_dirs(sub_dir)
+
+
+class DirScanner(object):
+    """Find new or changed media files using cached scan state."""
+
+    db = None
+    album_id = None
+    recursive = False
+    invalid = 0
+
+    def __init__(self, db, album_id, recursive=False):
+        """Create scanner for uploads into one album.
+
+        Args:
+            db (database.DB): store scan state is cached in
+            album_id (int): db id of album files are uploaded into
+            recursive (bool): descend into sub directories
+        """
+        self.db = db
+        self.album_id = album_id
+        self.recursive = recursive
+        self.invalid = 0
+
+    def scan(self, local_dir):
+        """List media files not yet uploaded from directory.
+
+        Directories whose mtime is unchanged since every file in them was
+        uploaded are not listed again, only their sub directories visited.
+
+        Args:
+            local_dir (str): full path of directory locally on disk
+
+        Yields:
+            str: full path filenames of new or changed media files
+        """
+        stat = os.stat(local_dir)
+        cached = self.db.select_scan_entry(self.album_id, local_dir)
+        if cached and cached['status'] == 'done' \
+                and cached['mtime_ns'] == stat.st_mtime_ns \
+                and cached['inode'] == stat.st_ino:
+            self.invalid += self.db.count_scan_invalid(self.album_id, local_dir)  # noqa:E501
+            if self.recursive:
+                for child in self.db.select_scan_children(self.album_id, local_dir, dirs_only=True):  # noqa:E501
+                    try:
+                        yield from self.scan(child['path'])
+                    except FileNotFoundError:
+                        self.db.delete_scan_entries(self.album_id, [child['path']])  # noqa:E501
+            return
+
+        # directory changed, compare each entry to cached state
+        known = {
+            x['path']: x
+            for x in self.db.select_scan_children(self.album_id, local_dir)
+        }
+        entries = [
+            self._entry(local_dir, os.path.dirname(local_dir), stat, True, 'pending')  # noqa:E501
+        ]
+        candidates = []
+        sub_dirs = []
+        with os.scandir(local_dir) as it:
+            for item in sorted(it, key=lambda x: x.name):
+                cached = known.pop(item.path, None)
+                if item.is_dir(follow_symlinks=False):
+                    sub_dirs.append(item.path)
+                    if not cached:
+                        entries.append(
+                            self._entry(item.path, local_dir, None, True, 'pending')  # noqa:E501
+                        )
+                    continue
+                if not item.is_file():
+                    continue
+                item_stat = item.stat()
+                if not (valid_photo_ext(item.name) or valid_video_ext(item.name)):  # noqa:E501
+                    self.invalid += 1
+                    entries.append(
+                        self._entry(item.path, local_dir, item_stat, False, 'invalid')  # noqa:E501
+                    )
+                    continue
+                if cached and cached['status'] == 'uploaded' \
+                        and cached['size'] == item_stat.st_size \
+                        and cached['mtime_ns'] == item_stat.st_mtime_ns \
+                        and cached['inode'] == item_stat.st_ino:
+                    continue
+                entries.append(
+                    self._entry(item.path, local_dir, item_stat, False, 'pending')  # noqa:E501
+                )
+                candidates.append(item.path)
+
+        # save state before yielding, forgetting entries removed from disk
+        self.db.delete_scan_entries(self.album_id, list(known.keys()))
+        self.db.save_scan_entries(entries)
+        yield from candidates
+        if self.recursive:
+            for sub_dir in sub_dirs:
+                yield from self.scan(sub_dir)
+
+    def _entry(self, path, parent, stat, is_dir, status):
+        return {
+            'album_id': self.album_id,
+            'path': path,
+            'parent': parent,
+            'is_dir': int(is_dir),
+            'size': stat.st_size if stat and not is_dir else None,
+            'mtime_ns': stat.st_mtime_ns if stat else None,
+            'inode': stat.st_ino if stat else None,
+            'status': status
+        }
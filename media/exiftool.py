@@ -0,0 +1,371 @@
+"""Tag copies of media with exiftool processes kept open between files."""
+
+import hashlib
+import json
+import os
+import select
+import shutil
+import tempfile
+import threading
+from collections import deque
+
+from gphoto import valid_video_ext
+
+# https://exiftool.org/exiftool_pod.html#stay_open-FLAG
+EXIFTOOL = 'exiftool'
+TAG_BATCH_SIZE = 50
+READ_SIZE = 64 * 1024
+
+# tags google photos reads, see exif_notes/README.md
+TAG_NAMES = ('date', 'offset', 'latitude', 'longitude')
+
+
+def tag_args(filename, tags):
+    """Arguments setting date, time zone and location the way google photos reads them.
+
+    Args:
+        filename (str): media file, photo and video tags differ
+        tags (dict): values to set, any of
+            - date (str): local time, e.g. 2021:07:12 12:03:24
+            - offset (str): time zone of date, e.g. +07:00, photos only
+            - latitude (float): decimal degrees, negative south
+            - longitude (float): decimal degrees, negative west
+
+    Returns:
+        list[str]: exiftool arguments
+    """  # noqa:E501
+    args = []
+    if 'date' in tags:
+        args.append(f'-ModifyDate={tags["date"]}')
+    has_gps = 'latitude' in tags and 'longitude' in tags
+    if valid_video_ext(filename):
+
+        # videos are localized by location, more than 4 decimals may not work
+        if has_gps:
+            args.append(
+                f'-Keys:GPSCoordinates={tags["latitude"]:.4f}, {tags["longitude"]:.4f}, 0'  # noqa:E501
+            )
+        return args
+    if 'offset' in tags:
+        args.append(f'-OffsetTimeDigitized={tags["offset"]}')
+    if has_gps:
+        args += [
+            f'-GPSLatitude={abs(tags["latitude"])}',
+            f'-GPSLatitudeRef={"N" if tags["latitude"] >= 0 else "S"}',
+            f'-GPSLongitude={abs(tags["longitude"])}',
+            f'-GPSLongitudeRef={"E" if tags["longitude"] >= 0 else "W"}'
+        ]
+    return args
+
+
+def validate_tags(tags):
+    """Check values of one file can be passed to exiftool.
+
+    Args:
+        tags (dict): values to set, see tag_args
+
+    Raises:
+        ValueError: unknown name or bad value
+    """
+    for name, value in tags.items():
+        if name not in TAG_NAMES:
+            raise ValueError(f'Invalid tag "{name}"')
+        if name in ('latitude', 'longitude'):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):  # noqa:E501
+                raise ValueError(f'Invalid {name} "{value}"')
+        elif not isinstance(value, str) or '\n' in value:
+            raise ValueError(f'Invalid {name} "{value}"')
+
+
+class ExifTool(object):
+    """One exiftool process, running commands read from stdin until closed."""
+
+    executable = EXIFTOOL
+    process = None
+
+    def __init__(self, executable=EXIFTOOL):
+        """Start process.
+
+        Args:
+            executable (str): exiftool command or full path
+
+        Raises:
+            FileNotFoundError: exiftool not installed
+        """
+        import subprocess
+
+        self.executable = executable
+        self.process = subprocess.Popen(
+            [executable, '-stay_open', 'True', '-@', '-'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        self.sequence = 0
+
+    def execute(self, commands):
+        """Run commands in order, sent together to save round trips.
+
+        Input is written as output is read, so neither side blocks on a
+        full pipe however many commands are sent.
+
+        Args:
+            commands (list[list[str]]): arguments of each command, without newlines
+
+        Returns:
+            list[tuple(str, str)]: stdout and stderr of each command
+        """  # noqa:E501
+        markers = []
+        data = bytearray()
+        for args in commands:
+            self.sequence += 1
+            marker = f'{{ready{self.sequence}}}'
+            markers.append(marker.encode())
+
+            # stderr gets marker too, echoed once command is done
+            data += '\n'.join(
+                args + ['-echo4', marker, f'-execute{self.sequence}']
+            ).encode() + b'\n'
+
+        stdin = self.process.stdin.fileno()
+        stdout = self.process.stdout.fileno()
+        stderr = self.process.stderr.fileno()
+        buffers = {stdout: bytearray(), stderr: bytearray()}
+        results = []
+        while len(results) < len(markers):
+            writers = [stdin] if data else []
+            readable, writable, _ = select.select(list(buffers), writers, [])
+            if writable:
+                written = os.write(stdin, data[:select.PIPE_BUF])
+                del data[:written]
+            for fd in readable:
+                chunk = os.read(fd, READ_SIZE)
+                if not chunk:
+                    raise OSError(f'{self.executable} exited unexpectedly')
+                buffers[fd] += chunk
+
+            # commands finish in order, collect each once both streams end
+            while len(results) < len(markers):
+                marker = markers[len(results)]
+                out_end = buffers[stdout].find(marker)
+                err_end = buffers[stderr].find(marker)
+                if out_end < 0 or err_end < 0:
+                    break
+                results.append((
+                    buffers[stdout][:out_end].decode(errors='replace'),
+                    buffers[stderr][:err_end].decode(errors='replace')
+                ))
+                del buffers[stdout][:out_end + len(marker)]
+                del buffers[stderr][:err_end + len(marker)]
+        return results
+
+    def close(self):
+        """Ask process to exit and wait for it."""
+        try:
+            self.process.stdin.write(b'-stay_open\nFalse\n')
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+        self.process.stdout.close()
+        self.process.stderr.close()
+
+
+class Tagger(object):
+    """Tagged copies of media on disk, written by a pool of exiftool processes."""  # noqa:E501
+
+    cache_dir = None
+    tags = None
+    executable = EXIFTOOL
+    workers = 1
+
+    def __init__(self, cache_dir, tags, executable=EXIFTOOL, workers=1):
+        """Create tagger for one set of values.
+
+        Args:
+            cache_dir (str): directory to keep tagged copies in, created if missing
+            tags (dict): values to set, see tag_args, by full path filename
+            executable (str): exiftool command or full path
+            workers (int): exiftool processes to run at once
+        """  # noqa:E501
+        if workers < 1:
+            raise ValueError('Invalid workers')
+        self.cache_dir = cache_dir
+        self.tags = tags
+        self.executable = executable
+        self.workers = workers
+
+    def tag(self, filenames, content_hashes, sources=None):
+        """Tag copies of files as they arrive, in batches per process.
+
+        Originals are never changed. Files without tags pass straight
+        through, as do files tagged by earlier runs with the same values.
+
+        Args:
+            filenames (iterable[str]): full path filenames locally on disk
+            content_hashes (dict): hashes of files, by filename
+            sources (dict): files to tag in place of others, e.g. downscaled copies, by filename
+
+        Yields:
+            tuple(str, str, str): filename, file to upload instead or None to upload original, and error if tagging failed, in input order
+        """  # noqa:E501
+        if sources is None:
+            sources = {}
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        processes = deque()
+        lock = threading.Lock()
+
+        def run(batch):
+            with lock:
+                process = processes.popleft() if processes else None
+            try:
+                if process is None:
+                    process = ExifTool(self.executable)
+                return self._run(process, batch)
+            except OSError:
+                # process died, files are retried one by one in new ones,
+                # so only files that kill it again fail
+                process = _discard(process)
+                results = []
+                for entry in batch:
+                    try:
+                        if process is None:
+                            process = ExifTool(self.executable)
+                        results += self._run(process, [entry])
+                    except OSError as e:
+                        process = _discard(process)
+                        results.append((None, f'exiftool failed, {e}'))
+                return results
+            finally:
+                if process is not None:
+                    with lock:
+                        processes.append(process)
+
+        # bounded window of files in flight, so input is consumed lazily,
+        # each waiting on its batch unless it needs no exiftool run
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        pending = deque()
+        batch = []
+
+        def submit():
+            future = executor.submit(run, [
+                (x['filename'], x['source'], x['cache_filename'])
+                for x in batch
+            ])
+            for index, x in enumerate(batch):
+                x['future'] = future
+                x['index'] = index
+            batch.clear()
+
+        def result(entry):
+            if entry['result'] is None:
+                if 'future' not in entry:
+                    submit()
+                entry['result'] = entry['future'].result()[entry['index']]
+            return (entry['filename'], *entry['result'])
+
+        try:
+            for filename in filenames:
+                entry = {
+                    'filename': filename,
+                    'source': sources.get(filename, filename),
+                    'result': None
+                }
+                tags = self.tags.get(filename)
+                if not tags:
+                    entry['result'] = (
+                        entry['source'] if entry['source'] != filename else None,  # noqa:E501
+                        None
+                    )
+                else:
+                    entry['cache_filename'] = self._filename(
+                        filename,
+                        content_hashes[filename],
+                        entry['source'],
+                        tags
+                    )
+                    if _touch(entry['cache_filename']):
+                        entry['result'] = (entry['cache_filename'], None)
+                    else:
+                        batch.append(entry)
+                        if len(batch) >= TAG_BATCH_SIZE:
+                            submit()
+                pending.append(entry)
+                while pending and (
+                    pending[0]['result'] is not None
+                    or len(pending) >= self.workers * TAG_BATCH_SIZE * 2
+                ):
+                    yield result(pending.popleft())
+            while pending:
+                yield result(pending.popleft())
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            for process in processes:
+                process.close()
+
+    def _run(self, process, batch):
+
+        # written under temporary names, so only complete copies are cached
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            commands = []
+            tmp_filenames = []
+            for index, (filename, source, cache_filename) in enumerate(batch):
+                _, ext = os.path.splitext(cache_filename)
+                tmp_filenames.append(os.path.join(tmp_dir, f'{index}{ext}'))
+                commands.append(
+                    tag_args(filename, self.tags[filename])
+                    + ['-o', tmp_filenames[-1], source]
+                )
+            results = []
+            for (filename, source, cache_filename), tmp_filename, (stdout, stderr) in zip(  # noqa:E501
+                batch,
+                tmp_filenames,
+                process.execute(commands)
+            ):
+                errors = [
+                    x.strip()
+                    for x in stderr.splitlines()
+                    if x.startswith('Error')
+                ]
+                if errors or not os.path.exists(tmp_filename):
+                    results.append((None, errors[0] if errors else stdout.strip() or 'no file written'))  # noqa:E501
+                    continue
+                os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+                os.replace(tmp_filename, cache_filename)
+                results.append((cache_filename, None))
+            return results
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _filename(self, filename, content_hash, source, tags):
+
+        # keyed by contents, any transform applied first, and values set
+        digest = hashlib.sha256(json.dumps(
+            [os.path.basename(source) if source != filename else None, tags],
+            sort_keys=True
+        ).encode()).hexdigest()[:16]
+        _, ext = os.path.splitext(filename)
+        return os.path.join(
+            self.cache_dir,
+            content_hash[:2],
+            f'{content_hash}-tags-{digest}{ext.lower()}'
+        )
+
+
+def _touch(filename):
+    """Mark cached copy used, see media.transform.prune_cache, False if missing."""  # noqa:E501
+    try:
+        os.utime(filename)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _discard(process):
+    """Stop process that failed, so it is not used again."""
+    if process is not None:
+        process.close()
@@ -0,0 +1,307 @@
+"""Check media files are whole and within API limits before upload."""
+
+import os
+from collections import deque
+
+from gphoto import valid_video_ext
+
+# https://developers.google.com/photos/library/guides/upload-media#file-types-sizes
+PHOTO_MAX_BYTES = 200 * 1024 * 1024
+VIDEO_MAX_BYTES = 20 * 1024 * 1024 * 1024
+
+# cached results of older versions are checked again
+PREFLIGHT_VERSION = 1
+PREFLIGHT_WORKERS = 8
+PREFLIGHT_FLUSH_SIZE = 50
+
+# bytes read from start and end of files, never the whole file
+HEADER_SIZE = 64 * 1024
+TAIL_SIZE = 4 * 1024
+
+# containers are walked box by box, giving up on very fragmented files
+MAX_BOXES = 10000
+
+# extensions with too many layouts to recognize, only checked by size
+UNSNIFFED_TYPES = ('RAW', 'MMV')
+
+FORMAT_KINDS = {
+    'JPEG': 'photo',
+    'PNG': 'photo',
+    'GIF': 'photo',
+    'BMP': 'photo',
+    'TIFF': 'photo',
+    'WEBP': 'photo',
+    'HEIC': 'photo',
+    'ICO': 'photo',
+    'CR3': 'photo',
+    'MP4': 'video',
+    'AVI': 'video',
+    'ASF': 'video',
+    'MKV': 'video',
+    'MPEG': 'video',
+    'MPEG-TS': 'video'
+}
+
+# https://nokiatech.github.io/heif/technical.html
+HEIF_BRANDS = (b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'mif1', b'msf1')  # noqa:E501
+
+# quicktime files written before ftyp existed start with one of these
+QUICKTIME_BOXES = (b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot')
+
+
+def sniff_format(header):
+    """Name of media format from first bytes of file.
+
+    Args:
+        header (bytes): start of file
+
+    Returns:
+        str: key of FORMAT_KINDS, None if not recognized
+    """
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'GIF'
+    if header.startswith(b'BM'):
+        return 'BMP'
+    if header[:4] in (b'II*\x00', b'MM\x00*', b'IIRO', b'IIRS', b'IIU\x00'):
+        return 'TIFF'
+    if header.startswith(b'\x00\x00\x01\x00'):
+        return 'ICO'
+    if header.startswith(b'RIFF'):
+        return {b'WEBP': 'WEBP', b'AVI ': 'AVI'}.get(header[8:12])
+    if header[4:8] == b'ftyp':
+        if header[8:12] in HEIF_BRANDS:
+            return 'HEIC'
+        return 'CR3' if header[8:12] == b'crx ' else 'MP4'
+    if header[4:8] in QUICKTIME_BOXES:
+        return 'MP4'
+    if header.startswith(b'\x30\x26\xb2\x75\x8e\x66\xcf\x11'):
+        return 'ASF'
+    if header.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'MKV'
+    if header[:4] in (b'\x00\x00\x01\xba', b'\x00\x00\x01\xb3'):
+        return 'MPEG'
+
+    # transport streams, plain or with 4 byte timestamps as in m2ts
+    if header[:1] == b'\x47' and header[188:189] in (b'\x47', b''):
+        return 'MPEG-TS'
+    if header[4:5] == b'\x47' and header[196:197] in (b'\x47', b''):
+        return 'MPEG-TS'
+    return None
+
+
+def check_file(filename, size=None):
+    """Find why file would be rejected by API, without reading it all.
+
+    Args:
+        filename (str): full path filename locally on disk
+        size (int): bytes on disk, if already known
+
+    Returns:
+        str: reason file should not be uploaded, None if it looks fine
+
+    Raises:
+        OSError: file not readable
+    """
+    if size is None:
+        size = os.path.getsize(filename)
+    kind = 'video' if valid_video_ext(filename) else 'photo'
+    if size == 0:
+        return 'empty file'
+    if kind == 'video' and size > VIDEO_MAX_BYTES:
+        return f'over {VIDEO_MAX_BYTES // 1024 ** 3} GB video limit'
+    if kind == 'photo' and size > PHOTO_MAX_BYTES:
+        return f'over {PHOTO_MAX_BYTES // 1024 ** 2} MB photo limit'
+    if filename.split('.')[-1].upper() in UNSNIFFED_TYPES:
+        return None
+    with open(filename, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+        media_format = sniff_format(header)
+        if media_format is None:
+            return 'unrecognized content'
+        if FORMAT_KINDS[media_format] != kind:
+            return f'{media_format} {FORMAT_KINDS[media_format]} named as {kind}'  # noqa:E501
+        return _check_integrity(f, media_format, header, size)
+
+
+def _check_integrity(f, media_format, header, size):
+    if media_format == 'JPEG':
+        return _check_jpeg(f, header, size)
+    if media_format in ('MP4', 'HEIC', 'CR3'):
+        return _check_boxes(f, media_format, size)
+    if media_format in ('PNG', 'GIF'):
+        f.seek(max(0, size - TAIL_SIZE))
+        tail = f.read().rstrip(b'\x00')
+        if media_format == 'PNG' and b'IEND' not in tail:
+            return 'truncated, no IEND chunk'
+        if media_format == 'GIF' and not tail.endswith(b';'):
+            return 'truncated, no trailer'
+        return None
+
+    # sizes and offsets recorded in headers must lie within the file
+    if media_format == 'BMP' and len(header) >= 6:
+        if int.from_bytes(header[2:6], 'little') > size:
+            return 'truncated, shorter than header size'
+    if media_format in ('WEBP', 'AVI') and len(header) >= 8:
+        if int.from_bytes(header[4:8], 'little') + 8 > size:
+            return 'truncated, shorter than header size'
+    if media_format == 'TIFF' and len(header) >= 8:
+        byteorder = 'little' if header.startswith(b'II') else 'big'
+        if int.from_bytes(header[4:8], byteorder) >= size:
+            return 'truncated, first directory past end'
+    return None
+
+
+def _check_jpeg(f, header, size):
+
+    # walk marker segments to start of scan, they are often over 64 KB
+    position = 2
+    while True:
+        f.seek(position)
+        marker = f.read(4)
+        if len(marker) < 4 or marker[0] != 0xff:
+            return 'truncated, headers incomplete'
+        if marker[1] == 0xff:
+            position += 1
+            continue
+        if marker[1] == 0xda:
+            break
+        position += 2 + int.from_bytes(marker[2:4], 'big')
+
+    # motion photos carry a video after the image, ending elsewhere
+    f.seek(max(position, size - TAIL_SIZE))
+    tail = f.read()
+    if b'\xff\xd9' in tail or b'SEFT' in tail:
+        return None
+    if b'MotionPhoto' in header or b'MicroVideo' in header:
+        return None
+    return 'truncated, no end of image marker'
+
+
+def _check_boxes(f, media_format, size):
+
+    # top level boxes must end exactly at end of file
+    position = 0
+    box_types = set()
+    for _ in range(MAX_BOXES):
+        if size - position < 8:
+            break
+        f.seek(position)
+        box = f.read(16)
+        box_size = int.from_bytes(box[:4], 'big')
+        if box_size == 1:
+            box_size = int.from_bytes(box[8:16], 'big')
+        elif box_size == 0:
+            box_size = size - position
+        if box_size < 8:
+            return 'corrupt, invalid box size'
+        box_types.add(box[4:8])
+        position += box_size
+        if position > size:
+            return f'truncated, {box[4:8].decode(errors="replace")} box past end'  # noqa:E501
+    else:
+        return None
+    if media_format == 'MP4' and b'moov' not in box_types:
+        return 'incomplete, no moov box'
+    if media_format in ('HEIC', 'CR3') and b'meta' not in box_types \
+            and b'moov' not in box_types:
+        return 'incomplete, no meta box'
+    return None
+
+
+class Preflight(object):
+    """Checks of files before upload, cached in db until files change."""
+
+    db = None
+    workers = PREFLIGHT_WORKERS
+
+    def __init__(self, db, workers=PREFLIGHT_WORKERS):
+        """Create checker.
+
+        Args:
+            db (database.DB): store results are cached in
+            workers (int): threads reading files at once
+        """
+        if workers < 1:
+            raise ValueError('Invalid workers')
+        self.db = db
+        self.workers = workers
+
+    def check(self, filenames):
+        """Check files in parallel threads as they arrive.
+
+        Files unchanged since an earlier check are not read again.
+
+        Args:
+            filenames (iterable[str]): full path filenames locally on disk, grouped by dir
+
+        Yields:
+            tuple(str, str): filename and reason it should not be uploaded or None, in input order
+        """  # noqa:E501
+        from concurrent.futures import ThreadPoolExecutor
+
+        cache_dir = None
+        cached = {}
+        results = []
+
+        def result(item):
+            filename, stat, error, future = item
+            if future is None:
+                return filename, error
+            try:
+                error = future.result()
+            except OSError as e:
+                # not cached, may be readable once permissions are fixed
+                return filename, f'unreadable, {e.strerror}'
+            results.append({
+                'local_dir': os.path.dirname(filename),
+                'filename': os.path.basename(filename),
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'version': PREFLIGHT_VERSION,
+                'error': error
+            })
+            if len(results) >= PREFLIGHT_FLUSH_SIZE:
+                self.db.save_preflight_results(results)
+                results.clear()
+            return filename, error
+
+        # bounded window of files in flight, so input is consumed lazily,
+        # files checked by earlier runs pass straight through
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            try:
+                for filename in filenames:
+
+                    # only the current dir's results are held in memory
+                    if os.path.dirname(filename) != cache_dir:
+                        cache_dir = os.path.dirname(filename)
+                        cached = {
+                            x['filename']: x
+                            for x in self.db.select_preflight_results(cache_dir)  # noqa:E501
+                        }
+                    try:
+                        stat = os.stat(filename)
+                    except OSError as e:
+                        pending.append((filename, None, f'unreadable, {e.strerror}', None))  # noqa:E501
+                    else:
+                        row = cached.get(os.path.basename(filename))
+                        if row and row['size'] == stat.st_size \
+                                and row['mtime_ns'] == stat.st_mtime_ns \
+                                and row['version'] == PREFLIGHT_VERSION:
+                            pending.append((filename, stat, row['error'], None))  # noqa:E501
+                        else:
+                            future = executor.submit(check_file, filename, stat.st_size)  # noqa:E501
+                            pending.append((filename, stat, None, future))
+                    while pending and (
+                        len(pending) >= self.workers * 4
+                        or pending[0][3] is None
+                    ):
+                        yield result(pending.popleft())
+                while pending:
+                    yield result(pending.popleft())
+            finally:
+                self.db.save_preflight_results(results)
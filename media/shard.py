@@ -0,0 +1,154 @@
+"""Share uploads of one tree between workers, through leases in app db."""
+
+import os
+import threading
+import time
+
+# files claimed at once, and how long a lease outlives its worker
+LEASE_CHUNK_SIZE = 50
+LEASE_SECONDS = 300
+
+
+def worker_name():
+    """Name unique to this process among hosts sharing app db."""
+    import socket
+
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class ShardLeases(object):
+    """Leases on files held by one worker, renewed until it stops.
+
+    Workers scan the same tree, each uploading only files it leased. Files
+    leased to others are claimed again once everything leased is uploaded,
+    so leases of workers that stop without releasing them are picked up
+    when they expire.
+    """
+
+    db = None
+    album_id = None
+    worker = None
+    lease_seconds = LEASE_SECONDS
+    skipped = 0
+    waiting = None
+
+    def __init__(self, db, album_id, worker=None, lease_seconds=LEASE_SECONDS):
+        """Create leases for uploads into one album.
+
+        Args:
+            db (database.DB): app database shared by workers
+            album_id (int): db id of album uploading into
+            worker (str): name unique among workers, defaults to host and pid
+            lease_seconds (int): leases expire unless renewed in time, renewed every third of it
+        """  # noqa:E501
+        if lease_seconds < 3:
+            raise ValueError('Invalid lease_seconds')
+        self.db = db
+        self.album_id = album_id
+        self.worker = worker or worker_name()
+        self.lease_seconds = lease_seconds
+        self.skipped = 0
+        self.waiting = []
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def claim(self, filenames, chunk_size=LEASE_CHUNK_SIZE):
+        """Lease files in chunks, keeping those no other worker has.
+
+        Uploads are checked again once leased, as workers record them
+        before releasing leases, so no file is uploaded twice.
+
+        Args:
+            filenames (iterable[str]): full path filenames, consumed lazily
+            chunk_size (int): files to claim at once
+
+        Yields:
+            str: full path filenames leased to this worker
+        """
+        chunk = []
+        for filename in filenames:
+            chunk.append(filename)
+            if len(chunk) >= chunk_size:
+                yield from self._claim_chunk(chunk)
+                chunk = []
+        yield from self._claim_chunk(chunk)
+
+    def reclaim(self, chunk_size=LEASE_CHUNK_SIZE):
+        """Wait a beat, then claim files that were leased to other workers.
+
+        Only called once this worker's own leases are released, so workers
+        finishing together never wait on each other.
+
+        Args:
+            chunk_size (int): files to claim at once
+
+        Yields:
+            str: full path filenames leased to this worker
+        """
+        time.sleep(self.lease_seconds / 3)
+        waiting = self.waiting
+        self.waiting = []
+        for i in range(0, len(waiting), chunk_size):
+            yield from self._claim_chunk(waiting[i:i + chunk_size])
+
+    def release(self, filenames):
+        """Give up leases on files, e.g. once uploads are recorded.
+
+        Args:
+            filenames (list[str]): full path filenames
+        """
+        self.db.delete_upload_leases(self.album_id, filenames, self.worker)
+
+    def start(self):
+        """Renew leases in background thread from now on."""
+        if self.thread is None:
+            self.db.delete_expired_upload_leases()
+            self.thread = threading.Thread(
+                target=self._heartbeat,
+                name='shard-leases',
+                daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        """End renewals and release leases still held."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.db.delete_worker_upload_leases(self.worker)
+
+    def _claim_chunk(self, chunk):
+        leased = self.db.claim_upload_leases(
+            self.album_id,
+            chunk,
+            self.worker,
+            self.lease_seconds
+        )
+        self.waiting += [x for x in chunk if x not in leased]
+
+        # finished by a worker whose lease ended since this one scanned,
+        # or failed and waiting to retry
+        uploaded = set()
+        done = set()
+        for local_dir in set(os.path.dirname(x) for x in leased):
+            for x in self.db.select_uploads(local_dir, self.album_id):
+                filename = os.path.join(local_dir, x['filename'])
+                uploaded.add(filename)
+                if x['uploaded']:
+                    done.add(filename)
+        uploaded &= leased
+        if uploaded:
+            self.skipped += len(done & leased)
+            self.release(list(uploaded))
+        for filename in chunk:
+            if filename in leased and filename not in uploaded:
+                yield filename
+
+    def _heartbeat(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            try:
+                self.db.renew_upload_leases(self.worker, self.lease_seconds)
+            except Exception:
+                # retried next beat, leases last three beats
+                pass
@@ -0,0 +1,260 @@
+"""Downscale and recompress images before upload, cached by content hash."""
+
+import math
+import os
+import tempfile
+from collections import deque
+
+# formats re-encoded as themselves, so file names and mime types still match
+TRANSFORM_FORMATS = ('JPEG', 'PNG', 'TIFF', 'HEIF')
+
+# tiff tags describe pixel layout too, only these are carried over
+# description, make, model, orientation, date, artist, copyright, exif, gps
+TIFF_METADATA_TAGS = (270, 271, 272, 274, 306, 315, 33432, 0x8769, 0x8825)
+
+# resized jpegs need re-encoding, at near original quality unless asked
+JPEG_RESIZE_QUALITY = 90
+
+# cache outgrowing this loses its least recently used copies
+TRANSFORM_CACHE_MAX_BYTES = 10 * 1024 * 1024 * 1024
+
+
+def transform_key(content_hash, max_pixels=None, jpeg_quality=None):
+    """Cache key of file contents under transform settings."""
+    return f'{content_hash}-{max_pixels or 0}-{jpeg_quality or 0}'
+
+
+def prune_cache(cache_dir, max_bytes=TRANSFORM_CACHE_MAX_BYTES):
+    """Delete least recently used copies until cache fits in max_bytes.
+
+    Copies are touched when reused, so modification time is time of last
+    use. Markers of files not worth transforming go with copies of their
+    age. Temporary dirs of runs in progress are left alone.
+
+    Args:
+        cache_dir (str): directory of cached copies, transformed or tagged
+        max_bytes (int): total size of copies kept
+
+    Returns:
+        tuple(int, int): files and bytes deleted
+    """
+    entries = []
+    for dir_path, dir_names, file_names in os.walk(cache_dir):
+        dir_names[:] = [x for x in dir_names if not x.startswith('.tmp-')]
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+    # newest kept until cap is reached, everything older is deleted
+    entries.sort(reverse=True)
+    total = 0
+    cut = len(entries)
+    for index, (_, size, _) in enumerate(entries):
+        total += size
+        if total > max_bytes:
+            cut = index
+            break
+    deleted_files = 0
+    deleted_bytes = 0
+    for _, size, path in entries[cut:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        deleted_files += 1
+        deleted_bytes += size
+    return deleted_files, deleted_bytes
+
+
+def transform_file(filename, cache_filename, max_pixels=None, jpeg_quality=None):  # noqa:E501
+    """Write smaller copy of image, keeping its date, GPS and orientation tags.
+
+    Args:
+        filename (str): full path filename locally on disk
+        cache_filename (str): where to write transformed copy
+        max_pixels (int): downscale images with more pixels, keeping aspect ratio
+        jpeg_quality (int): recompress jpegs at quality 1 to 95
+
+    Returns:
+        bool: if copy was written, otherwise original is smaller or not an image
+
+    Raises:
+        OSError: copy could not be written, e.g. disk full
+    """  # noqa:E501
+    from PIL import Image
+
+    # heic is only readable with optional plugin installed
+    try:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+    except ImportError:
+        pass
+
+    try:
+        with Image.open(filename) as im:
+            if im.format not in TRANSFORM_FORMATS:
+                return False
+            resize = bool(max_pixels) and im.width * im.height > max_pixels
+            recompress = bool(jpeg_quality) and im.format == 'JPEG'
+            if not resize and not recompress:
+                return False
+
+            # raw exif block copied as is, google photos reads tag order too
+            exif = im.info.get('exif') or im.getexif()
+            if im.format == 'TIFF':
+                for tag in list(exif):
+                    if tag not in TIFF_METADATA_TAGS:
+                        del exif[tag]
+            params = {
+                'exif': exif,
+                'icc_profile': im.info.get('icc_profile')
+            }
+            if im.format == 'JPEG':
+                params['quality'] = jpeg_quality or JPEG_RESIZE_QUALITY
+            image_format = im.format
+
+            # jpegs are decoded at reduced scale, much faster than full size
+            if resize:
+                scale = math.sqrt(max_pixels / (im.width * im.height))
+                im.thumbnail((
+                    max(1, int(im.width * scale)),
+                    max(1, int(im.height * scale))
+                ))
+            else:
+                im.load()
+
+    # only files failing to decode are not images, errors writing are raised
+    except (Image.UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError):  # noqa:E501
+        return False
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(cache_filename),
+        prefix='.tmp-'
+    )
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            im.save(f, format=image_format, **params)
+        if os.path.getsize(tmp_filename) >= os.path.getsize(filename):
+            os.unlink(tmp_filename)
+            return False
+        os.replace(tmp_filename, cache_filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+        raise
+    return True
+
+
+class TransformCache(object):
+    """Transformed copies of images on disk, named by content hash."""
+
+    cache_dir = None
+    max_pixels = None
+    jpeg_quality = None
+
+    def __init__(self, cache_dir, max_pixels=None, jpeg_quality=None):
+        """Create cache for one set of transform settings.
+
+        Args:
+            cache_dir (str): directory to keep transformed copies in, created if missing
+            max_pixels (int): downscale images with more pixels, keeping aspect ratio
+            jpeg_quality (int): recompress jpegs at quality 1 to 95
+        """  # noqa:E501
+        if max_pixels is not None and max_pixels < 1:
+            raise ValueError('Invalid max_pixels')
+        if jpeg_quality is not None and not 1 <= jpeg_quality <= 95:
+            raise ValueError('Invalid jpeg_quality')
+        self.cache_dir = cache_dir
+        self.max_pixels = max_pixels
+        self.jpeg_quality = jpeg_quality
+
+    def transform(self, filenames, content_hashes, workers=None):
+        """Transform images in parallel processes as they arrive.
+
+        Copies made by earlier runs are reused, as are files found not worth
+        transforming, which are marked with an empty file. Files whose copy
+        fails to write are not marked, so they are tried again next run.
+
+        Args:
+            filenames (iterable[str]): full path filenames locally on disk
+            content_hashes (dict): hashes of files, by filename
+            workers (int): processes to transform with, defaults to cpu count
+
+        Yields:
+            tuple(str, str, str): filename, file to upload instead or None to upload original, and error if writing copy failed, in input order
+        """  # noqa:E501
+        workers = workers or os.cpu_count() or 1
+        if workers == 1:
+            for filename in filenames:
+                try:
+                    yield filename, self._transform(filename, content_hashes[filename]), None  # noqa:E501
+                except OSError as e:
+                    yield filename, None, f'copy not written, {e}'
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        # bounded window of files in flight, so input is consumed lazily,
+        # files transformed by earlier runs pass straight through
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for filename in filenames:
+                content_hash = content_hashes[filename]
+                cached = self._cached(filename, content_hash)
+                future = None
+                if cached is None:
+                    future = executor.submit(self._transform, filename, content_hash)  # noqa:E501
+                pending.append((filename, cached, future))
+                while pending and (
+                    len(pending) >= workers * 4 or pending[0][2] is None
+                ):
+                    yield self._result(pending.popleft())
+            while pending:
+                yield self._result(pending.popleft())
+
+    def _result(self, item):
+        filename, cached, future = item
+        if future is None:
+            return filename, cached or None, None
+        try:
+            return filename, future.result(), None
+        except OSError as e:
+            return filename, None, f'copy not written, {e}'
+
+    def _cached(self, filename, content_hash):
+        """Copy or empty marker from earlier run, None if not done yet."""
+        cache_filename = self._filename(filename, content_hash)
+        try:
+            # touched as used, so pruning drops copies unused for longest
+            os.utime(cache_filename)
+            if os.path.getsize(cache_filename):
+                return cache_filename
+            return ''
+        except FileNotFoundError:
+            return None
+
+    def _transform(self, filename, content_hash):
+        cached = self._cached(filename, content_hash)
+        if cached is not None:
+            return cached or None
+        cache_filename = self._filename(filename, content_hash)
+        os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+        if transform_file(filename, cache_filename, self.max_pixels, self.jpeg_quality):  # noqa:E501
+            return cache_filename
+
+        # remembered as not worth transforming
+        open(cache_filename, 'ab').close()
+        return None
+
+    def _filename(self, filename, content_hash):
+
+        # same extension as original, so upload mime type is unchanged
+        _, ext = os.path.splitext(filename)
+        return os.path.join(
+            self.cache_dir,
+            content_hash[:2],
+            transform_key(content_hash, self.max_pixels, self.jpeg_quality) + ext.lower()  # noqa:E501
+        )
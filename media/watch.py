@@ -0,0 +1,215 @@
+"""Wait for changes under directory trees, via inotify where available."""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+# https://man7.org/linux/man-pages/man7/inotify.7.html
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+
+def create_watcher(settle=2, polling=False):
+    """Watch with inotify, falling back to polling where it is unavailable.
+
+    Args:
+        settle (float): seconds without events before a change is reported
+        polling (bool): skip inotify, e.g. for network mounts
+
+    Returns:
+        InotifyWatcher|PollingWatcher: watcher with no directories added
+    """
+    if not polling:
+        try:
+            return InotifyWatcher(settle)
+        except OSError:
+            pass
+    return PollingWatcher()
+
+
+class PollingWatcher(object):
+    """Report every directory tree changed after each interval.
+
+    Cheap with DirScanner, which only lists directories whose mtime moved.
+    """
+
+    roots = None
+
+    def __init__(self):
+        """Create watcher with no directories."""
+        self.roots = {}
+
+    def add(self, root, recursive=False):
+        """Watch directory tree.
+
+        Args:
+            root (str): full path of directory locally on disk
+            recursive (bool): include sub directories
+        """
+        self.roots[root] = recursive
+
+    def changes(self, timeout):
+        """Wait out timeout, then report all trees.
+
+        Args:
+            timeout (float): seconds to wait
+
+        Returns:
+            set[str]: roots that may have changed
+        """
+        time.sleep(timeout)
+        return set(self.roots)
+
+    def close(self):
+        """Nothing held open."""
+
+
+class InotifyWatcher(object):
+    """Report directory trees changed, once writes to them settle.
+
+    Trees whose new sub directories can not be watched, e.g. once
+    max_user_watches is reached, are reported after every timeout instead,
+    like PollingWatcher.
+    """
+
+    fd = None
+    settle = 2
+    roots = None
+    paths = None
+    watch_roots = None
+    polled = None
+
+    def __init__(self, settle=2):
+        """Open inotify instance.
+
+        Args:
+            settle (float): seconds without events before a change is reported
+
+        Raises:
+            OSError: inotify not available on this platform
+        """
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError('libc not found')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify not supported')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.settle = settle
+        self.roots = {}
+        self.paths = {}
+        self.watch_roots = {}
+        self.polled = set()
+
+    def add(self, root, recursive=False):
+        """Watch directory tree.
+
+        Args:
+            root (str): full path of directory locally on disk
+            recursive (bool): include sub directories
+
+        Raises:
+            OSError: watch could not be added, e.g. max_user_watches reached
+        """
+        self.roots[root] = recursive
+        self._watch_tree(root, root)
+
+    def changes(self, timeout):
+        """Block until watched trees change and settle, or timeout passes.
+
+        Args:
+            timeout (float): max seconds to wait
+
+        Returns:
+            set[str]: roots with changes, or polled, empty if none before timeout
+        """  # noqa:E501
+        changed = set()
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = deadline - time.monotonic()
+            if changed:
+                wait = min(wait, self.settle)
+            if wait <= 0:
+                return changed | self.polled
+            ready, _, _ = select.select([self.fd], [], [], wait)
+            if not ready:
+                if changed:
+                    return changed
+                continue
+            changed |= self._read_events()
+
+    def close(self):
+        """Release inotify instance and its watches."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _watch_tree(self, path, root):
+        if self.roots[root]:
+            for dir_path, _, _ in os.walk(path):
+                self._watch_dir(dir_path, root)
+        else:
+            self._watch_dir(path, root)
+
+    def _watch_dir(self, path, root):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)  # noqa:E501
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'Unable to watch "{path}"')
+        self.paths[wd] = path
+        self.watch_roots.setdefault(wd, set()).add(root)
+
+    def _read_events(self):
+        changed = set()
+        while True:
+            try:
+                buf = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+                name = buf[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')  # noqa:E501
+                offset += EVENT_HEADER.size + length
+
+                # events were dropped, anything may have changed
+                if mask & IN_Q_OVERFLOW:
+                    changed |= set(self.roots)
+                    continue
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+                    self.watch_roots.pop(wd, None)
+                    continue
+                roots = self.watch_roots.get(wd, set())
+                changed |= roots
+
+                # follow new sub directories of recursive trees
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    sub_dir = os.path.join(self.paths[wd], os.fsdecode(name))
+                    for root in roots:
+                        if self.roots[root]:
+                            try:
+                                self._watch_tree(sub_dir, root)
+                            except FileNotFoundError:
+                                pass
+                            except OSError:
+                                # out of watches, tree is polled from now on
+                                self.polled.add(root)
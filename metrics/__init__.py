@@ -0,0 +1,231 @@
+"""Timing spans and counters for runs, exported as json or prometheus."""
+
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds, wide enough for sqlite queries and multi GB uploads alike
+BUCKETS = (
+    0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900
+)
+PROMETHEUS_PREFIX = 'gphotos_uploader_'
+
+
+class Metrics(object):
+    """Thread safe counters and latency histograms for one run."""
+
+    started = None
+    lock = None
+    counters = None
+    histograms = None
+
+    def __init__(self):
+        """Start run clock with nothing recorded."""
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.local = threading.local()
+
+    def inc(self, name, value=1, **labels):
+        """Add to counter.
+
+        Args:
+            name (str): counter name
+            value (float): amount to add
+            labels (str): dimensions to count separately, e.g. endpoint, values kept as str
+        """  # noqa:E501
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """Add duration to histogram.
+
+        Args:
+            name (str): histogram name
+            seconds (float): duration observed
+            labels (str): dimensions to bucket separately, e.g. endpoint, values kept as str
+        """  # noqa:E501
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'count': 0,
+                    'sum': 0.0,
+                    'max': 0.0,
+                    'buckets': [0] * len(BUCKETS)
+                }
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+            index = bisect.bisect_left(BUCKETS, seconds)
+            if index < len(BUCKETS):
+                histogram['buckets'][index] += 1
+
+    @contextmanager
+    def span(self, name, **labels):
+        """Time block into histogram, whether or not it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def phase(self, name):
+        """Time block into phase_seconds counter, less nested phases.
+
+        Stages of a generator pipeline call into each other, so only time
+        spent in the stage itself is counted. Nesting is tracked per thread.
+        """
+        stack = self.local.__dict__.setdefault('phases', [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.inc('phase_seconds', elapsed - nested, phase=name)
+
+    def iterate(self, name, iterable):
+        """Yield from iterable, timing each step as a phase.
+
+        Args:
+            name (str): phase name
+            iterable (iterable): stage of pipeline, consumed lazily
+
+        Yields:
+            items of iterable
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self):
+        """Everything recorded so far.
+
+        Returns:
+            dict: run summary
+                - started (float): unix time run started
+                - seconds (float): wall time since start
+                - counters (dict): list of labels and value, by name
+                - histograms (dict): list of labels, count, sum, max and cumulative buckets, by name
+        """  # noqa:E501
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {
+                key: dict(value, buckets=list(value['buckets']))
+                for key, value in self.histograms.items()
+            }
+        summary = {
+            'started': self.started,
+            'seconds': time.time() - self.started,
+            'counters': {},
+            'histograms': {}
+        }
+        for (name, labels), value in sorted(counters.items()):
+            summary['counters'].setdefault(name, []).append({
+                'labels': dict(labels),
+                'value': value
+            })
+        for (name, labels), value in sorted(histograms.items()):
+            cumulative = 0
+            buckets = {}
+            for le, count in zip(BUCKETS, value['buckets']):
+                cumulative += count
+                buckets[str(le)] = cumulative
+            summary['histograms'].setdefault(name, []).append({
+                'labels': dict(labels),
+                'count': value['count'],
+                'sum': value['sum'],
+                'max': value['max'],
+                'buckets': buckets
+            })
+        return summary
+
+    def write_json(self, filename):
+        """Save summary as json.
+
+        Args:
+            filename (str): file to replace
+        """
+        _write_atomic(filename, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, filename):
+        """Save summary in text format, for node_exporter textfile collector.
+
+        Args:
+            filename (str): file to replace, ending in .prom
+        """
+        summary = self.summary()
+        lines = [
+            f'# TYPE {PROMETHEUS_PREFIX}run_start_time_seconds gauge',
+            f'{PROMETHEUS_PREFIX}run_start_time_seconds {summary["started"]}',
+            f'# TYPE {PROMETHEUS_PREFIX}run_seconds gauge',
+            f'{PROMETHEUS_PREFIX}run_seconds {summary["seconds"]}'
+        ]
+        for name, series in summary['counters'].items():
+            metric = f'{PROMETHEUS_PREFIX}{name}_total'
+            lines.append(f'# TYPE {metric} counter')
+            for x in series:
+                lines.append(f'{metric}{_labels(x["labels"])} {x["value"]}')
+        for name, series in summary['histograms'].items():
+            metric = f'{PROMETHEUS_PREFIX}{name}'
+            lines.append(f'# TYPE {metric} histogram')
+            for x in series:
+                for le, count in x['buckets'].items():
+                    lines.append(f'{metric}_bucket{_labels(x["labels"], le=le)} {count}')  # noqa:E501
+                lines.append(f'{metric}_bucket{_labels(x["labels"], le="+Inf")} {x["count"]}')  # noqa:E501
+                lines.append(f'{metric}_sum{_labels(x["labels"])} {x["sum"]}')
+                lines.append(f'{metric}_count{_labels(x["labels"])} {x["count"]}')  # noqa:E501
+        _write_atomic(filename, '\n'.join(lines) + '\n')
+
+
+def _key(name, labels):
+    """Key of one series, label values as str so mixed values still sort, e.g. http status codes and errors."""  # noqa:E501
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))  # noqa:E501
+
+
+def _labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            key,
+            str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')  # noqa:E501
+        )
+        for key, value in labels.items()
+    )
+    return '{' + pairs + '}'
+
+
+def _write_atomic(filename, contents):
+
+    # readers such as node_exporter never see a partly written file
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)),
+        prefix='.tmp-'
+    )
+    try:
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
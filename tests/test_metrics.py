@@ -0,0 +1,41 @@
+"""Tests of run metrics."""
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))  # noqa:E501
+
+from metrics import Metrics  # noqa:E402
+
+
+class MetricsTest(unittest.TestCase):
+    """Summaries of counters and histograms."""
+
+    def test_mixed_label_values(self):
+        """HTTP status codes and connection errors share one series."""
+        metrics = Metrics()
+        metrics.inc('api_requests', endpoint='v1/uploads', status=200)
+        metrics.inc('api_requests', endpoint='v1/uploads', status='error')
+        metrics.inc('api_requests', endpoint='v1/uploads', status=200)
+        metrics.observe('api_request_seconds', 0.1, status=503)
+        metrics.observe('api_request_seconds', 0.2, status='error')
+
+        counters = metrics.summary()['counters']['api_requests']
+        self.assertEqual(
+            [(x['labels']['status'], x['value']) for x in counters],
+            [('200', 2), ('error', 1)]
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            metrics.write_json(os.path.join(tmp_dir, 'metrics.json'))
+            metrics.write_prometheus(os.path.join(tmp_dir, 'metrics.prom'))
+            with open(os.path.join(tmp_dir, 'metrics.json')) as f:
+                self.assertIn('histograms', json.load(f))
+            with open(os.path.join(tmp_dir, 'metrics.prom')) as f:
+                self.assertIn('status="error"', f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()